@@ -0,0 +1,224 @@
+import argparse
+import asyncio
+import json
+import random
+from collections import Counter
+from dataclasses import dataclass, field, fields
+
+from aiohttp import web
+
+
+@dataclass
+class Latency:
+    # fixed: always ms; uniform: ms ± spread milliseconds; normal: mean ms, standard deviation spread milliseconds;
+    # lognormal: median ms, sigma spread; exponential: mean ms
+    distribution: str = "fixed"
+    ms: float = 0.0
+    spread: float = 0.0
+
+    def sample(self, rng: random.Random) -> float:
+        match self.distribution:
+            case "fixed":
+                value = self.ms
+            case "uniform":
+                value = rng.uniform(self.ms - self.spread, self.ms + self.spread)
+            case "normal":
+                value = rng.gauss(self.ms, self.spread)
+            case "lognormal":
+                value = self.ms * rng.lognormvariate(0, self.spread)
+            case "exponential":
+                value = rng.expovariate(1 / self.ms) if self.ms else 0.0
+            case _:
+                raise ValueError(f"Unknown latency distribution {self.distribution}")
+        return max(value, 0.0) / 1000
+
+
+@dataclass
+class EndpointBehaviour:
+    latency: Latency = field(default_factory=Latency)
+    # Share of requests answered with error_status
+    error_rate: float = 0.0
+    error_status: int = 500
+    # Share of requests that hang for timeout_seconds, longer than the bot waits
+    timeout_rate: float = 0.0
+    timeout_seconds: float = 60.0
+    # Filler added to every JSON answer
+    padding_bytes: int = 0
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "EndpointBehaviour":
+        data = dict(data)
+        if 'latency' in data:
+            data['latency'] = Latency(**data['latency'])
+        return cls(**data)
+
+
+@dataclass
+class StubSettings:
+    default: EndpointBehaviour = field(default_factory=EndpointBehaviour)
+    # Per path overrides of the default behaviour, e.g. "/question"
+    endpoints: dict[str, EndpointBehaviour] = field(default_factory=dict)
+    sellers: int = 5
+    legals: int = 3
+    bank_accounts: int = 2
+    seed: int | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "StubSettings":
+        data = dict(data)
+        if 'default' in data:
+            data['default'] = EndpointBehaviour.from_dict(data['default'])
+        data['endpoints'] = {
+            path: EndpointBehaviour.from_dict(behaviour)
+            for path, behaviour in data.get('endpoints', {}).items()
+        }
+        unknown = set(data) - {settings_field.name for settings_field in fields(cls)}
+        if unknown:
+            raise ValueError(f"Unknown stub settings: {', '.join(sorted(unknown))}")
+        return cls(**data)
+
+    @classmethod
+    def load(cls, path: str) -> "StubSettings":
+        with open(path, encoding="utf-8") as file:
+            return cls.from_dict(json.load(file))
+
+    def behaviour(self, path: str) -> EndpointBehaviour:
+        return self.endpoints.get(path, self.default)
+
+
+class BackendStub:
+    def __init__(self, settings: StubSettings | None = None):
+        self.settings = settings or StubSettings()
+        self.random = random.Random(self.settings.seed)
+        self.requests: Counter[tuple[str, str]] = Counter()
+        # Orders that reached the handler per user, the load generator counts a dialog as completed by them
+        self.orders: Counter[int] = Counter()
+
+        self.sellers = [{'id': seller_id, 'name': f"Продавец {seller_id}"}
+                        for seller_id in range(1, self.settings.sellers + 1)]
+        self.legals = [{'id': legal_id, 'name': f"ООО Юрлицо {legal_id}", 'inn': f"77{legal_id:08d}"}
+                       for legal_id in range(1, self.settings.legals + 1)]
+        self.bank_accounts = [
+            {
+                'id': account_id,
+                'bill': f"4070281{account_id:013d}",
+                'name': "ОАО Банк" if account_id % 2 else "КБ Банк",
+                'date_add_current_sum': "01.01.2024"
+            }
+            for account_id in range(1, self.settings.bank_accounts + 1)
+        ]
+        # The /bill dialog: seller, legal entity, sum and a comment
+        self.questions = [
+            {'name': "sellers", 'name_ru': "Продавец", 'question': "Выберите продавца", 'type': "list",
+             'data': self.sellers},
+            {'name': "legals", 'name_ru': "Юрлицо", 'question': "Выберите юрлицо", 'type': "list",
+             'data': self.legals},
+            {'name': "sum", 'name_ru': "Сумма", 'question': "Введите сумму", 'type': "float", 'data': []},
+            {'name': "comment", 'name_ru': "Комментарий", 'question': "Введите комментарий", 'type': "text",
+             'data': []}
+        ]
+
+    @web.middleware
+    async def inject_faults(self, request: web.Request, handler) -> web.StreamResponse:
+        if request.path == "/stats" or request.path.startswith("/orders/"):
+            return await handler(request)
+        behaviour = self.settings.behaviour(request.path)
+        await asyncio.sleep(behaviour.latency.sample(self.random))
+        if self.random.random() < behaviour.timeout_rate:
+            self.requests[(request.path, "timeout")] += 1
+            await asyncio.sleep(behaviour.timeout_seconds)
+        elif self.random.random() < behaviour.error_rate:
+            self.requests[(request.path, str(behaviour.error_status))] += 1
+            return web.json_response({'error': 1, 'data': "Injected error"}, status=behaviour.error_status)
+        else:
+            self.requests[(request.path, "200")] += 1
+        return await handler(request)
+
+    def reply(self, request: web.Request, payload: dict) -> web.Response:
+        padding_bytes = self.settings.behaviour(request.path).padding_bytes
+        if padding_bytes:
+            payload = {**payload, 'padding': "x" * padding_bytes}
+        return web.json_response(payload)
+
+    async def add_message(self, request: web.Request) -> web.Response:
+        return self.reply(request, {'error': 0, 'data': "Сообщение сохранено"})
+
+    async def add_message_bulk(self, request: web.Request) -> web.Response:
+        items = await request.json()
+        return self.reply(request, {'error': 0, 'data': len(items)})
+
+    async def add_command(self, request: web.Request) -> web.Response:
+        return self.reply(request, {'error': 0, 'data': "Команда принята"})
+
+    async def is_admin(self, request: web.Request) -> web.Response:
+        return self.reply(request, {'error': 0, 'data': {'isValidAdmin': "True"}})
+
+    async def question(self, request: web.Request) -> web.Response:
+        current_question = int((await request.post())['current_question'])
+        if not 1 <= current_question <= len(self.questions):
+            return self.reply(request, {'error': 1, 'destroy': True, 'data': "Нет такого вопроса"})
+        return self.reply(request, {
+            'error': 0,
+            'data': [{
+                **self.questions[current_question - 1],
+                'required': True,
+                'last_question': current_question == len(self.questions)
+            }]
+        })
+
+    async def delete_messages(self, request: web.Request) -> web.Response:
+        return self.reply(request, {'error': 0, 'data': True})
+
+    async def is_access(self, request: web.Request) -> web.Response:
+        return self.reply(request, {'result': True, 'data': True})
+
+    async def order(self, request: web.Request) -> web.Response:
+        self.orders[json.loads((await request.post())['data'])['user_id']] += 1
+        return self.reply(request, {'error': 0, 'data': True, 'path': "https://example.com/bills/bill.pdf"})
+
+    async def bank_account_list(self, request: web.Request) -> web.Response:
+        return self.reply(request, {'error': 0, 'data': {'data': self.bank_accounts}})
+
+    async def current_balances(self, request: web.Request) -> web.Response:
+        return self.reply(request, {
+            'error': 0,
+            'data': [{'bill': account['bill'], 'current_sum': 100000.0} for account in self.bank_accounts]
+        })
+
+    async def stats(self, _: web.Request) -> web.Response:
+        return web.json_response({f"{path} {outcome}": count for (path, outcome), count in self.requests.items()})
+
+    async def user_orders(self, request: web.Request) -> web.Response:
+        return web.json_response({'orders': self.orders[int(request.match_info['user_id'])]})
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.inject_faults])
+        app.router.add_post("/telegram/message/add", self.add_message)
+        app.router.add_post("/telegram/message/add_bulk", self.add_message_bulk)
+        app.router.add_post("/telegram/command/add", self.add_command)
+        app.router.add_post("/telegram/is_admin", self.is_admin)
+        app.router.add_post("/question", self.question)
+        app.router.add_post("/message/delete", self.delete_messages)
+        app.router.add_post("/bill/is_access", self.is_access)
+        app.router.add_post("/order", self.order)
+        app.router.add_get("/bank_acoounts/", self.bank_account_list)
+        app.router.add_post("/bank_account/current_balances", self.current_balances)
+        app.router.add_get("/stats", self.stats)
+        app.router.add_get("/orders/{user_id}", self.user_orders)
+        return app
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, host=host, port=port).start()
+        return runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the bot's backend.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--config", help="JSON file with StubSettings, see the dataclasses above")
+    args = parser.parse_args()
+    settings = StubSettings.load(args.config) if args.config else StubSettings()
+    web.run_app(BackendStub(settings).make_app(), host=args.host, port=args.port)
@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import bot_logger
+import config
+import requests_to_server
+
+
+class BalanceCache:
+    # The backend decides what a user may see, so snapshots are fetched and kept per (chat_id, user_id)
+    def __init__(self, refresh_interval: float, idle_ttl: float):
+        self.refresh_interval = refresh_interval
+        self.idle_ttl = idle_ttl
+        self._snapshots: dict[tuple[int, int], list[dict[str]]] = {}
+        # When each user last asked, only recent ones are kept warm by the background refresh
+        self._used: dict[tuple[int, int], float] = {}
+        # Bumped per chat on invalidation, so a refresh started before it can't store an outdated snapshot
+        self._generations: dict[int, int] = {}
+        # One fetch at a time per user, different users don't wait for each other
+        self._refresh_locks: dict[tuple[int, int], asyncio.Lock] = {}
+        self._task: asyncio.Task | None = None
+
+    def get(self, chat_id: int, user_id: int) -> list[dict[str]] | None:
+        return self._snapshots.get((chat_id, user_id))
+
+    async def get_or_refresh(self, chat_id: int, user_id: int) -> list[dict[str]]:
+        key = (chat_id, user_id)
+        self._used[key] = time.monotonic()
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            snapshot = await self.refresh(key, only_if_missing=True)
+        return snapshot
+
+    def invalidate(self, chat_id: int) -> None:
+        # An order moves the balances of its chat's accounts only, other chats keep their snapshots.
+        # The chat's users get theirs fetched again on their next read, refreshing them all at once would be a burst
+        bot_logger.debug("Balance snapshots of chat %s were invalidated.", chat_id)
+        self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+        for key in [key for key in self._snapshots if key[0] == chat_id]:
+            del self._snapshots[key]
+
+    async def refresh(self, key: tuple[int, int], only_if_missing: bool = False) -> list[dict[str]]:
+        chat_id, user_id = key
+        async with self._refresh_locks.setdefault(key, asyncio.Lock()):
+            snapshot = self._snapshots.get(key)
+            if only_if_missing and snapshot is not None:
+                return snapshot
+            generation = self._generations.get(chat_id, 0)
+            response = await requests_to_server.request_balances(
+                data={
+                    'chat_id': chat_id,
+                    'user_id': user_id
+                },
+                from_user_id=user_id
+            )
+            snapshot = response.json()['data']
+            # Still fresh enough for this caller, who asked before the invalidation, but not kept for later ones
+            if generation == self._generations.get(chat_id, 0):
+                self._snapshots[key] = snapshot
+            return snapshot
+
+    async def refresh_all(self) -> None:
+        horizon = time.monotonic() - self.idle_ttl
+        for key, used_at in list(self._used.items()):
+            if used_at < horizon:
+                del self._used[key]
+                self._snapshots.pop(key, None)
+                lock = self._refresh_locks.get(key)
+                if lock is not None and not lock.locked():
+                    del self._refresh_locks[key]
+        for key in list(self._used):
+            try:
+                await self.refresh(key)
+            except Exception as e:
+                bot_logger.error(f"Failed to refresh the balance snapshot of user {key[1]} "
+                                 f"in chat {key[0]}: {repr(e)}.")
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await self.refresh_all()
+            await asyncio.sleep(self.refresh_interval)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+balance_cache = BalanceCache(
+    refresh_interval=config.BALANCES_REFRESH_INTERVAL,
+    idle_ttl=config.BALANCES_IDLE_TTL
+)
@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+import aiogram
+from aiogram import Bot, Dispatcher, types
+
+import backend_stub
+import config
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def chat(chat_id: int) -> dict:
+        return {'id': chat_id, 'type': "supergroup", 'title': f"Chat {chat_id}"}
+
+    @staticmethod
+    def user(user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}
+
+    def message(self, chat_id: int, user_id: int, **fields) -> types.Update:
+        return types.Update(
+            update_id=next(self._update_ids),
+            message={
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': self.chat(chat_id),
+                'from': self.user(user_id),
+                **fields
+            }
+        )
+
+    def callback(self, chat_id: int, user_id: int, message_id: int, data: str) -> types.Update:
+        update_id = next(self._update_ids)
+        return types.Update(
+            update_id=update_id,
+            callback_query={
+                'id': str(update_id),
+                'from': self.user(user_id),
+                'chat_instance': str(chat_id),
+                'data': data,
+                'message': {
+                    'message_id': message_id,
+                    'date': int(time.time()),
+                    'chat': self.chat(chat_id),
+                    'from': self.user(config.BOT_ID),
+                    'text': "Benchmark"
+                }
+            }
+        )
+
+
+class Benchmark:
+    def __init__(self, dispatcher: Dispatcher, backend: backend_stub.BackendStub, args: argparse.Namespace):
+        self.dispatcher = dispatcher
+        self.backend = backend
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.updates = UpdateFactory()
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: Counter[str] = Counter()
+        self.loop_lags: list[float] = []
+        self._semaphore = asyncio.Semaphore(args.concurrency)
+        self._processed: dict[int, asyncio.Future] = {}
+        dispatcher.scheduler.add_listener(self._on_processed)
+
+    def _on_processed(self, update: types.Update, error: BaseException | None) -> None:
+        future = self._processed.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(error)
+
+    async def process(self, route: str, update: types.Update) -> bool:
+        async with self._semaphore:
+            processed = self._processed[update.update_id] = asyncio.get_running_loop().create_future()
+            start = time.perf_counter()
+            try:
+                # Through the scheduler like polling and the webhook, so updates of a chat wait for each other
+                await self.dispatcher.process_updates([update])
+                error = await processed
+            finally:
+                self.latencies.setdefault(route, []).append(time.perf_counter() - start)
+            if error is not None:
+                self.errors[route] += 1
+                return False
+            return True
+
+    async def bill_message_id(self, chat_id: int, user_id: int) -> int:
+        data = await self.dispatcher.storage.get_data(chat=chat_id, user=user_id)
+        return data['state_data'].message_id
+
+    async def bill_dialog(self, chat_id: int, user_id: int) -> None:
+        updates = self.updates
+        await self.process("bill_start", updates.message(
+            chat_id, user_id, text="/bill", entities=[{'type': "bot_command", 'offset': 0, 'length': 5}]
+        ))
+        for number, question in enumerate(self.backend.questions, start=1):
+            message_id = await self.bill_message_id(chat_id, user_id)
+            match question['type']:
+                case "list":
+                    option = self.random.choice(question['data'])
+                    # Buttons carry the question's number, as util.answer_callback_data builds them
+                    await self.process("bill_list_answer", updates.callback(
+                        chat_id, user_id, message_id, f"{number}/{option['id']}"
+                    ))
+                case "float":
+                    await self.process("bill_number_answer", updates.message(
+                        chat_id, user_id, text=str(self.random.randint(1, 1_000_000))
+                    ))
+                case "text":
+                    await self.process("bill_text_answer", updates.message(
+                        chat_id, user_id, text="Оплата по договору"
+                    ))
+        await self.process("bill_confirm", updates.callback(
+            chat_id, user_id, await self.bill_message_id(chat_id, user_id), "yes"
+        ))
+        account = self.random.choice(self.backend.bank_accounts)
+        await self.process("admin_callback", updates.callback(
+            config.ADMIN_CHAT_ID, user_id, 1, f"admin/{chat_id}/{user_id}/{account['id']}"
+        ))
+
+    async def chat_traffic(self, chat_ids: list[int], user_ids: list[int]) -> None:
+        routes = ["text"] * self.args.messages + ["media"] * self.args.media + ["hashtag"] * self.args.hashtags
+        self.random.shuffle(routes)
+        tasks = []
+        for route in routes:
+            chat_id, user_id = self.random.choice(chat_ids), self.random.choice(user_ids)
+            match route:
+                case "text":
+                    update = self.updates.message(chat_id, user_id, text="Обычное сообщение в чате")
+                case "media":
+                    file_id = f"photo-{self.random.randrange(self.args.media)}"
+                    update = self.updates.message(chat_id, user_id, caption="Фото", photo=[
+                        {'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 720}
+                    ])
+                case _:
+                    update = self.updates.message(chat_id, user_id, text="##отчет за день")
+            tasks.append(self.process(route, update))
+        await asyncio.gather(*tasks)
+
+    async def monitor_loop_lag(self, interval: float = 0.01) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lags.append(max(0.0, time.perf_counter() - start - interval))
+
+    async def run(self) -> float:
+        chat_ids = [-1_000_000_000_000 - index for index in range(self.args.chats)]
+        # Every dialog has its own user, so concurrent dialogs never share an FSM record
+        dialogs = [
+            self.bill_dialog(chat_ids[index % len(chat_ids)], 10_000 + index)
+            for index in range(self.args.dialogs)
+        ]
+        monitor = asyncio.create_task(self.monitor_loop_lag())
+        start = time.perf_counter()
+        await asyncio.gather(
+            self.chat_traffic(chat_ids, list(range(20_000, 20_000 + self.args.chats * 5))),
+            *dialogs
+        )
+        elapsed = time.perf_counter() - start
+        monitor.cancel()
+        return elapsed
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    samples = sorted(samples)
+    percentiles = statistics.quantiles(samples, n=100, method="inclusive") if len(samples) > 1 else samples * 99
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentiles[49] * 1000, 3),
+        'p95_ms': round(percentiles[94] * 1000, 3),
+        'p99_ms': round(percentiles[98] * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3)
+    }
+
+
+def configure(args: argparse.Namespace, work_dir: Path) -> None:
+    # Has to happen before the bot's modules are imported, they read paths and the log level on import
+    base_url = f"http://{args.backend_host}:{args.backend_port}"
+    for name in dir(config):
+        if name.startswith("WEB_URL_"):
+            setattr(config, name, getattr(config, name).replace("http://example.com", base_url))
+    config.LOG_LEVEL = args.log_level
+    config.LOG_FILE_PATH = str(work_dir / "bot.log")
+    config.FSM_STORAGE_PATH = str(work_dir / "fsm.sqlite3")
+    config.SPOOL_PATH = str(work_dir / "spool.sqlite3")
+    config.TRACE_FILE_PATH = str(work_dir / "traces.jsonl")
+    config.TRACE_ENABLED = args.tracing
+    config.METRICS_ENABLED = False
+    if not args.rate_limits:
+        config.TELEGRAM_RATE_LIMITED_METHODS = set()
+
+
+@contextlib.asynccontextmanager
+async def running_bot(args: argparse.Namespace):
+    settings = backend_stub.StubSettings.load(args.backend_config) if args.backend_config else None
+    backend = backend_stub.BackendStub(settings)
+    # An external stub doesn't compete with the bot for the event loop, it has to be started with the same settings
+    backend_runner = None if args.external_backend else await backend.start(args.backend_host, args.backend_port)
+
+    import fake_telegram
+    import main_bot
+
+    bot = fake_telegram.FakeBot(token=config.BOT_TOKEN, latency=args.telegram_latency / 1000)
+    main_bot.dp.bot = bot
+    Bot.set_current(bot)
+    Dispatcher.set_current(main_bot.dp)
+    await main_bot.on_startup(main_bot.dp)
+    try:
+        yield main_bot.dp, bot, backend
+    finally:
+        await main_bot.on_shutdown(main_bot.dp)
+        await main_bot.dp.storage.close()
+        if backend_runner is not None:
+            await backend_runner.cleanup()
+
+
+def environment() -> dict[str, str]:
+    return {
+        'python': platform.python_version(),
+        'aiogram': aiogram.__version__,
+        'platform': platform.platform()
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    async with running_bot(args) as (dispatcher, bot, backend):
+        benchmark = Benchmark(dispatcher, backend, args)
+        elapsed = await benchmark.run()
+
+    total = sum(len(samples) for samples in benchmark.latencies.values())
+    return {
+        'parameters': vars(args),
+        'environment': environment(),
+        'updates': total,
+        'errors': dict(benchmark.errors),
+        'elapsed_seconds': round(elapsed, 3),
+        'updates_per_second': round(total / elapsed, 1),
+        'routes': {route: summarize(samples) for route, samples in sorted(benchmark.latencies.items())},
+        'all_routes': summarize([sample for samples in benchmark.latencies.values() for sample in samples]),
+        'loop_lag': summarize(benchmark.loop_lags or [0.0]),
+        'telegram_calls': dict(sorted(bot.calls.items())),
+        'backend_requests': {f"{path} {outcome}": count for (path, outcome), count in sorted(backend.requests.items())}
+    }
+
+
+def print_report(results: dict) -> None:
+    print(f"{results['updates']} updates in {results['elapsed_seconds']} s, "
+          f"{results['updates_per_second']} updates/s, errors: {results['errors'] or 'none'}", file=sys.stderr)
+    print_latencies(list(results['routes'].items()) + [
+        ("all", results['all_routes']),
+        ("event loop lag", results['loop_lag'])
+    ])
+
+
+def print_latencies(rows: list[tuple[str, dict]]) -> None:
+    print(f"{'route':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}", file=sys.stderr)
+    for route, stats in rows:
+        print(f"{route:<20}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['max_ms']:>10}", file=sys.stderr)
+
+
+def add_environment_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="Bot API latency in milliseconds")
+    parser.add_argument("--backend-host", default="127.0.0.1")
+    parser.add_argument("--backend-port", type=int, default=8799)
+    parser.add_argument("--backend-config", help="JSON file with backend_stub.StubSettings")
+    parser.add_argument("--external-backend", action="store_true",
+                        help="use a backend_stub.py already running in another process")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--tracing", action="store_true", help="keep update tracing enabled")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep Telegram's rate limits, which otherwise make the run take minutes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Feeds synthetic updates through the bot's Dispatcher.")
+    parser.add_argument("--dialogs", type=int, default=200, help="full /bill dialogs, each ends with an admin callback")
+    parser.add_argument("--messages", type=int, default=2000, help="plain text messages")
+    parser.add_argument("--media", type=int, default=500, help="photo messages")
+    parser.add_argument("--hashtags", type=int, default=200, help="## hashtag commands")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=100, help="updates processed at the same time")
+    add_environment_arguments(parser)
+    return parser.parse_args()
+
+
+def execute(args: argparse.Namespace, scenario) -> dict:
+    with tempfile.TemporaryDirectory(prefix="bot-benchmark-") as work_dir:
+        configure(args, Path(work_dir))
+        # Some handlers print, which would end up in the middle of the JSON results
+        with contextlib.redirect_stdout(sys.stderr):
+            return asyncio.run(scenario(args))
+
+
+def write_results(results: dict, output: str | None) -> None:
+    if output:
+        Path(output).write_text(json.dumps(results, indent=2, ensure_ascii=False))
+    else:
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+
+
+def main() -> None:
+    args = parse_args()
+    results = execute(args, run)
+    print_report(results)
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
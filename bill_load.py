@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import Counter
+
+import aiohttp
+from aiogram import Dispatcher
+
+import backend_stub
+import benchmark
+import config
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class BillLoad(benchmark.Benchmark):
+    def __init__(self, dispatcher: Dispatcher, backend: backend_stub.BackendStub, args: argparse.Namespace):
+        super().__init__(dispatcher, backend, args)
+        self.outcomes: Counter[str] = Counter()
+        self.dialog_seconds: list[float] = []
+        self.memory: list[dict] = []
+        # Only set when the stub runs in another process, its orders are asked over HTTP then
+        self.stub_session: aiohttp.ClientSession | None = None
+
+    async def think(self) -> None:
+        if self.args.think_time:
+            await asyncio.sleep(self.random.expovariate(1000 / self.args.think_time))
+
+    def pick_option(self, options: list[dict]) -> dict:
+        # Zipf-like popularity, the first options are picked the most, 0 makes every option equally likely
+        weights = [1 / (rank + 1) ** self.args.option_skew for rank in range(len(options))]
+        return self.random.choices(options, weights=weights)[0]
+
+    async def bill_message_id(self, chat_id: int, user_id: int) -> int | None:
+        # The dialog is finished by the bot on backend errors, its record is gone then
+        data = await self.dispatcher.storage.get_data(chat=chat_id, user=user_id)
+        return data['state_data'].message_id if 'state_data' in data else None
+
+    async def order_count(self, user_id: int) -> int:
+        if self.stub_session is None:
+            return self.backend.orders[user_id]
+        url = f"http://{self.args.backend_host}:{self.args.backend_port}/orders/{user_id}"
+        async with self.stub_session.get(url) as response:
+            return (await response.json())['orders']
+
+    async def dialog(self, chat_id: int, user_id: int) -> str:
+        updates = self.updates
+        start = time.perf_counter()
+        if not await self.process("bill_start", updates.message(
+                chat_id, user_id, text="/bill", entities=[{'type': "bot_command", 'offset': 0, 'length': 5}]
+        )):
+            return "failed"
+
+        for number, question in enumerate(self.backend.questions, start=1):
+            if self.random.random() < self.args.abandon_rate:
+                return "abandoned"
+            await self.think()
+            message_id = await self.bill_message_id(chat_id, user_id)
+            if message_id is None:
+                return "failed"
+            match question['type']:
+                case "list":
+                    # Buttons carry the question's number, as util.answer_callback_data builds them
+                    option = self.pick_option(question['data'])
+                    update = updates.callback(chat_id, user_id, message_id, f"{number}/{option['id']}")
+                    route = "bill_list_answer"
+                case "float":
+                    update = updates.message(chat_id, user_id, text=str(self.random.randint(1, 1_000_000)))
+                    route = "bill_number_answer"
+                case _:
+                    update = updates.message(chat_id, user_id, text="Оплата по договору")
+                    route = "bill_text_answer"
+            if not await self.process(route, update):
+                return "failed"
+
+        await self.think()
+        message_id = await self.bill_message_id(chat_id, user_id)
+        if message_id is None:
+            return "failed"
+        if self.random.random() < self.args.cancel_rate:
+            return "cancelled" if await self.process("bill_cancel", updates.callback(
+                chat_id, user_id, message_id, "no"
+            )) else "failed"
+        if not await self.process("bill_confirm", updates.callback(chat_id, user_id, message_id, "yes")):
+            return "failed"
+
+        await self.think()
+        rejected = self.random.random() < self.args.reject_rate
+        answer = "reject" if rejected else self.pick_option(self.backend.bank_accounts)['id']
+        orders = await self.order_count(user_id)
+        if not await self.process("admin_callback", updates.callback(
+                config.ADMIN_CHAT_ID, user_id, 1, f"admin/{chat_id}/{user_id}/{answer}"
+        )):
+            return "failed"
+        if rejected:
+            return "rejected"
+        # The approval is handled without errors even when the bot couldn't find the dialog, only the order counts
+        if await self.order_count(user_id) == orders:
+            return "failed"
+        self.dialog_seconds.append(time.perf_counter() - start)
+        return "completed"
+
+    async def user(self, index: int, chat_id: int, user_id: int) -> None:
+        await asyncio.sleep(self.args.ramp_up * index / self.args.users)
+        for dialog in range(self.args.dialogs_per_user):
+            if dialog:
+                # The bot ignores /bill while a dialog is open, so whatever the last one left behind is cleared
+                await self.dispatcher.storage.finish(chat=chat_id, user=user_id)
+            outcome = await self.dialog(chat_id, user_id)
+            self.outcomes[outcome] += 1
+
+    def sample_memory(self, start: float) -> None:
+        storage = self.dispatcher.storage
+        records = [record for users in storage.data.values() for record in users.values()]
+        self.memory.append({
+            'seconds': round(time.perf_counter() - start, 3),
+            'fsm_records': len(records),
+            'open_dialogs': sum(1 for record in records if record['state']),
+            'fsm_pickled_bytes': sum(len(storage.dumps(record['data'])) for record in records),
+            'fsm_file_bytes': sum(
+                os.path.getsize(path) for path in (config.FSM_STORAGE_PATH, config.FSM_STORAGE_PATH + "-wal")
+                if os.path.exists(path)
+            ),
+            'rss_bytes': rss_bytes()
+        })
+
+    async def monitor_memory(self, start: float) -> None:
+        while True:
+            self.sample_memory(start)
+            await asyncio.sleep(self.args.sample_interval)
+
+    async def run(self) -> float:
+        chat_ids = [-1_000_000_000_000 - index for index in range(self.args.chats)]
+        if self.args.external_backend:
+            self.stub_session = aiohttp.ClientSession()
+        start = time.perf_counter()
+        monitors = [
+            asyncio.create_task(self.monitor_loop_lag()),
+            asyncio.create_task(self.monitor_memory(start))
+        ]
+        await asyncio.gather(*[
+            self.user(index, chat_ids[index % len(chat_ids)], 10_000 + index)
+            for index in range(self.args.users)
+        ])
+        elapsed = time.perf_counter() - start
+        for monitor in monitors:
+            monitor.cancel()
+        if self.stub_session is not None:
+            await self.stub_session.close()
+        self.sample_memory(start)
+        return elapsed
+
+
+async def run(args: argparse.Namespace) -> dict:
+    async with benchmark.running_bot(args) as (dispatcher, bot, backend):
+        load = BillLoad(dispatcher, backend, args)
+        elapsed = await load.run()
+
+    started = sum(load.outcomes.values())
+    first, last = load.memory[0], load.memory[-1]
+    return {
+        'parameters': vars(args),
+        'environment': benchmark.environment(),
+        'elapsed_seconds': round(elapsed, 3),
+        'dialogs': started,
+        'outcomes': dict(load.outcomes),
+        'completion_rate': round(load.outcomes['completed'] / started, 4) if started else 0.0,
+        'errors': dict(load.errors),
+        'steps': {route: benchmark.summarize(samples) for route, samples in sorted(load.latencies.items())},
+        'dialog_duration': benchmark.summarize(load.dialog_seconds or [0.0]),
+        'loop_lag': benchmark.summarize(load.loop_lags or [0.0]),
+        'memory': {
+            'fsm_records_growth': last['fsm_records'] - first['fsm_records'],
+            'fsm_pickled_bytes_growth': last['fsm_pickled_bytes'] - first['fsm_pickled_bytes'],
+            'rss_bytes_growth': last['rss_bytes'] - first['rss_bytes'],
+            'peak_open_dialogs': max(sample['open_dialogs'] for sample in load.memory),
+            'samples': load.memory
+        },
+        'telegram_calls': dict(sorted(bot.calls.items())),
+        'backend_requests': {f"{path} {outcome}": count for (path, outcome), count in sorted(load.backend.requests.items())}
+    }
+
+
+def print_report(results: dict) -> None:
+    memory = results['memory']
+    print(f"{results['dialogs']} dialogs in {results['elapsed_seconds']} s, "
+          f"completion rate {results['completion_rate']:.2%}, outcomes: {results['outcomes']}", file=sys.stderr)
+    print(f"FSM records +{memory['fsm_records_growth']}, pickled FSM data +{memory['fsm_pickled_bytes_growth']} bytes, "
+          f"RSS +{memory['rss_bytes_growth']} bytes, peak open dialogs {memory['peak_open_dialogs']}", file=sys.stderr)
+    benchmark.print_latencies(list(results['steps'].items()) + [
+        ("dialog", results['dialog_duration']),
+        ("event loop lag", results['loop_lag'])
+    ])
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Runs concurrent /bill dialogs through the bot's Dispatcher.")
+    parser.add_argument("--users", type=int, default=2000, help="simulated users, each in one of the chats")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--dialogs-per-user", type=int, default=1)
+    parser.add_argument("--ramp-up", type=float, default=10.0, help="seconds over which users start")
+    parser.add_argument("--think-time", type=float, default=500.0, help="mean pause between steps in milliseconds")
+    parser.add_argument("--option-skew", type=float, default=1.0, help="popularity skew of list options")
+    parser.add_argument("--abandon-rate", type=float, default=0.05, help="chance to leave the dialog at each question")
+    parser.add_argument("--cancel-rate", type=float, default=0.05, help="chance to answer 'no' at the confirmation")
+    parser.add_argument("--reject-rate", type=float, default=0.1, help="chance that the admin rejects the bill")
+    parser.add_argument("--concurrency", type=int, default=10_000, help="updates processed at the same time")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="seconds between memory samples")
+    benchmark.add_environment_arguments(parser)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    results = benchmark.execute(args, run)
+    print_report(results)
+    benchmark.write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
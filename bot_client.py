@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+import config
+import deadline
+import metrics
+import rate_limiter
+import tracing
+
+
+def chat_key(data: dict | None) -> int | str | None:
+    chat_id = None if data is None else data.get('chat_id')
+    # Some handlers pass chat ids taken from callback data as strings
+    if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+        return int(chat_id)
+    return chat_id
+
+
+class BotClient(Bot):
+    # Every Telegram Bot API call goes through request(), so it is the one place to rate limit and time them
+    async def request(self, method: str, data=None, files=None, **kwargs):
+        if method not in config.TELEGRAM_RATE_LIMITED_METHODS:
+            return await self._timed_request(method, data, files, **kwargs)
+
+        chat_id = chat_key(data)
+        lane = rate_limiter.current_lane(method)
+        for attempt in range(config.TELEGRAM_RETRY_AFTER_ATTEMPTS):
+            await self._acquire(chat_id, lane, method in config.TELEGRAM_NEW_MESSAGE_METHODS)
+            try:
+                return await self._timed_request(method, data, files, **kwargs)
+            except RetryAfter as e:
+                # Telegram didn't execute the call, it's safe to repeat once the pause is over
+                rate_limiter.telegram_limiter.retry_after(chat_id, e.timeout)
+                rate_limiter.retry_after_total.inc((method,))
+                if attempt == config.TELEGRAM_RETRY_AFTER_ATTEMPTS - 1:
+                    raise
+
+    async def _acquire(self, chat_id: int | str | None, lane: rate_limiter.Lane, new_message: bool) -> None:
+        timeout = deadline.remaining()
+        if timeout is not None and timeout <= 0:
+            raise deadline.DeadlineExceeded("Update deadline budget is spent")
+        try:
+            await rate_limiter.telegram_limiter.acquire(chat_id, lane, new_message, timeout)
+        except asyncio.TimeoutError as e:
+            raise deadline.DeadlineExceeded("Update deadline budget ran out waiting for the rate limiter") from e
+
+    async def _timed_request(self, method: str, data=None, files=None, **kwargs):
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"telegram {method}"):
+                result = await self._request_within_budget(method, data, files, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            metrics.telegram_seconds.observe((method, outcome), time.perf_counter() - start)
+
+    async def _request_within_budget(self, method: str, data=None, files=None, **kwargs):
+        # Calls made outside an update, like getUpdates, keep aiogram's timeouts unless configured here
+        if deadline.remaining() is None and method not in config.TELEGRAM_TIMEOUTS:
+            return await super().request(method, data, files, **kwargs)
+        default_timeout = config.TELEGRAM_TIMEOUTS.get(method, config.TELEGRAM_TIMEOUT_DEFAULT)
+        total = deadline.timeout(default_timeout)
+        try:
+            with self.request_timeout(total):
+                return await super().request(method, data, files, **kwargs)
+        except asyncio.TimeoutError as e:
+            if total < default_timeout:
+                raise deadline.DeadlineExceeded(f"Update deadline budget ran out waiting for {method}") from e
+            raise
@@ -1,33 +1,78 @@
+import atexit
+import gzip
 import logging
+import os
+import queue
+import shutil
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-from config import LOG_FILE_PATH
+from config import LOG_FILE_PATH, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_MAX_MESSAGE_LENGTH
+
+
+def truncate(text: str, max_length: int = LOG_MAX_MESSAGE_LENGTH) -> str:
+    if len(text) <= max_length:
+        return text
+    return f"{text[:max_length]}... [{len(text) - max_length} more characters]"
+
+
+class DeferredQueueHandler(QueueHandler):
+    # The message is built here, on the event loop, while the arguments hold what they held at the call,
+    # e.g. a StateData the dialog goes on changing. Truncating and writing it is left to the listener thread.
+    # Only records of enabled levels get here, so disabled debug calls still cost no formatting
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class TruncatingFormatter(logging.Formatter):
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = truncate(record.message)
+        return super().formatMessage(record)
+
+
+def compress_rotated(source: str, dest: str) -> None:
+    with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+        shutil.copyfileobj(source_file, dest_file)
+    os.remove(source)
 
 
 logger = logging.getLogger("BotLog")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
-formatter = logging.Formatter(
+formatter = TruncatingFormatter(
     '%(asctime)s | %(name)s |  %(levelname)s: %(message)s')
 
 stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.DEBUG)
+stream_handler.setLevel(LOG_LEVEL)
 stream_handler.setFormatter(formatter)
 
-file_handler = logging.FileHandler(filename=LOG_FILE_PATH)
-file_handler.setLevel(logging.DEBUG)
+file_handler = RotatingFileHandler(filename=LOG_FILE_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+file_handler.setLevel(LOG_LEVEL)
 file_handler.setFormatter(formatter)
+file_handler.namer = lambda name: name + ".gz"
+file_handler.rotator = compress_rotated
+
+log_queue = queue.SimpleQueue()
+queue_handler = DeferredQueueHandler(log_queue)
+listener = QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+
+logger.addHandler(queue_handler)
+listener.start()
+atexit.register(listener.stop)
+
 
-logger.addHandler(stream_handler)
-logger.addHandler(file_handler)
+def is_debug() -> bool:
+    return logger.isEnabledFor(logging.DEBUG)
 
 
-def debug(message: str) -> None:
-    logger.debug(message)
+def debug(message: str, *args) -> None:
+    logger.debug(message, *args)
 
 
-def info(message: str) -> None:
-    logger.info(message)
+def info(message: str, *args) -> None:
+    logger.info(message, *args)
 
 
-def error(message: str) -> None:
-    logger.error(message)
+def error(message: str, *args) -> None:
+    logger.error(message, *args)
@@ -1,3 +1,4 @@
+import json
 from aiogram import types
 from collections.abc import Mapping
 
@@ -41,3 +42,18 @@ class BotMessage(Mapping):
 
     def __len__(self):
         return len(self.to_dict())
+
+
+class FrozenKeyboard(types.InlineKeyboardMarkup):
+    # Shared between dialogs through the keyboard cache, so it's never changed after being built,
+    # and aiogram and the render layer get the serialized form computed once
+    def __init__(self, inline_keyboard: list[list[types.InlineKeyboardButton]]):
+        super().__init__(inline_keyboard=inline_keyboard)
+        self._python = super().to_python()
+        self._json = json.dumps(self._python)
+
+    def to_python(self) -> dict:
+        return self._python
+
+    def as_json(self) -> str:
+        return self._json
@@ -0,0 +1,129 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
+import bot_logger
+
+
+class TTLCache:
+    def __init__(self, max_size: int, ttl: float, on_evict: Callable[[Hashable, object], None] | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Called with entries dropped by expiry or size, not with the ones popped or cleared
+        self.on_evict = on_evict
+        self._data: OrderedDict[Hashable, tuple[float, object]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: Hashable, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self._evicted(key, value)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value, ttl: float | None = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            evicted_key, (_, evicted_value) = self._data.popitem(last=False)
+            self._evicted(evicted_key, evicted_value)
+
+    def _evicted(self, key: Hashable, value) -> None:
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def pop(self, key: Hashable, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def keys(self) -> list[Hashable]:
+        return list(self._data.keys())
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class SWRCache:
+    def __init__(self, max_size: int, ttl: float, stale_ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = TTLCache(max_size=max_size, ttl=ttl + stale_ttl)
+        # Concurrent misses for one key share a single fetch
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key)
+
+    async def get_or_fetch(
+            self,
+            key: Hashable,
+            fetch: Callable[[], Awaitable],
+            cacheable: Callable[[object], bool]
+    ):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            fresh_until, value = entry
+            if fresh_until <= time.monotonic() and key not in self._inflight:
+                task = asyncio.create_task(self._fetch(key, fetch, cacheable))
+                self._tasks.add(task)
+                task.add_done_callback(self._on_refreshed)
+            return value
+        self.misses += 1
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Only fetch again if the shared fetch was cancelled, not the caller
+                if not inflight.cancelled():
+                    raise
+        return await self._fetch(key, fetch, cacheable)
+
+    async def _fetch(
+            self,
+            key: Hashable,
+            fetch: Callable[[], Awaitable],
+            cacheable: Callable[[object], bool]
+    ):
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await fetch()
+            if cacheable(value):
+                self._entries.set(key, (time.monotonic() + self.ttl, value))
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting on the shared future, mark the exception as retrieved
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            # Cancelled, or stopped by anything else, the callers sharing this fetch must not wait forever
+            if not future.done():
+                future.cancel()
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def _on_refreshed(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            bot_logger.error(f"Background cache refresh failed: {repr(task.exception())}.")
@@ -1,10 +1,14 @@
+import asyncio
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 import json
 
+import balances
 import bot_logger
 import config
 import message_handlers
+import prefetch
+import render
 import requests_to_server
 import util
 
@@ -12,11 +16,12 @@ import util
 async def any_answer_callback_handler(callback_query: types.CallbackQuery, state: FSMContext) -> None:
     state_data = await util.get_state_data(state)
 
-    bot_logger.debug(f"Received callback query: {callback_query.data=}, {state_data=}")
+    bot_logger.debug("Received callback query: callback_query.data=%r, state_data=%r", callback_query.data, state_data)
 
     if callback_query.from_user.id != state_data.user_id:
-        bot_logger.debug(f"User's id doesn't match user_id saved in state_data: "
-                         f"{callback_query.from_user.id=} {state_data.user_id=}")
+        bot_logger.debug("User's id doesn't match user_id saved in state_data: "
+                         "callback_query.from_user.id=%r state_data.user_id=%r",
+                         callback_query.from_user.id, state_data.user_id)
 
         await callback_query.answer(
             text="Вы не можете отвечать на это сообщение, так как другой пользователь вызвал команду /bill.",
@@ -25,8 +30,9 @@ async def any_answer_callback_handler(callback_query: types.CallbackQuery, state
         return
 
     if callback_query.message.chat.id != state_data.chat_id:
-        bot_logger.debug(f"Chat's id doesn't match chat_id saved in state_data: "
-                         f"{callback_query.message.chat.id=} {state_data.chat_id=}")
+        bot_logger.debug("Chat's id doesn't match chat_id saved in state_data: "
+                         "callback_query.message.chat.id=%r state_data.chat_id=%r",
+                         callback_query.message.chat.id, state_data.chat_id)
 
         await callback_query.answer(
             text="Вы не можете отвечать на это сообщение, так как вызвали команду /bill в другом чате.",
@@ -35,8 +41,9 @@ async def any_answer_callback_handler(callback_query: types.CallbackQuery, state
         return
 
     if callback_query.message.message_id != state_data.message_id:
-        bot_logger.debug(f"Message's id doesn't match message_id saved in state_data: "
-                         f"{callback_query.message.message_id=} {state_data.message_id=}")
+        bot_logger.debug("Message's id doesn't match message_id saved in state_data: "
+                         "callback_query.message.message_id=%r state_data.message_id=%r",
+                         callback_query.message.message_id, state_data.message_id)
 
         await callback_query.answer(
             text="Вы не можете отвечать на это сообщение, так как это другое сообщение в ответ на /bill.",
@@ -45,50 +52,61 @@ async def any_answer_callback_handler(callback_query: types.CallbackQuery, state
         return
 
     # callback_data = util.get_callback_data(callback_query.data)
-    callback_data = callback_query.data
+    current_question, callback_data = util.parse_answer_callback_data(callback_query.data)
 
-    state_data.previous_answers.append(util.PreviousAnswer(
-        name=state_data.question_name,
-        value=callback_data
-    ))
-    state_data.current_question += 1
-    # print(state_data.answers_data)
-    for answer_data in state_data.answers_data:
-        # print(answer_data)
-        if answer_data['id'] == int(callback_data):
-            text = " ".join([str(answer_data[item]) for item in answer_data.keys() if item != 'id'])
-            state_data.answers_dict[state_data.question_name_ru] = text
+    answer_data = next(
+        (answer_data for answer_data in state_data.answers_data if str(answer_data['id']) == callback_data),
+        None
+    ) if current_question in (None, state_data.current_question) else None
+    if answer_data is None:
+        bot_logger.debug("Callback data isn't one of the current question's answers, the button is stale: "
+                         "callback_query.data=%r state_data.current_question=%r",
+                         callback_query.data, state_data.current_question)
+
+        await callback_query.answer(
+            text="Этот вариант ответа относится к предыдущему вопросу.",
+            show_alert=True
+        )
+        return
 
-    bot_logger.debug(f"{state_data=}")
+    prefetch.question_prefetcher.on_answer(
+        chat_id=state_data.chat_id,
+        user_id=state_data.user_id,
+        question_name=state_data.question_name,
+        value=callback_data
+    )
 
-    await callback_query.message.edit_reply_markup()
+    text = " ".join([str(answer_data[item]) for item in answer_data.keys() if item != 'id'])
 
-    await util.update_state_data(state, state_data)
+    await render.edit_message_reply_markup(
+        callback_query.bot,
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id
+    )
 
     await callback_query.answer(
         text=f"Ответ принят"
     )
 
-    if not state_data.last_question:
-        await message_handlers.new_question_routine(
-            message=callback_query.message,
-            state=state
-        )
-    else:
-        await message_handlers.confirm_answers_routine(
-            message=callback_query.message,
-            state=state
-        )
+    await message_handlers.next_step_routine(
+        message=callback_query.message,
+        state=state,
+        state_data=state_data,
+        value=callback_data,
+        text=text
+    )
 
 
 async def skip_callback_handler(callback_query: types.CallbackQuery, state: FSMContext) -> None:
     state_data = await util.get_state_data(state)
 
-    bot_logger.debug(f"Received skip callback query: {callback_query.data=}, {state_data=}")
+    bot_logger.debug("Received skip callback query: callback_query.data=%r, state_data=%r",
+                     callback_query.data, state_data)
 
     if callback_query.from_user.id != state_data.user_id:
-        bot_logger.debug(f"User's id doesn't match user_id saved in state_data: "
-                         f"{callback_query.from_user.id=} {state_data.user_id=}")
+        bot_logger.debug("User's id doesn't match user_id saved in state_data: "
+                         "callback_query.from_user.id=%r state_data.user_id=%r",
+                         callback_query.from_user.id, state_data.user_id)
 
         await callback_query.answer(
             text="Вы не можете отвечать на это сообщение, так как другой пользователь вызвал команду /bill.",
@@ -97,8 +115,9 @@ async def skip_callback_handler(callback_query: types.CallbackQuery, state: FSMC
         return
 
     if callback_query.message.chat.id != state_data.chat_id:
-        bot_logger.debug(f"Chat's id doesn't match chat_id saved in state_data: "
-                         f"{callback_query.message.chat.id=} {state_data.chat_id=}")
+        bot_logger.debug("Chat's id doesn't match chat_id saved in state_data: "
+                         "callback_query.message.chat.id=%r state_data.chat_id=%r",
+                         callback_query.message.chat.id, state_data.chat_id)
 
         await callback_query.answer(
             text="Вы не можете отвечать на это сообщение, так как вызвали команду /bill в другом чате.",
@@ -107,8 +126,9 @@ async def skip_callback_handler(callback_query: types.CallbackQuery, state: FSMC
         return
 
     if callback_query.message.message_id != state_data.message_id:
-        bot_logger.debug(f"Message's id doesn't match message_id saved in state_data: "
-                         f"{callback_query.message.message_id=} {state_data.message_id=}")
+        bot_logger.debug("Message's id doesn't match message_id saved in state_data: "
+                         "callback_query.message.message_id=%r state_data.message_id=%r",
+                         callback_query.message.message_id, state_data.message_id)
 
         await callback_query.answer(
             text="Вы не можете отвечать на это сообщение, так как это другое сообщение в ответ на /bill.",
@@ -118,45 +138,50 @@ async def skip_callback_handler(callback_query: types.CallbackQuery, state: FSMC
 
     # callback_data = util.get_callback_data(callback_query.data)
     # callback_data = callback_query.data
+    current_question, _ = util.parse_answer_callback_data(callback_query.data)
+    if current_question not in (None, state_data.current_question):
+        bot_logger.debug("Skip button of another question: callback_query.data=%r state_data.current_question=%r",
+                         callback_query.data, state_data.current_question)
 
-    state_data.previous_answers.append(util.PreviousAnswer(
-        name=state_data.question_name,
-        value="---"
-    ))
-    state_data.current_question += 1
-    # print(state_data.answers_data)
-    state_data.answers_dict[state_data.question_name_ru] = "---"
-
-    bot_logger.debug(f"{state_data=}")
+        await callback_query.answer(
+            text="Этот вариант ответа относится к предыдущему вопросу.",
+            show_alert=True
+        )
+        return
 
-    await callback_query.message.edit_reply_markup()
+    prefetch.question_prefetcher.cancel(
+        chat_id=state_data.chat_id,
+        user_id=state_data.user_id
+    )
 
-    await util.update_state_data(state, state_data)
+    await render.edit_message_reply_markup(
+        callback_query.bot,
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id
+    )
 
     await callback_query.answer(
         text=f"Ответ принят"
     )
 
-    if not state_data.last_question:
-        await message_handlers.new_question_routine(
-            message=callback_query.message,
-            state=state
-        )
-    else:
-        await message_handlers.confirm_answers_routine(
-            message=callback_query.message,
-            state=state
-        )
+    await message_handlers.next_step_routine(
+        message=callback_query.message,
+        state=state,
+        state_data=state_data,
+        value="---",
+        text="---"
+    )
 
 
 async def last_step_callback_handler(callback_query: types.CallbackQuery, state: FSMContext) -> None:
     state_data = await util.get_state_data(state)
 
-    bot_logger.debug(f"Received callback query: {callback_query.data=}, {state_data=}")
+    bot_logger.debug("Received callback query: callback_query.data=%r, state_data=%r", callback_query.data, state_data)
 
     if callback_query.from_user.id != state_data.user_id:
-        bot_logger.debug(f"User's id doesn't match user_id saved in state_data: "
-                         f"{callback_query.from_user.id=} {state_data.user_id=}")
+        bot_logger.debug("User's id doesn't match user_id saved in state_data: "
+                         "callback_query.from_user.id=%r state_data.user_id=%r",
+                         callback_query.from_user.id, state_data.user_id)
 
         await callback_query.answer(
             text="Вы не можете отвечать на это сообщение, так как другой пользователь вызвал команду /bill.",
@@ -175,8 +200,9 @@ async def last_step_callback_handler(callback_query: types.CallbackQuery, state:
     #     return
 
     if callback_query.message.message_id != state_data.message_id:
-        bot_logger.debug(f"Message's id doesn't match message_id saved in state_data: "
-                         f"{callback_query.message.message_id=} {state_data.message_id=}")
+        bot_logger.debug("Message's id doesn't match message_id saved in state_data: "
+                         "callback_query.message.message_id=%r state_data.message_id=%r",
+                         callback_query.message.message_id, state_data.message_id)
 
         await callback_query.answer(
             text="Вы не можете отвечать на это сообщение, так как это другое сообщение в ответ на /bill.",
@@ -195,47 +221,47 @@ async def last_step_callback_handler(callback_query: types.CallbackQuery, state:
             await state.finish()
             return
         case "yes":
-            response = requests_to_server.request_admin_question(
-                data={
-                    'chat_id': callback_query.message.chat.id,
-                    'user_id': callback_query.from_user.id
-                },
-                previous_answers=json.dumps([
-                    {
-                        'name': previous_answer.name,
-                        'value': previous_answer.value
-                    }
-                    for previous_answer in state_data.previous_answers
-                ]),
-                current_question=state_data.current_question,
-                from_user_id=callback_query.from_user.id
-            )
-            balances_response = requests_to_server.request_balances(
-                data={
-                    'chat_id': callback_query.message.chat.id,
-                    'user_id': callback_query.from_user.id
-                },
-                from_user_id=callback_query.from_user.id
+            response, balances_data = await asyncio.gather(
+                requests_to_server.request_admin_question(
+                    data={
+                        'chat_id': callback_query.message.chat.id,
+                        'user_id': callback_query.from_user.id
+                    },
+                    previous_answers=json.dumps([
+                        {
+                            'name': previous_answer.name,
+                            'value': previous_answer.value
+                        }
+                        for previous_answer in state_data.previous_answers
+                    ]),
+                    current_question=state_data.current_question,
+                    from_user_id=callback_query.from_user.id
+                ),
+                balances.balance_cache.get_or_refresh(callback_query.message.chat.id, callback_query.from_user.id)
             )
-            bot_logger.debug(f"{balances_response.json()=}")
+            bot_logger.debug("balances_data=%r", balances_data)
 
             admin_data = response.json()['data']['data']
 
-            for balance_data in balances_response.json()['data']:
-                bill = balance_data['bill']
-                for idx in range(len(admin_data)):
-                    if admin_data[idx]['bill'] == bill:
-                        admin_data[idx]['current_sum'] = balance_data['current_sum']
-
-            state_data.answers_data = admin_data
-
-            bot_logger.debug(f"{state_data=}")
+            admin_data_by_bill = {}
+            for item in admin_data:
+                admin_data_by_bill.setdefault(item['bill'], []).append(item)
+            for balance_data in balances_data:
+                for item in admin_data_by_bill.get(balance_data['bill'], []):
+                    item['current_sum'] = balance_data['current_sum']
+
+            state_data = await util.transition(
+                state,
+                state_data,
+                answers_data=tuple(admin_data)
+            )
 
-            await util.update_state_data(state, state_data)
+            bot_logger.debug("state_data=%r", state_data)
 
-            bot_logger.debug(f"{response.text=}")
+            bot_logger.debug("response.text=%r", response.text)
             bot_msg = await util.construct_message_to_admin_chat(
                 message=callback_query.message,
+                user_id=callback_query.from_user.id,
                 answers_dict=state_data.answers_dict,
                 answers_data=admin_data
             )
@@ -249,8 +275,11 @@ async def last_step_callback_handler(callback_query: types.CallbackQuery, state:
                 text="Запрос на подтверждение платежа был отправлен администратору.",
                 show_alert=True
             )
-            await callback_query.message.edit_text(
-                text=callback_query.message.text + "\n\nОжидайте ответа от администрации."
+            await render.edit_message_text(
+                callback_query.bot,
+                text=callback_query.message.text + "\n\nОжидайте ответа от администрации.",
+                chat_id=callback_query.message.chat.id,
+                message_id=callback_query.message.message_id
             )
 
 
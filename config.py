@@ -1,5 +1,10 @@
 # Logging
 LOG_FILE_PATH = "bot.log"
+LOG_LEVEL = "DEBUG"
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Longer messages and arguments are cut, so whole response bodies don't end up in the log
+LOG_MAX_MESSAGE_LENGTH = 2000
 
 # Telegram Bot API
 BOT_TOKEN = "0123456789:qwertyuiopasdfghjklzxcvbnmQWERTYUIO"
@@ -7,8 +12,28 @@ BOT_ID = 1234567890
 HOME_CHAT_ID = -123456789
 ADMIN_CHAT_ID = -123456780
 
+# Webhook mode, polling is used when disabled
+WEBHOOK_ENABLED = False
+WEBHOOK_HOST = "https://example.com"
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET_TOKEN = ""
+WEBHOOK_MAX_CONCURRENT_UPDATES = 40
+WEBAPP_HOST = "127.0.0.1"
+WEBAPP_PORT = 8080
+
+# Update scheduling: updates of one chat are processed in order on one of UPDATE_SHARDS workers,
+# different chats in parallel. At most UPDATE_MAX_IN_FLIGHT updates are accepted and not yet processed
+UPDATE_SHARDS = 32
+UPDATE_MAX_IN_FLIGHT = 1000
+
+# FSM storage, changes are written to disk at most FSM_FLUSH_DELAY seconds later
+FSM_STORAGE_PATH = "fsm.sqlite3"
+FSM_FLUSH_DELAY = 1.0
+FSM_FLUSH_MAX_PENDING = 500
+
 # Requests to server
 WEB_URL_MESSAGE = "http://example.com/telegram/message/add"
+WEB_URL_MESSAGE_BULK = "http://example.com/telegram/message/add_bulk"
 WEB_URL_COMMAND = "http://example.com/telegram/command/add"
 WEB_URL_IS_ADMIN = "http://example.com/telegram/is_admin"
 WEB_URL_BILL_FORM = "http://example.com/question"
@@ -18,5 +43,142 @@ WEB_URL_ORDER = "http://example.com/order"
 WEB_URL_ADMIN_QUESTION = "http://example.com/bank_acoounts/"
 WEB_URL_BALANCES = "http://example.com/bank_account/current_balances"
 
+# Connection pool per backend host
+WEB_POOL_SIZE = 20
+WEB_POOL_KEEPALIVE = 30
+
+# Timeouts in seconds, per endpoint path
+WEB_CONNECT_TIMEOUT = 3
+WEB_TIMEOUT_DEFAULT = 10
+WEB_TIMEOUTS = {
+    "/telegram/message/add": 5,
+    "/telegram/message/add_bulk": 10,
+    "/telegram/command/add": 5,
+    "/telegram/is_admin": 5,
+    "/question": 10,
+    "/message/delete": 5,
+    "/bill/is_access": 5,
+    "/order": 30,
+    "/bank_acoounts/": 10,
+    "/bank_account/current_balances": 10,
+}
+
+# Retries with jittered exponential backoff, only for endpoints that are safe to call twice.
+# Message and command ingestion is retried by the outbound spool instead, /order creates a bill
+WEB_RETRY_ATTEMPTS = 3
+WEB_RETRY_BASE_DELAY = 0.2
+WEB_RETRY_MAX_DELAY = 2.0
+WEB_RETRY_ENDPOINTS = {
+    "/question",
+    "/message/delete",
+    "/bill/is_access",
+    "/bank_acoounts/",
+    "/bank_account/current_balances",
+}
+
+# Circuit breaker per endpoint path, opened after WEB_BREAKER_FAILURE_THRESHOLD failures in a row
+# and probed again with a single request after WEB_BREAKER_RECOVERY_TIMEOUT seconds
+WEB_BREAKER_FAILURE_THRESHOLD = 5
+WEB_BREAKER_RECOVERY_TIMEOUT = 30
+
+# Deadline budget per update in seconds, shared by its backend and Telegram calls; None disables it.
+# Backend calls leave UPDATE_TELEGRAM_RESERVE of it for answering the user, after the deadline the
+# fallback error message gets UPDATE_DEADLINE_GRACE more before the update is cancelled
+UPDATE_DEADLINE = 45
+UPDATE_TELEGRAM_RESERVE = 5
+UPDATE_DEADLINE_GRACE = 5
+
+# Telegram Bot API timeouts in seconds, per method
+TELEGRAM_TIMEOUT_DEFAULT = 10
+TELEGRAM_TIMEOUTS = {
+    "sendDocument": 30,
+}
+
+# Outbound Telegram rate limits in calls per second with bursts, per bot and per chat, groups being stricter.
+# Flood control answers are waited out and retried up to TELEGRAM_RETRY_AFTER_ATTEMPTS times
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_GLOBAL_BURST = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_GROUP_RATE = 20 / 60
+TELEGRAM_GROUP_BURST = 20
+TELEGRAM_RETRY_AFTER_ATTEMPTS = 3
+TELEGRAM_RATE_LIMITED_METHODS = {
+    "sendMessage",
+    "sendDocument",
+    "editMessageText",
+    "editMessageReplyMarkup",
+    "deleteMessage",
+    "answerCallbackQuery",
+}
+# The calls that post a message, only these count against a group's limit
+TELEGRAM_NEW_MESSAGE_METHODS = {
+    "sendMessage",
+    "sendDocument",
+}
+
+# Last text and markup sent per dialog message, used to merge and skip edits
+RENDER_CACHE_SIZE = 10000
+
+# Batched message ingestion, flushed on whichever threshold is hit first
+INGESTION_BATCH_SIZE = 200
+INGESTION_BATCH_DELAY = 0.25
+
+# Outbound spool for addMessage/addCommand requests
+SPOOL_PATH = "spool.sqlite3"
+SPOOL_CONCURRENCY = 8
+SPOOL_RETRY_DELAY = 5
+SPOOL_RETRY_MAX_DELAY = 5 * 60
+# Only definitive rejections by the backend count, entries stay queued through outages
+SPOOL_MAX_ATTEMPTS = 5
+SPOOL_RETENTION = 24 * 60 * 60
+SPOOL_PRUNE_INTERVAL = 10 * 60
+SPOOL_RATE_WINDOW = 60
+SPOOL_SHUTDOWN_TIMEOUT = 10
+
+# Telegram file URL resolution
+FILES_CACHE_SIZE = 10000
+FILES_CACHE_TTL = 55 * 60
+FILES_PHOTO_LARGEST_ONLY = False
+
+# /bill question responses, served stale for up to QUESTION_CACHE_STALE_TTL while being refreshed
+QUESTION_CACHE_SIZE = 10000
+QUESTION_CACHE_TTL = 60
+QUESTION_CACHE_STALE_TTL = 300
+QUESTION_CACHE_OPT_OUT_FLAG = "no_cache"
+
+# Pre-built /bill keyboards, keyed by the data they're built from
+KEYBOARD_CACHE_SIZE = 1000
+KEYBOARD_CACHE_TTL = 24 * 60 * 60
+
+# Speculative prefetch of the next /bill question for the most picked list options
+PREFETCH_ENABLED = False
+PREFETCH_MAX_PER_DIALOG = 3
+PREFETCH_MAX_DIALOGS = 10000
+PREFETCH_TTL = 10 * 60
+
+# Bank balance snapshots shown in approval requests, one per user and chat asking for them
+BALANCES_REFRESH_INTERVAL = 60
+BALANCES_IDLE_TTL = 10 * 60
+
+# /bill access decisions
+ACCESS_CACHE_SIZE = 10000
+ACCESS_CACHE_GRANTED_TTL = 10 * 60
+ACCESS_CACHE_DENIED_TTL = 60
+
+# Prometheus metrics, served locally
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_PATH = "/metrics"
+
+# Per-update traces, slow ones are always written, the rest with TRACE_SAMPLE_RATE probability
+TRACE_ENABLED = True
+TRACE_FILE_PATH = "traces.jsonl"
+TRACE_MAX_BYTES = 50 * 1024 * 1024
+TRACE_BACKUP_COUNT = 3
+TRACE_SAMPLE_RATE = 0.05
+TRACE_SLOW_THRESHOLD = 1.0
+
 # Proxy
 PROXY_URL = "http://85.26.146.169:80"
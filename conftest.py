@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+import socket
+import tempfile
+from pathlib import Path
+
+import pytest
+
+import backend_stub
+import benchmark
+import config
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# The bot's modules read their paths and the backend's address on import, so this runs before any test imports them
+_work_dir = tempfile.TemporaryDirectory()
+BACKEND = argparse.Namespace(
+    backend_host="127.0.0.1", backend_port=free_port(), log_level="INFO", tracing=False, rate_limits=False
+)
+benchmark.configure(BACKEND, Path(_work_dir.name))
+
+
+@pytest.fixture(scope="session")
+def loop():
+    # The bot's singletons hold asyncio primitives and sessions, so every test shares one event loop
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def backend(loop):
+    backend = backend_stub.BackendStub()
+    runner = loop.run_until_complete(backend.start(BACKEND.backend_host, BACKEND.backend_port))
+    yield backend
+    loop.run_until_complete(runner.cleanup())
+
+
+@pytest.fixture(scope="session")
+def running_bot(loop, backend):
+    import fake_telegram
+    import main_bot
+
+    bot = fake_telegram.FakeBot(token=config.BOT_TOKEN)
+    main_bot.dp.bot = bot
+    # Started the way the webhook starts it, without a current bot or dispatcher
+    loop.run_until_complete(main_bot.on_startup(main_bot.dp))
+    yield main_bot.dp, bot
+    loop.run_until_complete(main_bot.on_shutdown(main_bot.dp))
+    loop.run_until_complete(main_bot.dp.storage.close())
+
+
+@pytest.fixture
+def process(loop, running_bot):
+    # Feeds updates through the scheduler, the way polling and the webhook do, and waits until they're handled
+    dispatcher, _ = running_bot
+
+    async def run(updates: list) -> None:
+        await dispatcher.process_updates(updates)
+        for queue in dispatcher.scheduler.queues:
+            await asyncio.wait_for(queue.join(), 10)
+
+    return lambda *updates: loop.run_until_complete(run(list(updates)))
@@ -0,0 +1,88 @@
+import asyncio
+from contextvars import ContextVar
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import bot_logger
+import metrics
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+class Budget:
+    __slots__ = ("deadline", "hard_deadline", "handle")
+
+    def __init__(self, deadline: float, hard_deadline: float, handle: asyncio.TimerHandle | None):
+        self.deadline = deadline
+        # The fallback error messages are sent between deadline and hard_deadline, the update is cancelled after it
+        self.hard_deadline = hard_deadline
+        self.handle = handle
+
+
+_current_budget: ContextVar[Budget | None] = ContextVar("current_budget", default=None)
+
+expired_updates = metrics.Counter(
+    "bot_update_deadline_exceeded_total", "Updates that ran out of their deadline budget.", ("outcome",)
+)
+
+
+def _cancel(task: asyncio.Task, seconds: float) -> None:
+    bot_logger.error(f"Update is still processed after {seconds:g} s, cancelling it.")
+    expired_updates.inc(("cancelled",))
+    task.cancel()
+
+
+def start(seconds: float, grace: float) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + seconds
+    task = asyncio.current_task()
+    handle = None if task is None else loop.call_at(deadline + grace, _cancel, task, seconds + grace)
+    _current_budget.set(Budget(deadline, deadline + grace, handle))
+
+
+def finish() -> None:
+    budget = _current_budget.get()
+    if budget is None:
+        return
+    _current_budget.set(None)
+    if budget.handle is not None:
+        budget.handle.cancel()
+
+
+def enter_grace() -> None:
+    budget = _current_budget.get()
+    if budget is not None:
+        budget.deadline = budget.hard_deadline
+
+
+def remaining() -> float | None:
+    budget = _current_budget.get()
+    return None if budget is None else budget.deadline - asyncio.get_running_loop().time()
+
+
+def timeout(default: float, reserve: float = 0.0) -> float:
+    # A call gets its own timeout or what's left of the update's budget, whichever is shorter.
+    # reserve keeps time for the calls that have to follow, e.g. answering the user after a backend call
+    left = remaining()
+    if left is None:
+        return default
+    left -= reserve
+    if left <= 0:
+        raise DeadlineExceeded("Update deadline budget is spent")
+    return min(default, left)
+
+
+class DeadlineMiddleware(BaseMiddleware):
+    def __init__(self, seconds: float, grace: float):
+        super().__init__()
+        self.seconds = seconds
+        self.grace = grace
+
+    async def on_pre_process_update(self, update: types.Update, data: dict) -> None:
+        start(self.seconds, self.grace)
+
+    async def on_post_process_update(self, update: types.Update, result: list, data: dict) -> None:
+        finish()
@@ -0,0 +1,45 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+import bot_client
+
+
+class FakeBot(bot_client.BotClient):
+    # Answers Bot API calls in-process, so only the bot's own work is measured.
+    # The rate limiter, tracing and timing of BotClient still run, only the HTTP call to Telegram is replaced
+    def __init__(self, token: str, latency: float = 0.0):
+        super().__init__(token=token)
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    async def _request_within_budget(self, method: str, data=None, files=None, **kwargs):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = data or {}
+        match method:
+            case "sendMessage" | "sendDocument" | "editMessageText":
+                message = {
+                    'message_id': int(data['message_id']) if 'message_id' in data else next(self._message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': int(data['chat_id']), 'type': "group", 'title': "Benchmark"},
+                    'text': data.get('text', "")
+                }
+                # Telegram echoes the keyboard, render compares later edits against it
+                if data.get('reply_markup'):
+                    message['reply_markup'] = json.loads(data['reply_markup'])
+                return message
+            case "getFile":
+                return {
+                    'file_id': data['file_id'],
+                    'file_unique_id': data['file_id'],
+                    'file_path': f"photos/{data['file_id']}.jpg"
+                }
+            case "getChatAdministrators":
+                return [{'user': {'id': 1, 'is_bot': False, 'first_name': "Admin"}, 'status': "creator"}]
+            case _:
+                return True
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import bot_logger
+import config
+import deadline
+import metrics
+import resilience
+import tracing
+
+
+class ResponseStatusError(aiohttp.ClientError):
+    def __init__(self, response: "ServerResponse"):
+        super().__init__(f"{response.status_code} for url {response.url}")
+        self.response = response
+
+
+class ServerResponse:
+    def __init__(self, url: str, status_code: int, text: str):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self._json = None
+
+    def json(self):
+        if self._json is None:
+            self._json = json.loads(self.text)
+        return self._json
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise ResponseStatusError(self)
+
+
+# One keep-alive connection pool per backend host
+_sessions: dict[str, aiohttp.ClientSession] = {}
+
+
+def endpoint(url: str) -> str:
+    return urlsplit(url).path
+
+
+def get_timeout(url: str) -> float:
+    return config.WEB_TIMEOUTS.get(endpoint(url), config.WEB_TIMEOUT_DEFAULT)
+
+
+def get_session(url: str) -> aiohttp.ClientSession:
+    parts = urlsplit(url)
+    host = f"{parts.scheme}://{parts.netloc}"
+    session = _sessions.get(host)
+    if session is None or session.closed:
+        bot_logger.debug("Opening a connection pool to %s.", host)
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=config.WEB_POOL_SIZE,
+                keepalive_timeout=config.WEB_POOL_KEEPALIVE
+            )
+        )
+        _sessions[host] = session
+    return session
+
+
+async def _send(
+        method: str,
+        url: str,
+        data: dict | None = None,
+        params: dict | None = None,
+        json_body=None
+) -> ServerResponse:
+    session = get_session(url)
+    path = endpoint(url)
+    correlation_id = tracing.correlation_id()
+    default_timeout = get_timeout(url)
+    total = deadline.timeout(default_timeout, reserve=config.UPDATE_TELEGRAM_RESERVE)
+    status = "error"
+    start = time.perf_counter()
+    try:
+        with tracing.span(f"backend {method} {path}"):
+            async with session.request(
+                    method=method,
+                    url=url,
+                    data=data,
+                    params=params,
+                    json=json_body,
+                    headers={tracing.CORRELATION_HEADER: correlation_id} if correlation_id else None,
+                    # connect would also count the wait for a free pooled connection, which only total should bound
+                    timeout=aiohttp.ClientTimeout(total=total, sock_connect=min(config.WEB_CONNECT_TIMEOUT, total))
+            ) as response:
+                text = await response.text()
+                status = response.status
+                return ServerResponse(
+                    url=str(response.url),
+                    status_code=response.status,
+                    text=text
+                )
+    except asyncio.TimeoutError as e:
+        status = "timeout"
+        if total < default_timeout:
+            raise deadline.DeadlineExceeded(f"Update deadline budget ran out waiting for {path}") from e
+        raise
+    finally:
+        metrics.backend_seconds.observe((path, method, status), time.perf_counter() - start)
+
+
+def retry_delay(attempt: int, attempts: int, breaker: resilience.CircuitBreaker) -> float | None:
+    # None when the caller should get the failure as is: no attempts left, the breaker opened
+    # or the update's budget can't cover the pause
+    if attempt == attempts - 1 or breaker.state is resilience.CircuitState.open:
+        return None
+    delay = resilience.backoff(attempt)
+    left = deadline.remaining()
+    if left is not None and delay >= left - config.UPDATE_TELEGRAM_RESERVE:
+        return None
+    return delay
+
+
+async def request(
+        method: str,
+        url: str,
+        data: dict | None = None,
+        params: dict | None = None,
+        json_body=None
+) -> ServerResponse:
+    path = endpoint(url)
+    breaker = resilience.get_breaker(path)
+    attempts = config.WEB_RETRY_ATTEMPTS if path in config.WEB_RETRY_ENDPOINTS else 1
+    for attempt in range(attempts):
+        breaker.allow()
+        try:
+            response = await _send(method, url, data, params, json_body)
+        except deadline.DeadlineExceeded:
+            # The update ran out of time, that says nothing about the endpoint's health
+            breaker.release()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            breaker.record_failure()
+            delay = retry_delay(attempt, attempts, breaker)
+            if delay is None:
+                raise
+            bot_logger.debug("Retrying %s %s after %s.", method, path, repr(e))
+        except BaseException:
+            # Cancelled, or failed in the bot itself, e.g. decoding the answer. The half-open probe mustn't stay taken
+            breaker.release()
+            raise
+        else:
+            # 4xx answers are the caller's problem, only server errors count against the endpoint
+            if response.status_code < 500:
+                breaker.record_success()
+                return response
+            breaker.record_failure()
+            delay = retry_delay(attempt, attempts, breaker)
+            if delay is None:
+                return response
+            bot_logger.debug("Retrying %s %s after status %s.", method, path, response.status_code)
+        metrics.backend_retries.inc((path,))
+        await asyncio.sleep(delay)
+
+
+async def close() -> None:
+    for host, session in list(_sessions.items()):
+        bot_logger.debug("Closing the connection pool to %s.", host)
+        await session.close()
+    _sessions.clear()
@@ -0,0 +1,208 @@
+import asyncio
+import json
+import time
+from itertools import groupby
+
+from aiogram import Bot
+
+import bot_logger
+import config
+import http_client
+import rate_limiter
+import requests_to_server
+import spool
+
+
+class EntryRejected(Exception):
+    def __init__(self, response: http_client.ServerResponse):
+        super().__init__(f"Backend refused the entry: {response.text}")
+        self.response = response
+
+
+def check_accepted(response: http_client.ServerResponse) -> None:
+    if response.json().get('error'):
+        raise EntryRejected(response)
+
+
+def is_rejection(error: Exception) -> bool:
+    # Only a definitive answer counts against an entry. Outages, timeouts and an open breaker say nothing about it
+    if isinstance(error, http_client.ResponseStatusError):
+        return error.response.status_code < 500
+    return isinstance(error, EntryRejected)
+
+
+class SpoolDrainer:
+    def __init__(
+            self,
+            outbound_spool: spool.Spool,
+            batch_size: int,
+            max_delay: float,
+            concurrency: int,
+            retry_delay: float,
+            max_retry_delay: float,
+            max_attempts: int,
+            prune_interval: float
+    ):
+        self.spool = outbound_spool
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.prune_interval = prune_interval
+        self._failed_drains = 0
+        self._pruned_at = 0.0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._appended = 0
+        self._closing = False
+        self._task: asyncio.Task | None = None
+        self._bot: Bot | None = None
+        self.spool.add_listener(self._on_append)
+
+    def _on_append(self) -> None:
+        self._appended += 1
+        if self._appended >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self, bot: Bot) -> None:
+        self._bot = bot
+        self.spool.open()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        bot_logger.info(f"Spool drainer started, {self.spool.stats()}.")
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if await self.drain():
+                self._failed_drains = 0
+            else:
+                # Backs off while the backend is down, so an outage isn't met with a request every few seconds
+                self._failed_drains += 1
+                await asyncio.sleep(min(self.max_retry_delay, self.retry_delay * 2 ** (self._failed_drains - 1)))
+            # Delivered rows only have to go eventually, not on every drain, each prune scans the table
+            if time.monotonic() - self._pruned_at >= self.prune_interval:
+                self.spool.prune(config.SPOOL_RETENTION)
+                self._pruned_at = time.monotonic()
+
+    async def drain(self) -> bool:
+        while True:
+            self._appended = 0
+            entries = self.spool.pending(self.batch_size)
+            if not entries:
+                return True
+            # Runs of messages go out as one bulk request each, in spool order, split only where the endpoint changes
+            for bulk, run in groupby(entries, key=lambda entry: entry.url == config.WEB_URL_MESSAGE):
+                run = list(run)
+                if not await (self._deliver_bulk(run) if bulk else self._deliver_singles(run)):
+                    bot_logger.error(f"Spool drain stopped, {self.spool.stats()}.")
+                    return False
+            if len(entries) < self.batch_size:
+                return True
+
+    async def _deliver_singles(self, entries: list[spool.SpoolEntry]) -> bool:
+        # Chats are delivered concurrently, each chat's entries strictly in spool order
+        by_chat: dict[int | None, list[spool.SpoolEntry]] = {}
+        for entry in entries:
+            by_chat.setdefault(entry.chat_id, []).append(entry)
+        return all(await asyncio.gather(*[
+            self._deliver_chat(chat_entries)
+            for chat_entries in by_chat.values()
+        ]))
+
+    async def _deliver_chat(self, entries: list[spool.SpoolEntry]) -> bool:
+        async with self._semaphore:
+            for entry in entries:
+                try:
+                    response = await self._deliver_single(entry)
+                except Exception as e:
+                    self._fail([entry], e)
+                    return False
+                # Acknowledged as soon as the backend has it, a failed reply must not deliver it again
+                self.spool.ack([entry.id])
+                if entry.reply_chat_id is not None:
+                    await self._reply(entry, response)
+        return True
+
+    def _fail(self, entries: list[spool.SpoolEntry], error: Exception) -> None:
+        if not is_rejection(error):
+            bot_logger.error(f"Backend unavailable, keeping {len(entries)} spooled entries queued: {repr(error)}.")
+            return
+        bot_logger.error(f"Backend rejected {len(entries)} spooled entries: {repr(error)}.")
+        dead = self.spool.fail([entry.id for entry in entries], repr(error), self.max_attempts)
+        if dead:
+            bot_logger.error(f"Gave up on {dead} spooled entries after {self.max_attempts} attempts, "
+                             f"they were moved to the dead letter table.")
+
+    async def _deliver_bulk(self, entries: list[spool.SpoolEntry]) -> bool:
+        try:
+            response = await requests_to_server.send_bulk_to_server(
+                items=[
+                    requests_to_server.build_params(entry.code, json.loads(entry.data), entry.from_user_id)
+                    for entry in entries
+                ],
+                url=config.WEB_URL_MESSAGE_BULK
+            )
+            check_accepted(response)
+        except Exception as e:
+            if len(entries) > 1 and is_rejection(e):
+                # One bad message mustn't take the whole batch with it, so they're sent one by one to find it
+                bot_logger.error(f"Backend rejected a batch of {len(entries)} messages, "
+                                 f"sending them one by one: {repr(e)}.")
+                return await self._deliver_singles(entries)
+            self._fail(entries, e)
+            return False
+        self.spool.ack([entry.id for entry in entries])
+        bot_logger.info(f"Batch of {len(entries)} messages was sent successfully. "
+                        f"Response is {response.text}")
+        return True
+
+    async def _deliver_single(self, entry: spool.SpoolEntry) -> http_client.ServerResponse:
+        response = await requests_to_server.send_to_server(
+            code=entry.code,
+            data=json.loads(entry.data),
+            request_method=requests_to_server.RequestMethod.Post,
+            url=entry.url,
+            from_user_id=entry.from_user_id
+        )
+        check_accepted(response)
+        return response
+
+    async def _reply(self, entry: spool.SpoolEntry, response: http_client.ServerResponse) -> None:
+        try:
+            # Acknowledgements yield to answers users are waiting for
+            with rate_limiter.use_lane(rate_limiter.Lane.background):
+                await self._bot.send_message(
+                    chat_id=entry.reply_chat_id,
+                    text=response.json()['data']
+                )
+        except Exception as e:
+            bot_logger.error(f"Failed to reply to spooled entry {entry.id} in chat {entry.reply_chat_id}: {repr(e)}.")
+
+    async def close(self) -> None:
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+        try:
+            await asyncio.wait_for(self.drain(), timeout=config.SPOOL_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        bot_logger.info(f"Spool drainer stopped, {self.spool.stats()}.")
+        self.spool.close()
+
+
+spool_drainer = SpoolDrainer(
+    outbound_spool=spool.outbound_spool,
+    batch_size=config.INGESTION_BATCH_SIZE,
+    max_delay=config.INGESTION_BATCH_DELAY,
+    concurrency=config.SPOOL_CONCURRENCY,
+    retry_delay=config.SPOOL_RETRY_DELAY,
+    max_retry_delay=config.SPOOL_RETRY_MAX_DELAY,
+    max_attempts=config.SPOOL_MAX_ATTEMPTS,
+    prune_interval=config.SPOOL_PRUNE_INTERVAL
+)
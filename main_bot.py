@@ -1,32 +1,98 @@
 import json
 
-from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram import Dispatcher, executor, types
 
+import balances
+import bot_client
 import bot_logger
 import callback_query_handlers
+import config
+import deadline
+import http_client
+import ingestion
+import metrics
+import render
 import requests_to_server
+import scheduler
+import sqlite_storage
+import tracing
 import util
 from config import BOT_TOKEN
 import message_handlers
 import bot_filters
+import webhook
 
 
-storage = MemoryStorage()
+storage = sqlite_storage.SQLiteStorage(
+    path=config.FSM_STORAGE_PATH,
+    flush_delay=config.FSM_FLUSH_DELAY,
+    flush_max_pending=config.FSM_FLUSH_MAX_PENDING
+)
 
 bot_logger.info("Creating Telegram Bot")
-bot = Bot(token=BOT_TOKEN)
+bot = bot_client.BotClient(token=BOT_TOKEN)
 bot_logger.info("Creating Bot Dispatcher")
-dp = Dispatcher(bot, storage=storage)
+dp = scheduler.ShardedDispatcher(
+    bot,
+    storage=storage,
+    shards=config.UPDATE_SHARDS,
+    max_in_flight=config.UPDATE_MAX_IN_FLIGHT
+)
+# Set up first, so its hook after the update flushes the edits while the trace and the deadline are still open
+dp.middleware.setup(render.RenderMiddleware())
+if config.TRACE_ENABLED:
+    dp.middleware.setup(tracing.TracingMiddleware())
+if config.UPDATE_DEADLINE:
+    dp.middleware.setup(deadline.DeadlineMiddleware(config.UPDATE_DEADLINE, config.UPDATE_DEADLINE_GRACE))
+
+metrics.Gauge(
+    "bot_fsm_open_dialogs",
+    "Users with an unfinished FSM dialog.",
+    lambda: sum(1 for users in storage.data.values() for record in users.values() if record['state'])
+)
 
 
 async def admin_callback_handler(callback_query: types.CallbackQuery) -> None:
-    bot_logger.debug(f"Received callback query: {callback_query.data=}")
+    bot_logger.debug("Received callback query: callback_query.data=%r", callback_query.data)
+
+    # Buttons name the user's chat and the user, the ones sent before the user was added name the chat only
+    _, chat_id, *user_id, answer = callback_query.data.split("/")
+
+    # The dialog is changed in its own chat's shard, so it can't interleave with the user's updates
+    await dp.scheduler.run_in_shard(
+        int(chat_id),
+        lambda: answer_bill_request(callback_query, chat_id, user_id[0] if user_id else None, answer)
+    )
+
+
+def waiting_user(chat_id: str) -> str | None:
+    users = [
+        user for user, record in storage.data.get(chat_id, {}).items()
+        if record['state'] == message_handlers.BillStates.last_step.state
+    ]
+    return users[0] if len(users) == 1 else None
 
-    _, chat_id, answer = callback_query.data.split("/")
+
+async def answer_bill_request(
+        callback_query: types.CallbackQuery,
+        chat_id: str,
+        user_id: str | None,
+        answer: str
+) -> None:
+    if user_id is None:
+        # Only resolved when a single dialog of the chat waits for the admin, otherwise it can't be told which
+        user_id = waiting_user(chat_id)
+        if user_id is None:
+            bot_logger.error(f"Admin answer {answer} for chat {chat_id} matches no single waiting dialog.")
+            await callback_query.answer(
+                text="Не удалось определить запрос по этой кнопке. Попросите пользователя отправить его заново.",
+                show_alert=True
+            )
+            return
 
     state = dp.get_current().current_state(
-        chat=chat_id
+        chat=chat_id,
+        user=user_id
     )
     try:
         state_data = await util.get_state_data(state)
@@ -40,25 +106,26 @@ async def admin_callback_handler(callback_query: types.CallbackQuery) -> None:
         case "reject":
             await callback_query.answer()
             await callback_query.message.delete()
-            await callback_query.bot.edit_message_text(
+            await render.edit_message_text(
+                callback_query.bot,
                 text="Ваш запрос был отклонен.",
                 chat_id=chat_id,
                 message_id=state_data.message_id
             )
             await state.finish()
         case _:
-            state_data.previous_answers.append(util.PreviousAnswer(
+            state_data.previous_answers += (util.PreviousAnswer(
                 name="bank_accountants",
                 value=answer
-            ))
+            ),)
 
-            response = requests_to_server.request_order(
+            response = await requests_to_server.request_order(
                 answers=state_data.previous_answers,
                 data=json.dumps({'chat_id': callback_query.message.chat.id, 'user_id': callback_query.from_user.id}),
                 from_user_id=callback_query.from_user.id
             )
 
-            bot_logger.debug(f"{response.text=}")
+            bot_logger.debug("response.text=%r", response.text)
 
             if response.json()['error'] != 0:
                 await callback_query.bot.send_message(
@@ -74,6 +141,8 @@ async def admin_callback_handler(callback_query: types.CallbackQuery) -> None:
                 )
                 await state.finish()
                 return
+            balances.balance_cache.invalidate(int(chat_id))
+
             await callback_query.answer()
             await callback_query.message.delete()
             await callback_query.bot.send_document(
@@ -89,41 +158,68 @@ async def admin_callback_handler(callback_query: types.CallbackQuery) -> None:
             return
 
 
+async def deadline_exceeded_handler(update: types.Update, exception: deadline.DeadlineExceeded) -> bool:
+    bot_logger.error(f"Update {update.update_id} ran out of its deadline budget: {repr(exception)}.")
+    deadline.expired_updates.inc(("fallback",))
+
+    if update.callback_query is not None:
+        message, user_id = update.callback_query.message, update.callback_query.from_user.id
+    elif update.message is not None:
+        message, user_id = update.message, update.message.from_user.id
+    else:
+        return True
+    state = dp.current_state(chat=message.chat.id, user=user_id)
+    # Plain chat messages are only recorded, nobody is waiting for an answer to them
+    if update.message is not None and not message.is_command() and await state.get_state() is None:
+        return True
+
+    deadline.enter_grace()
+    await dp.bot.send_message(
+        chat_id=message.chat.id,
+        text="Произошла проблема на сервере. Попробуйте еще раз."
+    )
+    await state.finish()
+    return True
+
+
+dp.register_errors_handler(deadline_exceeded_handler, exception=deadline.DeadlineExceeded)
+
+
 bot_logger.info("Start registering message handlers")
 dp.register_message_handler(
-    message_handlers.chat_created_routine,
+    metrics.instrument_handler(message_handlers.chat_created_routine),
     bot_filters.ValidChatFilter(),
     content_types=['group_chat_created']
 )
 dp.register_message_handler(
-    message_handlers.added_to_chat_routine,
+    metrics.instrument_handler(message_handlers.added_to_chat_routine),
     bot_filters.ValidChatFilter(),
     bot_filters.BotAddedToChatFilter(),
     content_types=['new_chat_members']
 )
 dp.register_message_handler(
-    message_handlers.hashtag_command_routine,
+    metrics.instrument_handler(message_handlers.hashtag_command_routine),
     bot_filters.ValidChatFilter(),
     bot_filters.HashtagCommandFilter(),
     content_types=['text']
 )
 dp.register_message_handler(
-    message_handlers.pre_bill_routine,
+    metrics.instrument_handler(message_handlers.pre_bill_routine),
     bot_filters.ValidChatFilter(),
     commands=['bill']
 )
 dp.register_message_handler(
-    message_handlers.number_step_handler,
+    metrics.instrument_handler(message_handlers.number_step_handler),
     bot_filters.ValidChatFilter(),
     state=message_handlers.BillStates.number_step
 )
 dp.register_message_handler(
-    message_handlers.text_step_handler,
+    metrics.instrument_handler(message_handlers.text_step_handler),
     bot_filters.ValidChatFilter(),
     state=message_handlers.BillStates.text_step
 )
 dp.register_message_handler(
-    message_handlers.any_message_routine,
+    metrics.instrument_handler(message_handlers.any_message_routine),
     bot_filters.ValidChatFilter(),
     content_types=["text", "audio", "document", "photo", "sticker",
                    "video", "video_note", "voice", "location", "contact"]
@@ -133,28 +229,47 @@ bot_logger.info("Finish registering message handlers")
 
 bot_logger.info("Start registering callback query handlers")
 dp.register_callback_query_handler(
-    callback_query_handlers.any_answer_callback_handler,
+    metrics.instrument_handler(callback_query_handlers.any_answer_callback_handler),
     state=message_handlers.BillStates.callback_step
 )
 dp.register_callback_query_handler(
-    callback_query_handlers.skip_callback_handler,
-    lambda cq: cq.data == "skip",
+    metrics.instrument_handler(callback_query_handlers.skip_callback_handler),
+    lambda cq: util.parse_answer_callback_data(cq.data)[1] == "skip",
     state="*"
 )
 dp.register_callback_query_handler(
-    callback_query_handlers.last_step_callback_handler,
+    metrics.instrument_handler(callback_query_handlers.last_step_callback_handler),
     state=message_handlers.BillStates.last_step
 )
 dp.register_callback_query_handler(
-    admin_callback_handler,
+    metrics.instrument_handler(admin_callback_handler),
     lambda cq: cq.data.startswith("admin")
 )
 dp.register_callback_query_handler(
-    callback_query_handlers.default_callback_handler,
+    metrics.instrument_handler(callback_query_handlers.default_callback_handler),
     state="*"
 )
 bot_logger.info("Finish registering callback query handlers")
 
 
+async def on_startup(dispatcher: Dispatcher) -> None:
+    if config.METRICS_ENABLED:
+        await metrics.start(config.METRICS_HOST, config.METRICS_PORT)
+    dispatcher.scheduler.start()
+    ingestion.spool_drainer.start(dispatcher.bot)
+    balances.balance_cache.start()
+
+
+async def on_shutdown(dispatcher: Dispatcher) -> None:
+    await dispatcher.scheduler.close()
+    await ingestion.spool_drainer.close()
+    await balances.balance_cache.close()
+    await http_client.close()
+    await metrics.close()
+
+
 if __name__ == "__main__":
-    executor.start_polling(dp, skip_updates=True)
+    if config.WEBHOOK_ENABLED:
+        webhook.start_webhook(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -7,6 +7,8 @@ import json
 import requests_to_server
 import bot_logger
 import message_objects
+import prefetch
+import render
 import config
 import util
 
@@ -24,7 +26,9 @@ async def chat_created_routine(message: types.Message) -> None:
     bot_logger.info(f"Bot has been added to chat through creation. "
                     f"Chat name is {message.chat.title}.")
 
-    response = requests_to_server.send_to_server(
+    requests_to_server.invalidate_access(chat_id=message.chat.id)
+
+    response = await requests_to_server.send_to_server(
         code="newChat",
         data={
             'chat_id': message.chat.id,
@@ -58,7 +62,7 @@ async def added_to_chat_routine(message: types.Message) -> None:
 async def pre_bill_routine(message: types.Message, state: FSMContext) -> None:
     bot_logger.info(f"Bot has received /bill and is going to start billing process.")
 
-    response = requests_to_server.has_access(
+    response = await requests_to_server.has_access(
         previous_answers=[],
         current_question=1,
         data=json.dumps(
@@ -92,7 +96,7 @@ async def pre_bill_routine(message: types.Message, state: FSMContext) -> None:
         return
 
     state_data = util.StateData(
-        previous_answers=[],
+        previous_answers=(),
         current_question=1,
         user_id=message.from_user.id,
         message_id=None,
@@ -102,25 +106,66 @@ async def pre_bill_routine(message: types.Message, state: FSMContext) -> None:
         last_question=False,
         question_name_ru="",
         answers_dict={},
-        answers_data=[]
+        answers_data=()
     )
 
     await message.delete()
 
-    await util.update_state_data(state, state_data)
-
+    # Stored together with the first question
     await new_question_routine(
         message=message,
-        state=state
+        state=state,
+        state_data=state_data
     )
 
 
-async def new_question_routine(message: types.Message, state: FSMContext) -> None:
-    state_data = await util.get_state_data(state)
+async def next_step_routine(
+        message: types.Message,
+        state: FSMContext,
+        state_data: util.StateData,
+        value: str | float,
+        text: str | float
+) -> None:
+    # The answer is stored together with what it leads to, the next question or the confirmation, in one transition
+    answer_changes = {
+        'previous_answers': state_data.previous_answers + (util.PreviousAnswer(
+            name=state_data.question_name,
+            value=value
+        ),),
+        'current_question': state_data.current_question + 1,
+        'answers_dict': {**state_data.answers_dict, state_data.question_name_ru: text}
+    }
+    if not state_data.last_question:
+        await new_question_routine(
+            message=message,
+            state=state,
+            state_data=state_data,
+            **answer_changes
+        )
+    else:
+        await confirm_answers_routine(
+            message=message,
+            state=state,
+            state_data=state_data,
+            **answer_changes
+        )
 
-    bot_logger.debug(f"Step {state_data.current_question} of bill dialogue, state_data is {state_data}.")
 
-    response = requests_to_server.ask_for_question(
+async def new_question_routine(
+        message: types.Message,
+        state: FSMContext,
+        state_data: util.StateData | None = None,
+        **answer_changes
+) -> None:
+    if state_data is None:
+        state_data = await util.get_state_data(state)
+    previous_answers = answer_changes.get('previous_answers', state_data.previous_answers)
+    current_question = answer_changes.get('current_question', state_data.current_question)
+
+    bot_logger.debug("Step %s of bill dialogue, state_data is %s, answer is %s.",
+                     current_question, state_data, answer_changes)
+
+    response = await requests_to_server.ask_for_question(
         data={
             'chat_id': message.chat.id,
             'user_id': message.from_user.id
@@ -130,9 +175,9 @@ async def new_question_routine(message: types.Message, state: FSMContext) -> Non
                 'name': previous_answer.name,
                 'value': previous_answer.value
             }
-            for previous_answer in state_data.previous_answers
+            for previous_answer in previous_answers
         ]),
-        current_question=state_data.current_question,
+        current_question=current_question,
         from_user_id=message.from_user.id
     )
 
@@ -157,10 +202,11 @@ async def new_question_routine(message: types.Message, state: FSMContext) -> Non
         await state.finish()
         return
 
-    bot_logger.debug(f"Response data is {response_data}.")
+    bot_logger.debug("Response data is %s.", response_data)
 
     bot_msg = await util.construct_question_with_answers(
         message=message,
+        current_question=current_question,
         question_name=response_data['name'],
         question=response_data['question'],
         answer_type=response_data['type'],
@@ -168,19 +214,35 @@ async def new_question_routine(message: types.Message, state: FSMContext) -> Non
         answers_data=response_data['data']
     )
 
-    state_data.last_question = response_data['last_question']
-    state_data.answer_type = response_data['type']
-    state_data.question_name = response_data['name']
-    state_data.question_name_ru = response_data['name_ru']
-    state_data.answers_data = response_data['data']
+    question_changes = {
+        **answer_changes,
+        'last_question': response_data['last_question'],
+        'answer_type': response_data['type'],
+        'question_name': response_data['name'],
+        'question_name_ru': response_data['name_ru'],
+        'answers_data': tuple(response_data['data'])
+    }
 
-    if state_data.current_question == 1:
+    if current_question == 1:
         msg = await message.answer(**bot_msg)
-        state_data.message_id = msg.message_id
-
-        await util.update_state_data(state, state_data)
+        render.remember_message(msg)
+
+        state_data = await util.transition(
+            state,
+            state_data,
+            next_state=BillStates.callback_step,
+            message_id=msg.message_id,
+            **question_changes
+        )
 
-        await BillStates.callback_step.set()
+        prefetch.question_prefetcher.start(
+            state_data=state_data,
+            data={
+                'chat_id': message.chat.id,
+                'user_id': message.from_user.id
+            },
+            from_user_id=message.from_user.id
+        )
     else:
         try:
             answer_type = util.AnswerType(response_data['type'])
@@ -193,38 +255,59 @@ async def new_question_routine(message: types.Message, state: FSMContext) -> Non
             return
         match answer_type:
             case util.AnswerType.list_:
-                await message.bot.edit_message_text(
+                await render.edit_message_text(
+                    message.bot,
                     text=bot_msg.text,
                     chat_id=state_data.chat_id,
                     message_id=state_data.message_id,
                     reply_markup=bot_msg.reply_markup
                 )
 
-                await util.update_state_data(state, state_data)
+                state_data = await util.transition(
+                    state,
+                    state_data,
+                    next_state=BillStates.callback_step,
+                    **question_changes
+                )
 
-                await BillStates.callback_step.set()
+                prefetch.question_prefetcher.start(
+                    state_data=state_data,
+                    data={
+                        'chat_id': message.chat.id,
+                        'user_id': message.from_user.id
+                    },
+                    from_user_id=message.from_user.id
+                )
             case util.AnswerType.float_:
-                await message.bot.edit_message_text(
+                await render.edit_message_text(
+                    message.bot,
                     text=bot_msg.text,
                     chat_id=state_data.chat_id,
                     message_id=state_data.message_id,
                     reply_markup=bot_msg.reply_markup
                 )
 
-                await util.update_state_data(state, state_data)
-
-                await BillStates.number_step.set()
+                state_data = await util.transition(
+                    state,
+                    state_data,
+                    next_state=BillStates.number_step,
+                    **question_changes
+                )
             case util.AnswerType.text_:
-                await message.bot.edit_message_text(
+                await render.edit_message_text(
+                    message.bot,
                     text=bot_msg.text,
                     chat_id=state_data.chat_id,
                     message_id=state_data.message_id,
                     reply_markup=bot_msg.reply_markup
                 )
 
-                await util.update_state_data(state, state_data)
-
-                await BillStates.text_step.set()
+                state_data = await util.transition(
+                    state,
+                    state_data,
+                    next_state=BillStates.text_step,
+                    **question_changes
+                )
             case _:
                 bot_logger.error(f"Some unexpected AnswerType object was passed: {answer_type=}")
                 await message.answer(
@@ -234,11 +317,19 @@ async def new_question_routine(message: types.Message, state: FSMContext) -> Non
                 return
 
 
-async def confirm_answers_routine(message: types.Message, state: FSMContext) -> None:
-    state_data = await util.get_state_data(state)
+async def confirm_answers_routine(
+        message: types.Message,
+        state: FSMContext,
+        state_data: util.StateData | None = None,
+        **answer_changes
+) -> None:
+    if state_data is None:
+        state_data = await util.get_state_data(state)
+    answers_dict = answer_changes.get('answers_dict', state_data.answers_dict)
 
-    bot_logger.debug(f"It was the last question, sending a message to confirm the answers: "
-                     f"{state_data=}")
+    bot_logger.debug("It was the last question, sending a message to confirm the answers: "
+                     "state_data=%r, answer is %r",
+                     state_data, answer_changes)
 
     markup = types.InlineKeyboardMarkup(
         inline_keyboard=[
@@ -254,29 +345,29 @@ async def confirm_answers_routine(message: types.Message, state: FSMContext) ->
     )
 
     text = f"Эти данные верны?"
-    for ans in state_data.answers_dict:
-        text += f"\n{ans}: {state_data.answers_dict[ans]}"
+    for ans in answers_dict:
+        text += f"\n{ans}: {answers_dict[ans]}"
 
-    await message.bot.edit_message_text(
+    await render.edit_message_text(
+        message.bot,
         text=text,
         chat_id=message.chat.id,
         message_id=state_data.message_id,
         reply_markup=markup
     )
 
-    await util.update_state_data(state, state_data)
-
-    await BillStates.last_step.set()
+    await util.transition(state, state_data, next_state=BillStates.last_step, **answer_changes)
 
 
 async def number_step_handler(message: types.Message, state: FSMContext) -> None:
     state_data = await util.get_state_data(state)
 
-    bot_logger.debug(f"Received number answer: {message.text=}, {state_data=}")
+    bot_logger.debug("Received number answer: message.text=%r, state_data=%r", message.text, state_data)
 
     if message.from_user.id != state_data.user_id:
-        bot_logger.debug(f"User's id doesn't match user_id saved in state_data: "
-                         f"{message.from_user.id=} {state_data.user_id=}")
+        bot_logger.debug("User's id doesn't match user_id saved in state_data: "
+                         "message.from_user.id=%r state_data.user_id=%r",
+                         message.from_user.id, state_data.user_id)
 
         await message.answer(
             text="Вы не можете отвечать на это сообщение, так как другой пользователь вызвал команду /bill."
@@ -292,39 +383,28 @@ async def number_step_handler(message: types.Message, state: FSMContext) -> None
     #     )
     #     return
 
-    state_data.previous_answers.append(util.PreviousAnswer(
-        name=state_data.question_name,
-        value=float(message.text)
-    ))
-    state_data.current_question += 1
-    state_data.answers_dict[state_data.question_name_ru] = float(message.text)
-
-    bot_logger.debug(f"{state_data=}")
+    answer = float(message.text)
 
     await message.delete()
 
-    await util.update_state_data(state, state_data)
-
-    if not state_data.last_question:
-        await new_question_routine(
-            message=message,
-            state=state
-        )
-    else:
-        await confirm_answers_routine(
-            message=message,
-            state=state
-        )
+    await next_step_routine(
+        message=message,
+        state=state,
+        state_data=state_data,
+        value=answer,
+        text=answer
+    )
 
 
 async def text_step_handler(message: types.Message, state: FSMContext) -> None:
     state_data = await util.get_state_data(state)
 
-    bot_logger.debug(f"Received text answer: {message.text=}, {state_data=}")
+    bot_logger.debug("Received text answer: message.text=%r, state_data=%r", message.text, state_data)
 
     if message.from_user.id != state_data.user_id:
-        bot_logger.debug(f"User's id doesn't match user_id saved in state_data: "
-                         f"{message.from_user.id=} {state_data.user_id=}")
+        bot_logger.debug("User's id doesn't match user_id saved in state_data: "
+                         "message.from_user.id=%r state_data.user_id=%r",
+                         message.from_user.id, state_data.user_id)
 
         await message.answer(
             text="Вы не можете отвечать на это сообщение, так как другой пользователь вызвал команду /bill."
@@ -340,29 +420,17 @@ async def text_step_handler(message: types.Message, state: FSMContext) -> None:
     #     )
     #     return
 
-    state_data.previous_answers.append(util.PreviousAnswer(
-        name=state_data.question_name,
-        value=message.text
-    ))
-    state_data.current_question += 1
-    state_data.answers_dict[state_data.question_name_ru] = message.text
-
-    bot_logger.debug(f"{state_data=}")
+    answer = message.text
 
     await message.delete()
 
-    await util.update_state_data(state, state_data)
-
-    if not state_data.last_question:
-        await new_question_routine(
-            message=message,
-            state=state
-        )
-    else:
-        await confirm_answers_routine(
-            message=message,
-            state=state
-        )
+    await next_step_routine(
+        message=message,
+        state=state,
+        state_data=state_data,
+        value=answer,
+        text=answer
+    )
 
 
 # When bot receives a hashtag starting message
@@ -370,7 +438,9 @@ async def hashtag_command_routine(message: types.Message) -> None:
     bot_logger.info(f"Bot has received a hashtag starting message. "
                     f"Hashtag command is {message.text}.")
 
-    response = requests_to_server.send_to_server(
+    # The server's answer is sent to the chat once the spooled command is delivered
+    requests_to_server.spool_to_server(
+        dedup_key=f"addCommand/{message.chat.id}/{message.message_id}",
         code="addCommand",
         data={
             'chat_id': message.chat.id,
@@ -378,17 +448,12 @@ async def hashtag_command_routine(message: types.Message) -> None:
             'date': time.strftime("%d.%m.%Y %H:%M"),
             'command': message.text
         },
-        request_method=requests_to_server.RequestMethod.Post,
         url=config.WEB_URL_COMMAND,
-        from_user_id=message.from_user.id
-    )
-    bot_logger.info(f"Hashtag command request was sent successfully. "
-                    f"Hashtag command is {message.text}. "
-                    f"Response is {response.text}")
-
-    await message.answer(
-        text=response.json()['data']
+        from_user_id=message.from_user.id,
+        reply_chat_id=message.chat.id
     )
+    bot_logger.info(f"Hashtag command was spooled. "
+                    f"Hashtag command is {message.text}.")
 
 
 # When bot receives any message aside from all above cases
@@ -396,7 +461,8 @@ async def any_message_routine(message: types.Message) -> None:
     bot_logger.info(f"Bot has received a message. "
                     f"Message text is {message.text}.")
 
-    response = requests_to_server.send_to_server(
+    requests_to_server.spool_to_server(
+        dedup_key=f"addMessage/{message.chat.id}/{message.message_id}",
         code="addMessage",
         data={
             'text': util.get_text(message),
@@ -407,10 +473,8 @@ async def any_message_routine(message: types.Message) -> None:
             'reply_to_message_id': util.get_reply_to_message_id(message),
             'date': time.strftime("%d.%m.%Y %H:%M")
         },
-        request_method=requests_to_server.RequestMethod.Post,
         url=config.WEB_URL_MESSAGE,
         from_user_id=message.from_user.id
     )
-    bot_logger.info(f"Message request was sent successfully. "
-                    f"Message text is {message.text}. "
-                    f"Response is {response.text}")
+    bot_logger.info(f"Message was spooled. "
+                    f"Message text is {message.text}.")
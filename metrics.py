@@ -0,0 +1,182 @@
+import functools
+import time
+from bisect import bisect_left
+from typing import Awaitable, Callable
+
+from aiogram.dispatcher.handler import CancelHandler, SkipHandler
+from aiohttp import web
+
+import bot_logger
+import config
+import tracing
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: list = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names: tuple[str, ...], labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: dict[tuple, float] = {}
+        _registry.append(self)
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # Per label set: the count of every bucket plus +Inf, not cumulative, and the sum
+        self._series: dict[tuple, list] = {}
+        _registry.append(self)
+
+    def observe(self, labels: tuple, value: float) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    # The value is read from the callback on every scrape, nothing is recorded on the hot path.
+    # With label names the callback returns the values keyed by label tuples
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            callback: Callable[[], float | dict[tuple, float]],
+            label_names: tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.label_names = label_names
+        _registry.append(self)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.callback() if self.label_names else {(): self.callback()}
+        except Exception as e:
+            bot_logger.error(f"Failed to read gauge {self.name}: {repr(e)}.")
+            return lines
+        for labels, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+handler_seconds = Histogram(
+    "bot_handler_duration_seconds", "Time spent in update handlers.", ("handler",)
+)
+handler_errors = Counter(
+    "bot_handler_errors_total", "Update handlers that raised an exception.", ("handler",)
+)
+backend_seconds = Histogram(
+    "bot_backend_request_duration_seconds", "Time spent in backend requests.", ("endpoint", "method", "status")
+)
+backend_retries = Counter(
+    "bot_backend_retries_total", "Backend requests that were retried.", ("endpoint",)
+)
+backend_rejections = Counter(
+    "bot_backend_circuit_rejections_total", "Backend requests refused by an open circuit breaker.", ("endpoint",)
+)
+telegram_seconds = Histogram(
+    "bot_telegram_request_duration_seconds", "Time spent in Telegram Bot API requests.", ("method", "outcome")
+)
+Gauge("bot_log_queue_depth", "Log records waiting to be written.", bot_logger.log_queue.qsize)
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def instrument_handler(handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    labels = (handler.__name__,)
+
+    # functools.wraps keeps __wrapped__, which aiogram follows to pass only the arguments the handler accepts
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"handler {handler.__name__}"):
+                return await handler(*args, **kwargs)
+        except (CancelHandler, SkipHandler):
+            raise
+        except Exception:
+            handler_errors.inc(labels)
+            raise
+        finally:
+            handler_seconds.observe(labels, time.perf_counter() - start)
+
+    return wrapper
+
+
+async def handle_metrics(_: web.Request) -> web.Response:
+    return web.Response(text=render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+_runner: web.AppRunner | None = None
+
+
+async def start(host: str, port: int) -> None:
+    global _runner
+    app = web.Application()
+    app.router.add_get(config.METRICS_PATH, handle_metrics)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, host=host, port=port).start()
+    bot_logger.info(f"Serving metrics on http://{host}:{port}{config.METRICS_PATH}.")
+
+
+async def close() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
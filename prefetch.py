@@ -0,0 +1,97 @@
+import asyncio
+import json
+from collections import Counter
+
+import bot_logger
+import cache
+import config
+import metrics
+import requests_to_server
+import util
+
+
+prefetch_answers = metrics.Counter(
+    "bot_question_prefetch_total", "Answers to list questions, by whether their next question was prefetched.",
+    ("outcome",)
+)
+prefetch_evictions = metrics.Counter(
+    "bot_question_prefetch_evicted_total", "Dialogs whose prefetches were cancelled unused by the cache's TTL or size."
+)
+
+
+class QuestionPrefetcher:
+    def __init__(self, enabled: bool, max_per_dialog: int, max_dialogs: int, ttl: float):
+        self.enabled = enabled
+        self.max_per_dialog = max_per_dialog
+        # Prefetch tasks of every open dialog, keyed by the option they were started for
+        self._dialogs = cache.TTLCache(max_size=max_dialogs, ttl=ttl, on_evict=self._on_evict)
+        self._popularity: Counter[tuple[str, str]] = Counter()
+
+    def start(self, state_data: util.StateData, data: dict[str], from_user_id: int) -> None:
+        if not self.enabled or state_data.last_question or state_data.answer_type != util.AnswerType.list_.value:
+            return
+        self.cancel(state_data.chat_id, state_data.user_id)
+
+        # The most picked options go first, ties keep the server's order
+        options = sorted(
+            (str(item['id']) for item in state_data.answers_data),
+            key=lambda option: -self._popularity[(state_data.question_name, option)]
+        )[:self.max_per_dialog]
+
+        previous_answers = [
+            {
+                'name': previous_answer.name,
+                'value': previous_answer.value
+            }
+            for previous_answer in state_data.previous_answers
+        ]
+        tasks = {}
+        for option in options:
+            tasks[option] = asyncio.create_task(requests_to_server.ask_for_question(
+                data=data,
+                previous_answers=json.dumps(previous_answers + [{
+                    'name': state_data.question_name,
+                    'value': option
+                }]),
+                current_question=state_data.current_question + 1,
+                from_user_id=from_user_id
+            ))
+            tasks[option].add_done_callback(self._on_done)
+        self._dialogs.set((state_data.chat_id, state_data.user_id), tasks)
+
+    def on_answer(self, chat_id: int, user_id: int, question_name: str, value: str) -> None:
+        if not self.enabled:
+            return
+        self._popularity[(question_name, value)] += 1
+        tasks = self._dialogs.pop((chat_id, user_id), {})
+        outcome = "hit" if value in tasks else "miss"
+        prefetch_answers.inc((outcome,))
+        # The prefetch of the chosen option keeps running, the next question request joins it
+        for option, task in tasks.items():
+            if option != value:
+                task.cancel()
+        bot_logger.debug("Question prefetch %s for user %s in chat %s.", outcome, user_id, chat_id)
+
+    def cancel(self, chat_id: int, user_id: int) -> None:
+        for task in self._dialogs.pop((chat_id, user_id), {}).values():
+            task.cancel()
+
+    @staticmethod
+    def _on_evict(key: tuple[int, int], tasks: dict[str, asyncio.Task]) -> None:
+        # An abandoned dialog's requests would otherwise hold backend connections until they finish
+        prefetch_evictions.inc()
+        for task in tasks.values():
+            task.cancel()
+
+    @staticmethod
+    def _on_done(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            bot_logger.debug(f"Question prefetch failed: {repr(task.exception())}.")
+
+
+question_prefetcher = QuestionPrefetcher(
+    enabled=config.PREFETCH_ENABLED,
+    max_per_dialog=config.PREFETCH_MAX_PER_DIALOG,
+    max_dialogs=config.PREFETCH_MAX_DIALOGS,
+    ttl=config.PREFETCH_TTL
+)
@@ -0,0 +1,228 @@
+import asyncio
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+
+import bot_logger
+import config
+import metrics
+
+
+class Lane(IntEnum):
+    # Lower lanes are served first when the limits are reached
+    callback = 0
+    interactive = 1
+    background = 2
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def paused_for(self, now: float) -> float:
+        return max(0.0, self.paused_until - now)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Waiter:
+    __slots__ = ("lane", "seq", "chat_id", "new_message", "future", "enqueued")
+
+    def __init__(self, lane: Lane, seq: int, chat_id: int | str | None, new_message: bool, future: asyncio.Future):
+        self.lane = lane
+        self.seq = seq
+        self.chat_id = chat_id
+        self.new_message = new_message
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+    def __lt__(self, other: "Waiter") -> bool:
+        return (self.lane, self.seq) < (other.lane, other.seq)
+
+
+retry_after_total = metrics.Counter(
+    "bot_telegram_retry_after_total", "Telegram API calls answered with flood control.", ("method",)
+)
+
+
+def is_group(chat_id: int | str) -> bool:
+    # Group and channel ids are negative, usernames like @channel are treated the same way
+    return not isinstance(chat_id, int) or chat_id < 0
+
+
+_current_lane: ContextVar[Lane | None] = ContextVar("current_lane", default=None)
+
+
+@contextmanager
+def use_lane(value: Lane):
+    token = _current_lane.set(value)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def current_lane(method: str) -> Lane:
+    value = _current_lane.get()
+    if value is not None:
+        return value
+    return Lane.callback if method == "answerCallbackQuery" else Lane.interactive
+
+
+class RateLimiter:
+    # Telegram's limits: one global bucket for all calls and one per chat, groups being stricter than private chats
+    def __init__(
+            self,
+            global_rate: float,
+            global_burst: float,
+            chat_rate: float,
+            chat_burst: float,
+            group_rate: float,
+            group_burst: float
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+        self._prune_at = 1024
+        self._waiters: list[Waiter] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+        self.queue_wait = metrics.Histogram(
+            "bot_telegram_queue_wait_seconds",
+            "Time Telegram API calls waited for the rate limiter.",
+            ("lane",)
+        )
+        metrics.Gauge(
+            "bot_telegram_queue_depth",
+            "Telegram API calls waiting for the rate limiter, per lane.",
+            lambda: {(lane.name,): sum(1 for waiter in self._waiters if waiter.lane is lane) for lane in Lane},
+            ("lane",)
+        )
+
+    def _prune(self) -> None:
+        # A bucket that has refilled is no different from a new one
+        now = time.monotonic()
+        self._chat_buckets = {
+            chat_id: bucket for chat_id, bucket in self._chat_buckets.items()
+            if bucket.wait_time(now) > 0 or bucket.tokens < bucket.burst
+        }
+        self._prune_at = max(1024, 2 * len(self._chat_buckets))
+
+    def chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self._prune_at:
+                self._prune()
+            group = is_group(chat_id)
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                self.group_rate if group else self.chat_rate,
+                self.group_burst if group else self.chat_burst
+            )
+        return bucket
+
+    @staticmethod
+    def _chat_counted(chat_id: int | str, new_message: bool) -> bool:
+        # A group's limit is on posted messages, edits and deletions there only wait out flood control pauses
+        return new_message or not is_group(chat_id)
+
+    def _wait_time(self, chat_id: int | str | None, new_message: bool, now: float) -> float:
+        wait = self.global_bucket.wait_time(now)
+        if chat_id is not None:
+            bucket = self.chat_bucket(chat_id)
+            if self._chat_counted(chat_id, new_message):
+                wait = max(wait, bucket.wait_time(now))
+            else:
+                wait = max(wait, bucket.paused_for(now))
+        return wait
+
+    def _take(self, chat_id: int | str | None, new_message: bool) -> None:
+        self.global_bucket.take()
+        if chat_id is not None and self._chat_counted(chat_id, new_message):
+            self.chat_bucket(chat_id).take()
+
+    async def acquire(
+            self,
+            chat_id: int | str | None,
+            lane: Lane,
+            new_message: bool = True,
+            timeout: float | None = None
+    ) -> None:
+        if not self._waiters and self._wait_time(chat_id, new_message, time.monotonic()) == 0:
+            self._take(chat_id, new_message)
+            self.queue_wait.observe((lane.name,), 0.0)
+            return
+
+        waiter = Waiter(lane, next(self._seq), chat_id, new_message, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._grant())
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        finally:
+            # The grant loop may have dropped it already
+            if waiter.future.cancelled() and waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self.queue_wait.observe((lane.name,), time.perf_counter() - waiter.enqueued)
+
+    async def _grant(self) -> None:
+        while self._waiters:
+            self._wakeup.clear()
+            now = time.monotonic()
+            next_wait = None
+            # A waiter whose chat is still limited doesn't hold back other chats, even from lower lanes
+            for waiter in sorted(self._waiters):
+                if waiter.future.done():
+                    continue
+                wait = self._wait_time(waiter.chat_id, waiter.new_message, now)
+                if wait == 0:
+                    self._take(waiter.chat_id, waiter.new_message)
+                    waiter.future.set_result(None)
+                    if self.global_bucket.wait_time(now) > 0:
+                        break
+                elif next_wait is None or wait < next_wait:
+                    next_wait = wait
+            self._waiters = [waiter for waiter in self._waiters if not waiter.future.done()]
+            if self._waiters:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_wait or self.global_bucket.wait_time(now) or None)
+                except asyncio.TimeoutError:
+                    pass
+
+    def retry_after(self, chat_id: int | str | None, seconds: float) -> None:
+        bot_logger.error(f"Telegram flood control for chat {chat_id}, pausing it for {seconds} s.")
+        (self.global_bucket if chat_id is None else self.chat_bucket(chat_id)).pause(seconds)
+
+
+telegram_limiter = RateLimiter(
+    global_rate=config.TELEGRAM_GLOBAL_RATE,
+    global_burst=config.TELEGRAM_GLOBAL_BURST,
+    chat_rate=config.TELEGRAM_CHAT_RATE,
+    chat_burst=config.TELEGRAM_CHAT_BURST,
+    group_rate=config.TELEGRAM_GROUP_RATE,
+    group_burst=config.TELEGRAM_GROUP_BURST
+)
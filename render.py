@@ -0,0 +1,140 @@
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from aiogram import Bot, types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import bot_logger
+import config
+import metrics
+
+
+class Rendered:
+    __slots__ = ("text", "markup")
+
+    def __init__(self, text: str | None, markup: str | None):
+        # None text means it isn't known, e.g. only the markup was edited since the bot restarted
+        self.text = text
+        self.markup = markup
+
+
+class PendingEdit:
+    __slots__ = ("bot", "text", "reply_markup")
+
+    def __init__(self, bot: Bot, text: str | None, reply_markup: types.InlineKeyboardMarkup | None):
+        self.bot = bot
+        # None text leaves the text as it is and only changes the markup
+        self.text = text
+        self.reply_markup = reply_markup
+
+
+# What was last sent per (chat_id, message_id), the least recently used messages are forgotten first
+_rendered: OrderedDict[tuple[int, int], Rendered] = OrderedDict()
+# Edits of the update being processed, sent together once it's done
+_pending: ContextVar[dict[tuple[int, int], PendingEdit] | None] = ContextVar("pending_edits", default=None)
+
+skipped_edits = metrics.Counter(
+    "bot_render_edits_skipped_total",
+    "Message edits merged into a later one or dropped as unchanged.",
+    ("reason",)
+)
+
+
+def markup_key(reply_markup: types.InlineKeyboardMarkup | None) -> str | None:
+    if reply_markup is None or not reply_markup.inline_keyboard:
+        return None
+    return reply_markup.as_json()
+
+
+def remember(chat_id: int | str, message_id: int, text: str | None,
+             reply_markup: types.InlineKeyboardMarkup | None) -> None:
+    key = (int(chat_id), message_id)
+    _rendered[key] = Rendered(text, markup_key(reply_markup))
+    _rendered.move_to_end(key)
+    while len(_rendered) > config.RENDER_CACHE_SIZE:
+        _rendered.popitem(last=False)
+
+
+def remember_message(message: types.Message) -> None:
+    remember(message.chat.id, message.message_id, message.text, message.reply_markup)
+
+
+async def edit_message_text(
+        bot: Bot,
+        text: str,
+        chat_id: int | str,
+        message_id: int,
+        reply_markup: types.InlineKeyboardMarkup | None = None
+) -> None:
+    await _edit(bot, (int(chat_id), message_id), text, reply_markup)
+
+
+async def edit_message_reply_markup(
+        bot: Bot,
+        chat_id: int | str,
+        message_id: int,
+        reply_markup: types.InlineKeyboardMarkup | None = None
+) -> None:
+    await _edit(bot, (int(chat_id), message_id), None, reply_markup)
+
+
+async def _edit(bot: Bot, key: tuple[int, int], text: str | None,
+                reply_markup: types.InlineKeyboardMarkup | None) -> None:
+    pending = _pending.get()
+    if pending is None:
+        await _send(bot, key, text, reply_markup)
+        return
+    previous = pending.get(key)
+    if previous is not None:
+        skipped_edits.inc(("merged",))
+        if text is None:
+            text = previous.text
+    pending[key] = PendingEdit(bot, text, reply_markup)
+
+
+async def _send(bot: Bot, key: tuple[int, int], text: str | None,
+                reply_markup: types.InlineKeyboardMarkup | None) -> None:
+    chat_id, message_id = key
+    rendered = _rendered.get(key)
+    markup = markup_key(reply_markup)
+    if text is not None and (rendered is None or rendered.text != text):
+        # Telegram drops the keyboard when the text is edited without one, so the markup always goes along
+        await bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+    elif rendered is None or rendered.markup != markup:
+        await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+        text = None if rendered is None else rendered.text
+    else:
+        skipped_edits.inc(("unchanged",))
+        return
+    remember(chat_id, message_id, text, reply_markup)
+
+
+async def flush() -> None:
+    # Every edit is tried, the first failure is raised once they're all done
+    error = None
+    pending = _pending.get()
+    while pending:
+        key = next(iter(pending))
+        edit = pending.pop(key)
+        try:
+            await _send(edit.bot, key, edit.text, edit.reply_markup)
+        except Exception as e:
+            bot_logger.error(f"Failed to edit message {key[1]} in chat {key[0]}: {repr(e)}.")
+            error = error or e
+    if error is not None:
+        raise error
+
+
+class RenderMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict) -> None:
+        _pending.set({})
+
+    async def on_post_process_update(self, update: types.Update, result: list, data: dict) -> None:
+        try:
+            await flush()
+        except Exception as e:
+            # The dispatcher's error handling is over by now, so the errors handlers are called from here.
+            # Not raised further, the hooks of the middlewares set up after this one still have to run
+            await self.manager.dispatcher.errors_handlers.notify(update, e)
+        finally:
+            _pending.set(None)
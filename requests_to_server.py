@@ -1,12 +1,16 @@
+import asyncio
 import hashlib
 import time
-import requests
 import json
 from enum import Enum
+import aiohttp
 from aiogram import types
 
 import bot_logger
+import cache
 import config
+import http_client
+import spool
 
 
 class RequestStatusCodeException(Exception):
@@ -30,50 +34,61 @@ def generate_token(from_user_id: types.User) -> str:
     ).hexdigest()
 
 
-def send_to_server(
+def build_params(
         code: str,
         data: dict[str],
-        request_method: RequestMethod,
-        url: str,
         from_user_id: types.User
-) -> requests.Response:
-    token = generate_token(from_user_id)
-    params = {
+) -> dict[str]:
+    return {
         'code': code,
-        'token': token,
+        'token': generate_token(from_user_id),
         'data': json.dumps(data)
     }
 
+
+async def send_to_server(
+        code: str,
+        data: dict[str],
+        request_method: RequestMethod,
+        url: str,
+        from_user_id: types.User
+) -> http_client.ServerResponse:
+    params = build_params(code, data, from_user_id)
+
     match request_method:
         case RequestMethod.Post:
             try:
-                bot_logger.debug(f"Sending a post request to {url}. "
-                                 f"Request params: {params}.")
-                response = requests.post(url=url, data=params)
+                bot_logger.debug("Sending a post request to %s. "
+                                 "Request params: %s.",
+                                 url, params)
+                response = await http_client.request("POST", url=url, data=params)
                 response.raise_for_status()
-                bot_logger.debug(f"Received a response for post request to {url}. "
-                                 f"Request params: {params}. "
-                                 f"Response text: {response.text}.")
+                bot_logger.debug("Received a response for post request to %s. "
+                                 "Request params: %s. "
+                                 "Response text: %s.",
+                                 url, params, response.text)
                 return response
-            except requests.exceptions.HTTPError as e:
+            except http_client.ResponseStatusError as e:
                 bot_logger.error(f"Post request was unsuccessful due to HTTPError. Error: {e}.")
                 raise e
-            except requests.exceptions.RequestException as e:
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 bot_logger.error(f"Post request was unsuccessful due to RequestException. Error: {e}.")
                 raise e
         case RequestMethod.Get:
             try:
-                bot_logger.debug(f"Sending a get request to {url}. "
-                                 f"Request params: {params}.")
-                response = requests.get(url=url, data=params)
-                bot_logger.debug(f"Received a response for get request to {url}. "
-                                 f"Request params: {params}. "
-                                 f"Response text: {response.text}.")
+                bot_logger.debug("Sending a get request to %s. "
+                                 "Request params: %s.",
+                                 url, params)
+                response = await http_client.request("GET", url=url, data=params)
+                bot_logger.debug("Received a response for get request to %s. "
+                                 "Request params: %s. "
+                                 "Response text: %s.",
+                                 url, params, response.text)
                 return response
-            except requests.exceptions.HTTPError as e:
+            except http_client.ResponseStatusError as e:
                 bot_logger.error(f"Post request was unsuccessful due to HTTPError. Error: {e}.")
                 raise e
-            except requests.exceptions.RequestException as e:
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 bot_logger.error(f"Post request was unsuccessful due to RequestException. Error: {e}.")
                 raise e
         case _:
@@ -81,13 +96,96 @@ def send_to_server(
             raise Exception
 
 
-def has_access(
+def spool_to_server(
+        dedup_key: str,
+        code: str,
+        data: dict[str],
+        url: str,
+        from_user_id: types.User,
+        reply_chat_id: int | None = None
+) -> None:
+    appended = spool.outbound_spool.append(
+        dedup_key=dedup_key,
+        code=code,
+        url=url,
+        data=json.dumps(data),
+        from_user_id=from_user_id,
+        chat_id=data.get('chat_id'),
+        reply_chat_id=reply_chat_id
+    )
+    if appended:
+        bot_logger.debug("Spooled a %s request to %s with key %s.", code, url, dedup_key)
+    else:
+        bot_logger.debug("Request with key %s is already spooled, skipping it.", dedup_key)
+
+
+async def send_bulk_to_server(
+        items: list[dict[str]],
+        url: str
+) -> http_client.ServerResponse:
+    try:
+        bot_logger.debug("Sending a bulk post request with %s items to %s.", len(items), url)
+        response = await http_client.request("POST", url=url, json_body=items)
+        response.raise_for_status()
+        bot_logger.debug("Received a response for bulk post request to %s. "
+                         "Response text: %s.",
+                         url, response.text)
+        return response
+    except http_client.ResponseStatusError as e:
+        bot_logger.error(f"Bulk post request was unsuccessful due to HTTPError. Error: {e}.")
+        raise e
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        bot_logger.error(f"Bulk post request was unsuccessful due to RequestException. Error: {e}.")
+        raise e
+
+
+# Access decisions keyed by (url, user_id, chat_id), denials expire on their own TTL
+access_cache = cache.TTLCache(
+    max_size=config.ACCESS_CACHE_SIZE,
+    ttl=config.ACCESS_CACHE_GRANTED_TTL
+)
+
+
+def invalidate_access(user_id: int | None = None, chat_id: int | None = None) -> None:
+    for key in access_cache.keys():
+        _, cached_user_id, cached_chat_id = key
+        if (user_id is None or user_id == cached_user_id) and (chat_id is None or chat_id == cached_chat_id):
+            access_cache.pop(key)
+
+
+async def has_access(
         previous_answers: list,
         current_question: int,
         data: str,
         url: str,
         from_user_id: types.User
-) -> requests.Response:
+) -> http_client.ServerResponse:
+    decoded_data = json.loads(data)
+    key = (url, decoded_data['user_id'], decoded_data['chat_id'])
+    response = access_cache.get(key)
+    if response is not None:
+        bot_logger.debug("Using a cached access decision for %s.", key)
+        return response
+
+    response = await fetch_access(previous_answers, current_question, data, url, from_user_id)
+    r = response.json()
+    # Only decisions are cached, not server problems
+    if r['result'] is True:
+        access_cache.set(
+            key,
+            response,
+            ttl=config.ACCESS_CACHE_GRANTED_TTL if r['data'] is True else config.ACCESS_CACHE_DENIED_TTL
+        )
+    return response
+
+
+async def fetch_access(
+        previous_answers: list,
+        current_question: int,
+        data: str,
+        url: str,
+        from_user_id: types.User
+) -> http_client.ServerResponse:
     bot_logger.info(f"Asking server if user has access to /bill.")
 
     params = {
@@ -97,28 +195,72 @@ def has_access(
         'token': generate_token(from_user_id)
     }
     try:
-        bot_logger.debug(f"Sending a bill post request to {url}. "
-                         f"Request params: {params}.")
-        response = requests.post(url=url, data=params)
+        bot_logger.debug("Sending a bill post request to %s. "
+                         "Request params: %s.",
+                         url, params)
+        response = await http_client.request("POST", url=url, data=params)
         response.raise_for_status()
-        bot_logger.debug(f"Received a bill response for post request to {url}. "
-                         f"Request params: {params}. "
-                         f"Response text: {response.text}.")
+        bot_logger.debug("Received a bill response for post request to %s. "
+                         "Request params: %s. "
+                         "Response text: %s.",
+                         url, params, response.text)
         return response
-    except requests.exceptions.HTTPError as e:
+    except http_client.ResponseStatusError as e:
         bot_logger.error(f"Post bill request was unsuccessful due to HTTPError. Error: {e}.")
         raise e
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         bot_logger.error(f"Post bill request was unsuccessful due to RequestException. Error: {e}.")
         raise e
 
 
-def ask_for_question(
+question_cache = cache.SWRCache(
+    max_size=config.QUESTION_CACHE_SIZE,
+    ttl=config.QUESTION_CACHE_TTL,
+    stale_ttl=config.QUESTION_CACHE_STALE_TTL
+)
+
+
+def question_cache_key(
+        data: dict[str],
+        previous_answers: str,
+        current_question: int
+) -> tuple:
+    return (
+        data['chat_id'],
+        int(current_question),
+        json.dumps(json.loads(previous_answers), sort_keys=True, separators=(',', ':'))
+    )
+
+
+def is_question_cacheable(response: http_client.ServerResponse) -> bool:
+    if response.status_code != 200:
+        return False
+    try:
+        r = response.json()
+    except json.JSONDecodeError:
+        return False
+    return not r['error'] and not r.get(config.QUESTION_CACHE_OPT_OUT_FLAG, False)
+
+
+async def ask_for_question(
+        data: dict[str],
+        previous_answers: str,
+        current_question: int,
+        from_user_id: types.User
+) -> http_client.ServerResponse:
+    return await question_cache.get_or_fetch(
+        key=question_cache_key(data, previous_answers, current_question),
+        fetch=lambda: fetch_question(data, previous_answers, current_question, from_user_id),
+        cacheable=is_question_cacheable
+    )
+
+
+async def fetch_question(
         data: dict[str],
         previous_answers: str,
         current_question: int,
         from_user_id: types.User
-) -> requests.Response:
+) -> http_client.ServerResponse:
     params = {
         'data': json.dumps(data),
         'previous_answers': previous_answers,
@@ -127,32 +269,35 @@ def ask_for_question(
     }
     url = config.WEB_URL_BILL_FORM
     try:
-        bot_logger.debug(f"Sending a bill post request to {url}. "
-                         f"Request params: {params}.")
-        response = requests.post(
+        bot_logger.debug("Sending a bill post request to %s. "
+                         "Request params: %s.",
+                         url, params)
+        response = await http_client.request(
+            "POST",
             url=url,
             data=params
         )
         response.raise_for_status()
-        bot_logger.debug(f"Received a response for bill post request to {url}. "
-                         f"Request params: {params}. "
-                         f"Response text: {response.text}.")
+        bot_logger.debug("Received a response for bill post request to %s. "
+                         "Request params: %s. "
+                         "Response text: %s.",
+                         url, params, response.text)
         return response
-    except requests.exceptions.HTTPError as e:
+    except http_client.ResponseStatusError as e:
         bot_logger.error(f"Post request was unsuccessful due to HTTPError. Error: {e}.")
         raise e
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         bot_logger.error(f"Post request was unsuccessful due to RequestException. Error: {e}.")
         raise e
 
 
 def handle_json_error(
         message: types.Message,
-        response: requests.Response
+        response: http_client.ServerResponse
 ) -> dict:
     try:
         r = response.json()
-    except requests.exceptions.JSONDecodeError as e:
+    except json.JSONDecodeError as e:
         bot_logger.error(f"Failed to decode JSON response with text {response.text}: {repr(e)}.")
         raise e
 
@@ -187,12 +332,13 @@ async def send_messages_to_delete(
             'messages': json.dumps(message_ids),
             'token': generate_token(message.from_user.id)
         }
-        print(json.dumps(data, indent=4))
-        response = requests.post(
+        bot_logger.debug("Sending a delete messages post request with data %s.", data)
+        response = await http_client.request(
+            "POST",
             url=config.WEB_URL_DELETE,
             data=data
         )
-        print(response.text)
+        bot_logger.debug("Received a response for delete messages post request. Response text: %s.", response.text)
         if response.status_code != 200:
             await message.bot.send_message(
                 chat_id=message.chat.id,
@@ -211,11 +357,11 @@ async def send_messages_to_delete(
     pass
 
 
-def request_order(
+async def request_order(
         answers: list,
         data: str,
         from_user_id: types.User
-) -> requests.Response:
+) -> http_client.ServerResponse:
     params = {
         f"{previous_answer.name}": previous_answer.value
         for previous_answer in answers
@@ -224,31 +370,34 @@ def request_order(
     params['token'] = generate_token(from_user_id)
     url = config.WEB_URL_ORDER
     try:
-        bot_logger.debug(f"Sending a order post request to {url}. "
-                         f"Request params: {params}.")
-        response = requests.post(
+        bot_logger.debug("Sending a order post request to %s. "
+                         "Request params: %s.",
+                         url, params)
+        response = await http_client.request(
+            "POST",
             url=url,
             data=params
         )
         response.raise_for_status()
-        bot_logger.debug(f"Received a response for order post request to {url}. "
-                         f"Request params: {params}. "
-                         f"Response text: {response.text}.")
+        bot_logger.debug("Received a response for order post request to %s. "
+                         "Request params: %s. "
+                         "Response text: %s.",
+                         url, params, response.text)
         return response
-    except requests.exceptions.HTTPError as e:
+    except http_client.ResponseStatusError as e:
         bot_logger.error(f"Post request was unsuccessful due to HTTPError. Error: {e}.")
         raise e
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         bot_logger.error(f"Post request was unsuccessful due to RequestException. Error: {e}.")
         raise e
 
 
-def request_admin_question(
+async def request_admin_question(
         data: dict[str],
         previous_answers: str,
         current_question: int,
         from_user_id: types.User
-) -> requests.Response:
+) -> http_client.ServerResponse:
     params = {
         'data': json.dumps(data),
         'previous_answers': previous_answers,
@@ -260,31 +409,34 @@ def request_admin_question(
         if answer['name'] == "sellers":
             url += f"?seller_id={answer['value']}"
     try:
-        bot_logger.debug(f"Sending a admin question post request to {url}. "
-                         f"Request params: {params}.")
-        response = requests.get(
+        bot_logger.debug("Sending a admin question post request to %s. "
+                         "Request params: %s.",
+                         url, params)
+        response = await http_client.request(
+            "GET",
             url=url,
             data=params
         )
         response.raise_for_status()
-        bot_logger.debug(f"Received a response for admin question post request to {url}. "
-                         f"Request params: {params}. "
-                         f"Response text: {response.text}.")
+        bot_logger.debug("Received a response for admin question post request to %s. "
+                         "Request params: %s. "
+                         "Response text: %s.",
+                         url, params, response.text)
         return response
-    except requests.exceptions.HTTPError as e:
+    except http_client.ResponseStatusError as e:
         bot_logger.error(f"Post request was unsuccessful due to HTTPError. Error: {e}.")
         raise e
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         bot_logger.error(f"Post request was unsuccessful due to RequestException. Error: {e}.")
         raise e
 
 
-def request_balances(
+async def request_balances(
         data: dict[str],
         # previous_answers: str,
         # current_question: int,
         from_user_id: types.User
-) -> requests.Response:
+) -> http_client.ServerResponse:
     params = {
         'data': json.dumps(data),
     #     'previous_answers': previous_answers,
@@ -295,19 +447,21 @@ def request_balances(
     # for answer in json.loads(previous_answers):
     #     if answer['name'] == "sellers":
     #         url += f"?seller_id={answer['value']}"
-    bot_logger.debug(f"Sending a admin question post request to {url}.")
+    bot_logger.debug("Sending a admin question post request to %s.", url)
     try:
-        response = requests.post(
+        response = await http_client.request(
+            "POST",
             url=url,
             params=params
         )
         response.raise_for_status()
-        bot_logger.debug(f"Received a response for admin question post request to {url}."
-                         f"Response text: {response.text}.")
+        bot_logger.debug("Received a response for admin question post request to %s."
+                         "Response text: %s.",
+                         url, response.text)
         return response
-    except requests.exceptions.HTTPError as e:
+    except http_client.ResponseStatusError as e:
         bot_logger.error(f"Post request was unsuccessful due to HTTPError. Error: {e}.")
         raise e
-    except requests.exceptions.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         bot_logger.error(f"Post request was unsuccessful due to RequestException. Error: {e}.")
         raise e
@@ -0,0 +1,98 @@
+import random
+import time
+from enum import Enum
+
+import aiohttp
+
+import bot_logger
+import config
+import metrics
+
+
+class CircuitOpenError(aiohttp.ClientError):
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Circuit breaker for {name} is open, retrying in {retry_in:.1f} s")
+        self.name = name
+
+
+class CircuitState(Enum):
+    closed = 0
+    half_open = 1
+    open = 2
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CircuitState.closed
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def _set_state(self, state: CircuitState) -> None:
+        if state is not self.state:
+            bot_logger.info(f"Circuit breaker for {self.name} went from {self.state.name} to {state.name}.")
+            self.state = state
+
+    def allow(self) -> None:
+        if self.state is CircuitState.open:
+            retry_in = self._opened_at + self.recovery_timeout - time.monotonic()
+            if retry_in > 0:
+                metrics.backend_rejections.inc((self.name,))
+                raise CircuitOpenError(self.name, retry_in)
+            self._set_state(CircuitState.half_open)
+        if self.state is CircuitState.half_open:
+            # A single request probes the endpoint, the rest keep failing fast until it's done
+            if self._probing:
+                metrics.backend_rejections.inc((self.name,))
+                raise CircuitOpenError(self.name, 0.0)
+            self._probing = True
+
+    def record_success(self) -> None:
+        self._probing = False
+        self.failures = 0
+        self._set_state(CircuitState.closed)
+
+    def record_failure(self) -> None:
+        self._probing = False
+        self.failures += 1
+        if self.state is CircuitState.half_open or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._set_state(CircuitState.open)
+
+    def release(self) -> None:
+        # The request didn't get an answer from the endpoint, so it says nothing about its health
+        self._probing = False
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(
+            name=name,
+            failure_threshold=config.WEB_BREAKER_FAILURE_THRESHOLD,
+            recovery_timeout=config.WEB_BREAKER_RECOVERY_TIMEOUT
+        )
+    return breaker
+
+
+def breaker_states() -> dict[str, CircuitState]:
+    return {name: breaker.state for name, breaker in _breakers.items()}
+
+
+def backoff(attempt: int) -> float:
+    # Full jitter, so clients that failed together don't retry together
+    return random.uniform(0, min(config.WEB_RETRY_MAX_DELAY, config.WEB_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+metrics.Gauge(
+    "bot_backend_circuit_state",
+    "Circuit breaker state per backend endpoint: 0 closed, 1 half-open, 2 open.",
+    lambda: {(name,): state.value for name, state in breaker_states().items()},
+    ("endpoint",)
+)
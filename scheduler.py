@@ -0,0 +1,158 @@
+import asyncio
+from contextvars import ContextVar
+from typing import Awaitable, Callable
+
+from aiogram import Bot, Dispatcher, types
+
+import bot_logger
+import metrics
+
+
+def shard_key(update: types.Update) -> int:
+    for event in (update.message, update.edited_message, update.channel_post, update.edited_channel_post,
+                  update.my_chat_member, update.chat_member, update.chat_join_request):
+        if event is not None:
+            return event.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+# Work handed to a shard by an update of another chat, with the future its caller waits on
+ShardCall = tuple[Callable[[], Awaitable], asyncio.Future]
+
+# The queue of the shard the current task runs in
+_shard: ContextVar[asyncio.Queue | None] = ContextVar("shard", default=None)
+
+
+class UpdateScheduler:
+    # Updates of one chat go to the same shard and are processed one after another, shards run in parallel
+    def __init__(self, dispatcher: Dispatcher, shards: int, max_in_flight: int):
+        self.dispatcher = dispatcher
+        self.queues: list[asyncio.Queue[types.Update | ShardCall]] = [asyncio.Queue() for _ in range(shards)]
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        # Submitters wait for slots one at a time, so updates are queued in the order they arrived
+        self._submit_lock = asyncio.Lock()
+        self._workers: list[asyncio.Task] = []
+        self._listeners: list[Callable[[types.Update, BaseException | None], None]] = []
+        metrics.Gauge(
+            "bot_scheduler_queue_depth",
+            "Updates waiting in each scheduler shard.",
+            lambda: {(str(shard),): queue.qsize() for shard, queue in enumerate(self.queues)},
+            ("shard",)
+        )
+        metrics.Gauge(
+            "bot_scheduler_updates_in_flight",
+            "Updates accepted by the scheduler and not processed yet.",
+            lambda: self.in_flight
+        )
+
+    def add_listener(self, listener: Callable[[types.Update, BaseException | None], None]) -> None:
+        # Called once an update is processed, with the exception it failed with or None
+        self._listeners.append(listener)
+
+    def start(self) -> None:
+        bot_logger.info(f"Starting {len(self.queues)} update scheduler shards, "
+                        f"at most {self.max_in_flight} updates in flight.")
+        self._workers = [asyncio.create_task(self._work(queue)) for queue in self.queues]
+
+    async def submit(self, updates: list[types.Update]) -> None:
+        async with self._submit_lock:
+            for update in updates:
+                # Only waits when the limit is reached, so updates back up at Telegram instead of in memory
+                await self._slots.acquire()
+                self.in_flight += 1
+                self.queues[shard_key(update) % len(self.queues)].put_nowait(update)
+
+    async def run_in_shard(self, chat_id: int, call: Callable[[], Awaitable]):
+        # For updates that change another chat's dialogs, e.g. the admin chat's approvals.
+        # The call waits for that chat's queued updates, and its later ones wait for the call
+        queue = self.queues[chat_id % len(self.queues)]
+        if queue is _shard.get():
+            return await call()
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((call, future))
+        return await future
+
+    async def _work(self, queue: asyncio.Queue[types.Update | ShardCall]) -> None:
+        # Workers may be started outside of polling, e.g. in the webhook's on_startup, where nothing is current yet.
+        # Every update task copies the worker's context, so the handlers see the bot and the dispatcher
+        Bot.set_current(self.dispatcher.bot)
+        Dispatcher.set_current(self.dispatcher)
+        _shard.set(queue)
+        while True:
+            item = await queue.get()
+            try:
+                if isinstance(item, types.Update):
+                    await self._process(item)
+                else:
+                    await self._call(*item)
+            finally:
+                queue.task_done()
+
+    async def _process(self, update: types.Update) -> None:
+        try:
+            # Own task per update, so aiogram's context variables and the deadline's cancellation stay with it
+            task = asyncio.create_task(self.dispatcher.updates_handler.notify(update))
+            await asyncio.wait((task,))
+            if task.cancelled():
+                bot_logger.error(f"Processing of update {update.update_id} was cancelled.")
+                error = asyncio.CancelledError()
+            else:
+                error = task.exception()
+                if error is not None:
+                    bot_logger.error(f"Failed to process update {update.update_id}: {repr(error)}.")
+            for listener in self._listeners:
+                listener(update, error)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    @staticmethod
+    async def _call(call: Callable[[], Awaitable], future: asyncio.Future) -> None:
+        if future.cancelled():
+            return
+        # Finished even when the caller stops waiting, so the chat's dialog isn't left half changed
+        task = asyncio.create_task(call())
+        await asyncio.wait((task,))
+        if future.cancelled():
+            if not task.cancelled() and task.exception() is not None:
+                bot_logger.error(f"Shard call failed after its caller stopped waiting: {repr(task.exception())}.")
+            return
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    async def close(self) -> None:
+        for queue in self.queues:
+            await queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+class ShardedDispatcher(Dispatcher):
+    def __init__(self, *args, shards: int, max_in_flight: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = UpdateScheduler(self, shards, max_in_flight)
+
+    # aiogram sets the current dispatcher through Dispatcher itself, so the subclass must not get a context of its own
+    @classmethod
+    def get_current(cls, no_error=True) -> Dispatcher | None:
+        return Dispatcher.get_current(no_error)
+
+    @classmethod
+    def set_current(cls, value: Dispatcher) -> None:
+        Dispatcher.set_current(value)
+
+    async def process_updates(self, updates: list[types.Update], fast: bool = True) -> list:
+        await self.scheduler.submit(updates)
+        return []
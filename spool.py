@@ -0,0 +1,254 @@
+import argparse
+import sqlite3
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable
+
+import config
+import metrics
+
+
+@dataclass
+class SpoolEntry:
+    id: int
+    code: str
+    url: str
+    data: str
+    from_user_id: int
+    chat_id: int | None
+    reply_chat_id: int | None
+    created_at: float
+
+
+class Spool:
+    def __init__(self, path: str, rate_window: float):
+        self.path = path
+        self.rate_window = rate_window
+        self._listeners: list[Callable[[], None]] = []
+        self._delivered: deque[tuple[float, int]] = deque()
+        self._connection: sqlite3.Connection | None = None
+
+    def open(self) -> None:
+        if self._connection is not None:
+            return
+        self._connection = sqlite3.connect(self.path, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        # Delivered rows are kept for a while, so updates replayed after a restart are not spooled twice
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "dedup_key TEXT NOT NULL UNIQUE, "
+            "code TEXT NOT NULL, "
+            "url TEXT NOT NULL, "
+            "data TEXT NOT NULL, "
+            "from_user_id INTEGER NOT NULL, "
+            "chat_id INTEGER, "
+            "reply_chat_id INTEGER, "
+            "created_at REAL NOT NULL, "
+            "delivered_at REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "last_error TEXT)"
+        )
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(spool)")}
+        if "attempts" not in columns:
+            self._connection.execute("ALTER TABLE spool ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            self._connection.execute("ALTER TABLE spool ADD COLUMN last_error TEXT")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS spool_pending ON spool (id) WHERE delivered_at IS NULL"
+        )
+        # Entries the backend kept rejecting, moved aside so they don't hold back the rest of the spool
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS spool_dead_letter ("
+            "id INTEGER PRIMARY KEY, "
+            "dedup_key TEXT NOT NULL UNIQUE, "
+            "code TEXT NOT NULL, "
+            "url TEXT NOT NULL, "
+            "data TEXT NOT NULL, "
+            "from_user_id INTEGER NOT NULL, "
+            "chat_id INTEGER, "
+            "reply_chat_id INTEGER, "
+            "created_at REAL NOT NULL, "
+            "attempts INTEGER NOT NULL, "
+            "last_error TEXT, "
+            "failed_at REAL NOT NULL)"
+        )
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        self.open()
+        return self._connection
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        self._listeners.append(listener)
+
+    def append(
+            self,
+            dedup_key: str,
+            code: str,
+            url: str,
+            data: str,
+            from_user_id: int,
+            chat_id: int | None = None,
+            reply_chat_id: int | None = None
+    ) -> bool:
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO spool "
+            "(dedup_key, code, url, data, from_user_id, chat_id, reply_chat_id, created_at) "
+            "SELECT ?, ?, ?, ?, ?, ?, ?, ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM spool_dead_letter WHERE dedup_key = ?)",
+            (dedup_key, code, url, data, from_user_id, chat_id, reply_chat_id, time.time(), dedup_key)
+        )
+        appended = cursor.rowcount == 1
+        if appended:
+            for listener in self._listeners:
+                listener()
+        return appended
+
+    def pending(self, limit: int) -> list[SpoolEntry]:
+        rows = self.connection.execute(
+            "SELECT id, code, url, data, from_user_id, chat_id, reply_chat_id, created_at "
+            "FROM spool WHERE delivered_at IS NULL ORDER BY id LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [SpoolEntry(*row) for row in rows]
+
+    def ack(self, ids: list[int]) -> None:
+        if not ids:
+            return
+        now = time.time()
+        self.connection.execute(
+            f"UPDATE spool SET delivered_at = ? WHERE id IN ({', '.join('?' * len(ids))})",
+            (now, *ids)
+        )
+        self._delivered.append((now, len(ids)))
+
+    def fail(self, ids: list[int], error: str, max_attempts: int) -> int:
+        placeholders = ', '.join('?' * len(ids))
+        connection = self.connection
+        connection.execute("BEGIN")
+        try:
+            connection.execute(
+                f"UPDATE spool SET attempts = attempts + 1, last_error = ? WHERE id IN ({placeholders})",
+                (error, *ids)
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO spool_dead_letter "
+                "(id, dedup_key, code, url, data, from_user_id, chat_id, reply_chat_id, created_at, "
+                "attempts, last_error, failed_at) "
+                "SELECT id, dedup_key, code, url, data, from_user_id, chat_id, reply_chat_id, created_at, "
+                f"attempts, last_error, ? FROM spool WHERE id IN ({placeholders}) AND attempts >= ?",
+                (time.time(), *ids, max_attempts)
+            )
+            dead = connection.execute(
+                f"DELETE FROM spool WHERE id IN ({placeholders}) AND attempts >= ?",
+                (*ids, max_attempts)
+            ).rowcount
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return dead
+
+    def replay(self, ids: list[int] | None = None) -> int:
+        # Dead letters go back to the queue under their old ids, so each chat's history keeps its order
+        if ids is not None and not ids:
+            return 0
+        where = f"WHERE id IN ({', '.join('?' * len(ids))})" if ids is not None else ""
+        connection = self.connection
+        connection.execute("BEGIN")
+        try:
+            connection.execute(
+                "INSERT INTO spool "
+                "(id, dedup_key, code, url, data, from_user_id, chat_id, reply_chat_id, created_at) "
+                "SELECT id, dedup_key, code, url, data, from_user_id, chat_id, reply_chat_id, created_at "
+                f"FROM spool_dead_letter {where}",
+                ids or ()
+            )
+            replayed = connection.execute(f"DELETE FROM spool_dead_letter {where}", ids or ()).rowcount
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        for listener in self._listeners:
+            listener()
+        return replayed
+
+    def dead_letter_entries(self) -> list[tuple]:
+        return self.connection.execute(
+            "SELECT id, code, chat_id, attempts, last_error, failed_at FROM spool_dead_letter ORDER BY id"
+        ).fetchall()
+
+    def prune(self, retention: float) -> None:
+        self.connection.execute(
+            "DELETE FROM spool WHERE delivered_at < ?",
+            (time.time() - retention,)
+        )
+
+    def depth(self) -> int:
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM spool WHERE delivered_at IS NULL"
+        ).fetchone()[0]
+
+    def dead_letters(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM spool_dead_letter").fetchone()[0]
+
+    def oldest_age(self) -> float:
+        oldest = self.connection.execute(
+            "SELECT MIN(created_at) FROM spool WHERE delivered_at IS NULL"
+        ).fetchone()[0]
+        return 0.0 if oldest is None else time.time() - oldest
+
+    def drain_rate(self) -> float:
+        horizon = time.time() - self.rate_window
+        while self._delivered and self._delivered[0][0] < horizon:
+            self._delivered.popleft()
+        return sum(count for _, count in self._delivered) / self.rate_window
+
+    def stats(self) -> dict[str]:
+        return {
+            'depth': self.depth(),
+            'drain_rate': self.drain_rate(),
+            'oldest_age': self.oldest_age(),
+            'dead_letters': self.dead_letters()
+        }
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+outbound_spool = Spool(
+    path=config.SPOOL_PATH,
+    rate_window=config.SPOOL_RATE_WINDOW
+)
+metrics.Gauge("bot_spool_depth", "Spooled requests waiting for delivery.", outbound_spool.depth)
+metrics.Gauge(
+    "bot_spool_oldest_age_seconds", "Age of the oldest undelivered spooled request.", outbound_spool.oldest_age
+)
+metrics.Gauge(
+    "bot_spool_drain_rate",
+    "Spooled requests delivered per second over the last SPOOL_RATE_WINDOW seconds.",
+    outbound_spool.drain_rate
+)
+metrics.Gauge(
+    "bot_spool_dead_letters", "Spooled requests given up on after SPOOL_MAX_ATTEMPTS.", outbound_spool.dead_letters
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lists the spool's dead letters and puts them back in the queue.")
+    parser.add_argument("--path", default=config.SPOOL_PATH)
+    parser.add_argument("--replay", nargs="*", type=int, metavar="ID",
+                        help="replay the given dead letters, or all of them without IDs")
+    args = parser.parse_args()
+    outbound_spool = Spool(path=args.path, rate_window=config.SPOOL_RATE_WINDOW)
+    if args.replay is None:
+        for dead_letter in outbound_spool.dead_letter_entries():
+            print(*dead_letter, sep="\t")
+    else:
+        # The running bot's drainer picks them up on its next drain
+        print(f"Replayed {outbound_spool.replay(args.replay or None)} dead letters.")
+    outbound_spool.close()
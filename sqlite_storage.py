@@ -0,0 +1,205 @@
+import asyncio
+import pickle
+import sqlite3
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+import bot_logger
+import tracing
+import util
+
+
+class SQLiteStorage(MemoryStorage):
+    # States live in the in-memory cache of MemoryStorage, changed records are written behind in batches
+
+    def __init__(self, path: str, flush_delay: float, flush_max_pending: int):
+        super().__init__()
+        self.flush_delay = flush_delay
+        self.flush_max_pending = flush_max_pending
+        self._pending: set[tuple[str, str]] = set()
+        self._timer: asyncio.TimerHandle | None = None
+        # Writes run one at a time off the event loop, in the order they were flushed
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-writer")
+        self._writes: set[asyncio.Future] = set()
+
+        self._connection: sqlite3.Connection | None = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            "chat TEXT NOT NULL, "
+            "user TEXT NOT NULL, "
+            "state TEXT, "
+            "data BLOB NOT NULL, "
+            "bucket BLOB NOT NULL, "
+            "PRIMARY KEY (chat, user))"
+        )
+        self._load()
+
+    def _load(self) -> None:
+        for chat, user, state, data, bucket in self._connection.execute(
+                "SELECT chat, user, state, data, bucket FROM fsm"
+        ).fetchall():
+            try:
+                record = {
+                    'state': state,
+                    'data': self.loads(data),
+                    'bucket': self.loads(bucket)
+                }
+            except Exception as e:
+                bot_logger.error(f"Dropping unreadable FSM record of chat {chat}, user {user}: {repr(e)}.")
+                self._connection.execute("DELETE FROM fsm WHERE chat = ? AND user = ?", (chat, user))
+                continue
+            self.data.setdefault(chat, {})[user] = record
+        bot_logger.info(f"Loaded {sum(len(users) for users in self.data.values())} FSM records from storage.")
+
+    @staticmethod
+    def dumps(value: dict) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(value: bytes) -> dict:
+        # Records written before StateData got its codec are still readable
+        return util.unpickle(value)
+
+    def _mark(self, chat, user) -> None:
+        self._pending.add(tuple(map(str, self.check_address(chat=chat, user=user))))
+        if len(self._pending) >= self.flush_max_pending:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_delay, self.flush)
+
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, set()
+
+        upserts = []
+        deletes = []
+        for chat, user in pending:
+            record = self.data.get(chat, {}).get(user)
+            if record is None:
+                deletes.append((chat, user))
+            else:
+                upserts.append((
+                    chat,
+                    user,
+                    record['state'],
+                    self.dumps(record['data']),
+                    self.dumps(record['bucket'])
+                ))
+
+        write = asyncio.get_running_loop().run_in_executor(self._writer, self._write, deletes, upserts)
+        self._writes.add(write)
+        write.add_done_callback(lambda _: self._on_written(write, pending))
+
+    def _write(self, deletes: list[tuple[str, str]], upserts: list[tuple]) -> None:
+        self._connection.execute("BEGIN")
+        try:
+            self._connection.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", deletes)
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO fsm (chat, user, state, data, bucket) VALUES (?, ?, ?, ?, ?)",
+                upserts
+            )
+            self._connection.execute("COMMIT")
+        except Exception:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _on_written(self, write: asyncio.Future, pending: set[tuple[str, str]]) -> None:
+        self._writes.discard(write)
+        if write.cancelled() or write.exception() is None:
+            return
+        # Written again with whatever the records hold by the next flush
+        self._pending |= pending
+        bot_logger.error(f"Failed to flush {len(pending)} FSM records: {repr(write.exception())}.")
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        with tracing.span("storage get_state"):
+            state = await super().get_state(chat=chat, user=user, default=default)
+            # Reading creates an empty record for anyone without a dialog, it's dropped like a reset one
+            self._cleanup(chat, user)
+            return state
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        with tracing.span("storage get_data"):
+            data = await super().get_data(chat=chat, user=user, default=default)
+            self._cleanup(chat, user)
+            return data
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        with tracing.span("storage set_state"):
+            await super().set_state(chat=chat, user=user, state=state)
+            self._mark(chat, user)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        with tracing.span("storage set_data"):
+            await super().set_data(chat=chat, user=user, data=data)
+            self._mark(chat, user)
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        with tracing.span("storage update_data"):
+            await super().update_data(chat=chat, user=user, data=data, **kwargs)
+            self._mark(chat, user)
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        await super().set_bucket(chat=chat, user=user, bucket=bucket)
+        self._mark(chat, user)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        await super().update_bucket(chat=chat, user=user, bucket=bucket, **kwargs)
+        self._mark(chat, user)
+
+    async def update_record(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            data: typing.Dict = None,
+                            state: typing.AnyStr = None,
+                            set_state: bool = True):
+        with tracing.span("storage update_record"):
+            chat, user = self.resolve_address(chat=chat, user=user)
+            record = self.data[chat][user]
+            if data:
+                record['data'].update(data)
+            if set_state:
+                record['state'] = self.resolve_state(state)
+            self._mark(chat, user)
+
+    async def close(self):
+        if self._connection is None:
+            return
+        self.flush()
+        if self._writes:
+            await asyncio.wait(self._writes)
+        self._writer.shutdown()
+        self._connection.close()
+        self._connection = None
+        self.data.clear()
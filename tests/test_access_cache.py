@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+import cache
+import config
+import http_client
+import requests_to_server
+
+
+@pytest.fixture
+def decisions(monkeypatch):
+    # Answers of the access endpoint by user id, and how many times it was asked
+    answers = {}
+    asked = []
+
+    async def fetch_access(previous_answers, current_question, data, url, from_user_id):
+        user_id = json.loads(data)['user_id']
+        asked.append(user_id)
+        return http_client.ServerResponse(url=url, status_code=200, text=json.dumps(answers[user_id]))
+
+    monkeypatch.setattr(requests_to_server, "fetch_access", fetch_access)
+    monkeypatch.setattr(requests_to_server, "access_cache", cache.TTLCache(
+        max_size=config.ACCESS_CACHE_SIZE,
+        ttl=config.ACCESS_CACHE_GRANTED_TTL
+    ))
+    return answers, asked
+
+
+def ask(loop, user_id: int, chat_id: int = -1) -> dict:
+    response = loop.run_until_complete(requests_to_server.has_access(
+        previous_answers=[],
+        current_question=1,
+        data=json.dumps({'user_id': user_id, 'chat_id': chat_id}),
+        url=config.WEB_URL_IS_ACCESS,
+        from_user_id=user_id
+    ))
+    return response.json()
+
+
+def test_decisions_are_cached_and_server_problems_are_not(loop, decisions):
+    answers, asked = decisions
+    answers.update({1: {'result': True, 'data': True}, 2: {'result': True, 'data': False}, 3: {'result': False}})
+
+    for _ in range(2):
+        assert ask(loop, 1)['data'] is True
+        assert ask(loop, 2)['data'] is False
+        assert ask(loop, 3)['result'] is False
+
+    assert asked == [1, 2, 3, 3]
+    # Denials are asked again sooner than grants
+    key = (config.WEB_URL_IS_ACCESS, 2, -1)
+    denied_expires_at, _ = requests_to_server.access_cache._data[key]
+    granted_expires_at, _ = requests_to_server.access_cache._data[(config.WEB_URL_IS_ACCESS, 1, -1)]
+    assert granted_expires_at - denied_expires_at == pytest.approx(
+        config.ACCESS_CACHE_GRANTED_TTL - config.ACCESS_CACHE_DENIED_TTL, abs=1
+    )
+
+
+def test_chat_decisions_are_dropped_when_the_bot_joins_it_again(loop, decisions):
+    answers, asked = decisions
+    answers.update({1: {'result': True, 'data': False}})
+
+    ask(loop, 1, chat_id=-1)
+    ask(loop, 1, chat_id=-2)
+    requests_to_server.invalidate_access(chat_id=-1)
+    ask(loop, 1, chat_id=-1)
+    ask(loop, 1, chat_id=-2)
+
+    assert asked == [1, 1, 1]
@@ -0,0 +1,109 @@
+import json
+import time
+
+import backend_stub
+import benchmark
+import config
+import util
+
+ADMIN_ID = 1
+
+
+def request_bill(
+        loop, running_bot, backend, process, updates, chat_id: int, user_id: int, confirm: bool = True
+) -> None:
+    dispatcher, _ = running_bot
+
+    def message_id() -> int:
+        data = loop.run_until_complete(dispatcher.storage.get_data(chat=chat_id, user=user_id))
+        return data['state_data'].message_id
+
+    process(updates.message(
+        chat_id, user_id, text="/bill", entities=[{'type': "bot_command", 'offset': 0, 'length': 5}]
+    ))
+    for number, question in enumerate(backend.questions, start=1):
+        match question['type']:
+            case "list":
+                process(updates.callback(
+                    chat_id, user_id, message_id(), util.answer_callback_data(number, question['data'][0]['id'])
+                ))
+            case "float":
+                process(updates.message(chat_id, user_id, text="1500"))
+            case _:
+                process(updates.message(chat_id, user_id, text="Оплата по договору"))
+    if confirm:
+        process(updates.callback(chat_id, user_id, message_id(), "yes"))
+
+
+def open_dialogs(running_bot, chat_id: int) -> int:
+    dispatcher, _ = running_bot
+    return len(dispatcher.storage.data.get(str(chat_id), {}))
+
+
+def test_approval_finishes_the_users_dialog(loop, running_bot, backend, process):
+    updates = benchmark.UpdateFactory()
+    chat_id, user_id = -1010, 10
+    request_bill(loop, running_bot, backend, process, updates, chat_id, user_id)
+    orders = backend.orders[ADMIN_ID]
+
+    process(updates.callback(config.ADMIN_CHAT_ID, ADMIN_ID, 1, f"admin/{chat_id}/{user_id}/1"))
+    assert backend.orders[ADMIN_ID] == orders + 1
+    assert open_dialogs(running_bot, chat_id) == 0
+
+
+def test_legacy_button_resolves_the_only_waiting_dialog(loop, running_bot, backend, process):
+    updates = benchmark.UpdateFactory()
+    chat_id, user_id = -1011, 11
+    request_bill(loop, running_bot, backend, process, updates, chat_id, user_id)
+    orders = backend.orders[ADMIN_ID]
+
+    process(updates.callback(config.ADMIN_CHAT_ID, ADMIN_ID, 1, f"admin/{chat_id}/1"))
+    assert backend.orders[ADMIN_ID] == orders + 1
+    assert open_dialogs(running_bot, chat_id) == 0
+
+
+def test_legacy_button_of_an_ambiguous_chat_is_rejected(loop, running_bot, backend, process):
+    _, bot = running_bot
+    updates = benchmark.UpdateFactory()
+    chat_id = -1012
+    for user_id in (12, 13):
+        request_bill(loop, running_bot, backend, process, updates, chat_id, user_id)
+    orders = backend.orders[ADMIN_ID]
+    bot.calls.clear()
+
+    process(updates.callback(config.ADMIN_CHAT_ID, ADMIN_ID, 1, f"admin/{chat_id}/1"))
+    assert backend.orders[ADMIN_ID] == orders
+    assert open_dialogs(running_bot, chat_id) == 2
+    assert bot.calls == {'answerCallbackQuery': 1}
+
+
+def test_confirmation_asks_for_accounts_and_balances_at_once(loop, running_bot, backend, process, monkeypatch):
+    dispatcher, bot = running_bot
+    updates = benchmark.UpdateFactory()
+    chat_id, user_id = -1013, 14
+    request_bill(loop, running_bot, backend, process, updates, chat_id, user_id, confirm=False)
+    slow = backend_stub.EndpointBehaviour(latency=backend_stub.Latency(ms=200))
+    monkeypatch.setitem(backend.settings.endpoints, "/bank_acoounts/", slow)
+    monkeypatch.setitem(backend.settings.endpoints, "/bank_account/current_balances", slow)
+    sent = []
+    request = bot._request_within_budget
+
+    async def recording(method, data=None, *args, **kwargs):
+        if method == "sendMessage" and int(data['chat_id']) == config.ADMIN_CHAT_ID:
+            sent.append(data['reply_markup'])
+        return await request(method, data, *args, **kwargs)
+
+    monkeypatch.setattr(bot, "_request_within_budget", recording)
+    message_id = loop.run_until_complete(
+        dispatcher.storage.get_data(chat=chat_id, user=user_id)
+    )['state_data'].message_id
+
+    start = time.perf_counter()
+    process(updates.callback(chat_id, user_id, message_id, "yes"))
+    # Two requests of 0.2 s each, made together
+    assert 0.2 <= time.perf_counter() - start < 0.35
+
+    buttons = [row[0]['text'] for row in json.loads(sent[0])['inline_keyboard']]
+    # Every account of the admin question carries its balance
+    assert all(text.endswith(" : 100000.0") for text in buttons[:-1])
+    assert len(buttons) == len(backend.bank_accounts) + 1
@@ -0,0 +1,56 @@
+import json
+import random
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import backend_stub
+
+
+def test_settings_are_read_from_json(tmp_path):
+    path = tmp_path / "stub.json"
+    path.write_text(json.dumps({
+        'default': {'latency': {'distribution': "uniform", 'ms': 20, 'spread': 5}},
+        'endpoints': {'/question': {'error_rate': 0.5, 'error_status': 503}},
+        'sellers': 2
+    }))
+
+    settings = backend_stub.StubSettings.load(str(path))
+    assert settings.behaviour("/order").latency == backend_stub.Latency("uniform", 20, 5)
+    assert settings.behaviour("/question").error_status == 503
+    assert settings.behaviour("/question").latency.ms == 0
+    assert settings.sellers == 2
+
+    with pytest.raises(ValueError, match="sellerz"):
+        backend_stub.StubSettings.from_dict({'sellerz': 2})
+
+
+@pytest.mark.parametrize("distribution", ["fixed", "uniform", "normal", "lognormal", "exponential"])
+def test_latency_is_sampled_in_seconds(distribution):
+    latency = backend_stub.Latency(distribution, ms=100, spread=10 if distribution != "lognormal" else 0.1)
+    samples = [latency.sample(random.Random(seed)) for seed in range(200)]
+
+    assert all(sample >= 0 for sample in samples)
+    assert sum(samples) / len(samples) == pytest.approx(0.1, rel=0.2)
+
+
+def test_injected_errors_are_answered_and_counted(loop):
+    stub = backend_stub.BackendStub(backend_stub.StubSettings(
+        endpoints={'/order': backend_stub.EndpointBehaviour(error_rate=1.0, error_status=502)},
+        seed=1
+    ))
+
+    async def scenario() -> tuple[list[int], dict[str, int]]:
+        async with TestClient(TestServer(stub.make_app())) as client:
+            statuses = []
+            for path in ("/order", "/bill/is_access"):
+                response = await client.post(path, data={'data': json.dumps({'user_id': 1})})
+                statuses.append(response.status)
+            stats = await (await client.get("/stats")).json()
+            return statuses, stats
+
+    statuses, stats = loop.run_until_complete(scenario())
+    assert statuses == [502, 200]
+    assert stats == {"/order 502": 1, "/bill/is_access 200": 1}
+    # The failed order never reached the handler
+    assert stub.orders[1] == 0
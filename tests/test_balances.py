@@ -0,0 +1,35 @@
+import asyncio
+from types import SimpleNamespace
+
+import balances
+import requests_to_server
+
+
+def test_order_invalidates_only_its_chat(loop, monkeypatch):
+    balance_cache = balances.BalanceCache(refresh_interval=60, idle_ttl=60)
+    fetched = []
+    released = asyncio.Event()
+    released.set()
+
+    async def request_balances(data, from_user_id):
+        fetched.append((data['chat_id'], data['user_id']))
+        await released.wait()
+        return SimpleNamespace(json=lambda: {'data': [{'bill': 1, 'current_sum': len(fetched)}]})
+
+    monkeypatch.setattr(requests_to_server, "request_balances", request_balances)
+
+    async def run():
+        for key in [(1, 10), (1, 11), (2, 20)]:
+            await balance_cache.get_or_refresh(*key)
+        released.clear()
+        in_flight = asyncio.ensure_future(balance_cache.refresh((1, 10)))
+        await asyncio.sleep(0)
+        balance_cache.invalidate(1)
+        released.set()
+        await in_flight
+
+    loop.run_until_complete(run())
+    assert balance_cache.get(2, 20) is not None
+    # The refresh started before the order isn't kept, the next read fetches again
+    assert balance_cache.get(1, 10) is None
+    assert balance_cache.get(1, 11) is None
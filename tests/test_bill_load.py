@@ -0,0 +1,31 @@
+import argparse
+
+import pytest
+
+import bill_load
+
+
+def load_args(**overrides) -> argparse.Namespace:
+    args = {
+        'users': 6, 'chats': 2, 'dialogs_per_user': 2, 'ramp_up': 0.0, 'think_time': 0.0, 'option_skew': 1.0,
+        'abandon_rate': 0.0, 'cancel_rate': 0.0, 'reject_rate': 0.0, 'concurrency': 100, 'sample_interval': 1.0,
+        'external_backend': False, 'seed': 1
+    }
+    return argparse.Namespace(**{**args, **overrides})
+
+
+@pytest.mark.parametrize("overrides, outcome", [
+    ({}, "completed"),
+    ({'cancel_rate': 1.0}, "cancelled"),
+    ({'reject_rate': 1.0}, "rejected"),
+    ({'abandon_rate': 1.0}, "abandoned")
+])
+def test_every_dialog_ends_with_its_outcome(loop, running_bot, backend, overrides, outcome):
+    dispatcher, _ = running_bot
+    load = bill_load.BillLoad(dispatcher, backend, load_args(**overrides))
+
+    loop.run_until_complete(load.run())
+
+    assert load.outcomes == {outcome: 12}
+    assert not load.errors
+    assert len(load.dialog_seconds) == (12 if outcome == "completed" else 0)
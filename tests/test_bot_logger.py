@@ -0,0 +1,14 @@
+import logging
+
+import bot_logger
+
+
+def test_message_is_built_with_the_arguments_at_the_call():
+    answers = ["sellers"]
+    record = logging.LogRecord("BotLog", logging.DEBUG, __file__, 1, "answers=%r", (answers,), None)
+    record = bot_logger.queue_handler.prepare(record)
+    # Changed on the event loop before the listener thread writes the record
+    answers.append("legals")
+    assert record.getMessage() == "answers=['sellers']"
+    assert record.args is None
+
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+import cache
+
+
+def test_failing_cacheable_fails_shared_callers(loop):
+    swr_cache = cache.SWRCache(max_size=10, ttl=60, stale_ttl=60)
+    released = asyncio.Event()
+
+    async def fetch():
+        await released.wait()
+        return {'data': []}
+
+    def cacheable(value):
+        raise KeyError("result")
+
+    async def run():
+        callers = [asyncio.ensure_future(swr_cache.get_or_fetch("key", fetch, cacheable)) for _ in range(3)]
+        await asyncio.sleep(0)
+        released.set()
+        return await asyncio.wait_for(asyncio.gather(*callers, return_exceptions=True), 1)
+
+    results = loop.run_until_complete(run())
+    assert all(isinstance(result, KeyError) for result in results)
+    assert not swr_cache._inflight
+
+
+def test_cancelled_fetch_is_retried_by_shared_callers(loop):
+    swr_cache = cache.SWRCache(max_size=10, ttl=60, stale_ttl=60)
+
+    async def run():
+        started = asyncio.Event()
+
+        async def slow_fetch():
+            started.set()
+            await asyncio.sleep(10)
+
+        async def fetch():
+            return "value"
+
+        first = asyncio.ensure_future(swr_cache.get_or_fetch("key", slow_fetch, lambda value: True))
+        await started.wait()
+        second = asyncio.ensure_future(swr_cache.get_or_fetch("key", fetch, lambda value: True))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await asyncio.wait_for(second, 1)
+
+    assert loop.run_until_complete(run()) == "value"
@@ -0,0 +1,78 @@
+import benchmark
+import util
+
+
+def test_stale_answer_is_not_recorded_for_next_question(loop, running_bot, process):
+    dispatcher, bot = running_bot
+    updates = benchmark.UpdateFactory()
+    chat_id, user_id = -1002, 2
+
+    process(updates.message(
+        chat_id, user_id, text="/bill", entities=[{'type': "bot_command", 'offset': 0, 'length': 5}]
+    ))
+    state_data = loop.run_until_complete(dispatcher.storage.get_data(chat=chat_id, user=user_id))['state_data']
+    # Seller 5 tapped twice, the second tap arrives once the legal entities, numbered 1 to 3, are asked
+    tap = util.answer_callback_data(state_data.current_question, 5)
+    process(
+        updates.callback(chat_id, user_id, state_data.message_id, tap),
+        updates.callback(chat_id, user_id, state_data.message_id, tap)
+    )
+
+    state_data = loop.run_until_complete(dispatcher.storage.get_data(chat=chat_id, user=user_id))['state_data']
+    assert state_data.question_name == "legals"
+    assert [answer.name for answer in state_data.previous_answers] == ["sellers"]
+    assert len(state_data.answers_dict) == 1
+
+
+def test_list_answer_edits_the_message_once(loop, running_bot, process):
+    dispatcher, bot = running_bot
+    updates = benchmark.UpdateFactory()
+    chat_id, user_id = -1003, 3
+
+    process(updates.message(
+        chat_id, user_id, text="/bill", entities=[{'type': "bot_command", 'offset': 0, 'length': 5}]
+    ))
+    state_data = loop.run_until_complete(dispatcher.storage.get_data(chat=chat_id, user=user_id))['state_data']
+    bot.calls.clear()
+    process(updates.callback(
+        chat_id, user_id, state_data.message_id, util.answer_callback_data(state_data.current_question, 5)
+    ))
+
+    # Clearing the old buttons is merged into the edit that asks the next question
+    assert bot.calls == {'answerCallbackQuery': 1, 'editMessageText': 1}
+
+
+def test_answer_and_next_question_are_stored_in_one_write(loop, running_bot, process, monkeypatch):
+    dispatcher, bot = running_bot
+    updates = benchmark.UpdateFactory()
+    chat_id, user_id = -1004, 4
+    writes = []
+
+    def counting(name):
+        write = getattr(dispatcher.storage, name)
+
+        async def counted(**kwargs):
+            writes.append(name)
+            return await write(**kwargs)
+
+        return counted
+
+    for name in ("update_record", "set_data", "update_data", "set_state"):
+        monkeypatch.setattr(dispatcher.storage, name, counting(name))
+
+    process(updates.message(
+        chat_id, user_id, text="/bill", entities=[{'type': "bot_command", 'offset': 0, 'length': 5}]
+    ))
+    assert writes == ["update_record"]
+
+    state_data = loop.run_until_complete(dispatcher.storage.get_data(chat=chat_id, user=user_id))['state_data']
+    writes.clear()
+    process(updates.callback(
+        chat_id, user_id, state_data.message_id, util.answer_callback_data(state_data.current_question, 5)
+    ))
+
+    assert writes == ["update_record"]
+    state_data = loop.run_until_complete(dispatcher.storage.get_data(chat=chat_id, user=user_id))['state_data']
+    assert state_data.question_name == "legals"
+    assert state_data.current_question == 2
+    assert [answer.name for answer in state_data.previous_answers] == ["sellers"]
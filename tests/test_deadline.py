@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+import backend_stub
+import benchmark
+import config
+import deadline
+
+
+def test_calls_get_what_is_left_of_the_budget(loop):
+    async def run():
+        deadline.start(1.0, grace=1.0)
+        try:
+            assert deadline.timeout(10.0) <= 1.0
+            assert deadline.timeout(0.2) == 0.2
+            with pytest.raises(deadline.DeadlineExceeded):
+                deadline.timeout(10.0, reserve=1.0)
+            deadline.enter_grace()
+            # The fallback message gets the grace period on top
+            assert deadline.timeout(10.0, reserve=1.0) > 0.5
+        finally:
+            deadline.finish()
+        assert deadline.remaining() is None
+
+    loop.run_until_complete(run())
+
+
+def test_update_is_cancelled_after_the_grace_period(loop):
+    async def update(seconds: float):
+        deadline.start(0.05, grace=0.05)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            deadline.finish()
+
+    async def run():
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.create_task(update(1.0))
+        # A finished update's timer is cancelled with it
+        fast = asyncio.create_task(update(0.0))
+        await fast
+        await asyncio.sleep(0.15)
+        assert not fast.cancelled()
+
+    loop.run_until_complete(run())
+
+
+def test_slow_backend_ends_the_dialog_with_an_error_message(loop, running_bot, backend, process, monkeypatch):
+    dispatcher, bot = running_bot
+    updates = benchmark.UpdateFactory()
+    chat_id, user_id = -1021, 21
+    middleware = next(
+        middleware for middleware in dispatcher.middleware.applications
+        if isinstance(middleware, deadline.DeadlineMiddleware)
+    )
+    monkeypatch.setattr(middleware, "seconds", 0.3)
+    monkeypatch.setattr(middleware, "grace", 0.5)
+    monkeypatch.setattr(config, "UPDATE_TELEGRAM_RESERVE", 0.1)
+    monkeypatch.setitem(backend.settings.endpoints, "/question", backend_stub.EndpointBehaviour(
+        latency=backend_stub.Latency(ms=600)
+    ))
+    sent = []
+    request = bot._request_within_budget
+
+    async def recording(method, data=None, *args, **kwargs):
+        if method == "sendMessage":
+            sent.append(data['text'])
+        return await request(method, data, *args, **kwargs)
+
+    monkeypatch.setattr(bot, "_request_within_budget", recording)
+
+    process(updates.message(
+        chat_id, user_id, text="/bill", entities=[{'type': "bot_command", 'offset': 0, 'length': 5}]
+    ))
+
+    assert sent == ["Произошла проблема на сервере. Попробуйте еще раз."]
+    assert loop.run_until_complete(dispatcher.storage.get_state(chat=chat_id, user=user_id)) is None
+    # Lets the stub finish the abandoned request before the next test
+    loop.run_until_complete(asyncio.sleep(0.6))
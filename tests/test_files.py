@@ -0,0 +1,56 @@
+import asyncio
+
+from aiogram import Bot
+
+import benchmark
+import cache
+import config
+import fake_telegram
+import util
+
+
+def photo(file_id: str, width: int) -> dict:
+    return {'file_id': file_id, 'file_unique_id': file_id, 'width': width, 'height': width}
+
+
+def test_files_are_resolved_concurrently_and_cached(loop, monkeypatch):
+    bot = fake_telegram.FakeBot(token=config.BOT_TOKEN, latency=0.1)
+    monkeypatch.setattr(util, "file_url_cache", cache.TTLCache(max_size=10, ttl=60))
+    monkeypatch.setattr(config, "FILES_PHOTO_LARGEST_ONLY", False)
+    message = benchmark.UpdateFactory().message(
+        -1, 1, caption="Фото",
+        photo=[photo("small", 90), photo("medium", 320), photo("large", 1280)],
+        document={'file_id': "report", 'file_unique_id': "report", 'file_name': "report.pdf"}
+    ).message
+
+    async def resolve() -> tuple[dict, float]:
+        Bot.set_current(bot)
+        start = asyncio.get_running_loop().time()
+        files = await util.get_files(message)
+        return files, asyncio.get_running_loop().time() - start
+
+    files, elapsed = loop.run_until_complete(resolve())
+    url = f"https://api.telegram.org/file/bot{config.BOT_TOKEN}/photos/"
+    assert files['photo'] == [f"{url}small.jpg", f"{url}medium.jpg", f"{url}large.jpg"]
+    assert files['document'] == f"{url}report.jpg"
+    # Four getFile calls at 0.1 s each, made at the same time
+    assert bot.calls['getFile'] == 4
+    assert elapsed < 0.3
+
+    assert loop.run_until_complete(resolve())[0] == files
+    assert bot.calls['getFile'] == 4
+
+
+def test_only_the_largest_photo_is_resolved_when_configured(loop, monkeypatch):
+    bot = fake_telegram.FakeBot(token=config.BOT_TOKEN)
+    monkeypatch.setattr(util, "file_url_cache", cache.TTLCache(max_size=10, ttl=60))
+    monkeypatch.setattr(config, "FILES_PHOTO_LARGEST_ONLY", True)
+    message = benchmark.UpdateFactory().message(-1, 1, photo=[photo("small", 90), photo("large", 1280)]).message
+
+    async def resolve() -> dict:
+        Bot.set_current(bot)
+        return await util.get_files(message)
+
+    files = loop.run_until_complete(resolve())
+    assert files['photo'] == [f"https://api.telegram.org/file/bot{config.BOT_TOKEN}/photos/large.jpg"]
+    assert bot.calls['getFile'] == 1
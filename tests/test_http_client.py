@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import http_client
+import resilience
+
+
+def test_probe_is_released_on_unexpected_error(monkeypatch):
+    async def undecodable(*args, **kwargs):
+        raise UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+
+    monkeypatch.setattr(http_client, "_send", undecodable)
+    breaker = resilience.get_breaker("/probe")
+    breaker.state = resilience.CircuitState.half_open
+
+    with pytest.raises(UnicodeDecodeError):
+        asyncio.run(http_client.request("POST", "http://backend/probe"))
+    # Otherwise the endpoint would reject every request until the bot restarts
+    breaker.allow()
+
+
+def respond_with(monkeypatch, statuses: list[int]) -> list[str]:
+    sent = []
+
+    async def send(method, url, *args):
+        sent.append(url)
+        return http_client.ServerResponse(url=url, status_code=statuses[len(sent) - 1], text="{}")
+
+    monkeypatch.setattr(http_client, "_send", send)
+    monkeypatch.setattr(resilience, "backoff", lambda attempt: 0)
+    return sent
+
+
+def test_idempotent_endpoint_is_retried_after_server_error(monkeypatch):
+    sent = respond_with(monkeypatch, [502, 503, 200])
+
+    response = asyncio.run(http_client.request("POST", "http://backend/question"))
+    assert response.status_code == 200
+    assert len(sent) == 3
+    assert resilience.get_breaker("/question").state is resilience.CircuitState.closed
+
+
+def test_other_endpoints_are_not_retried(monkeypatch):
+    sent = respond_with(monkeypatch, [500, 200])
+
+    response = asyncio.run(http_client.request("POST", "http://backend/order"))
+    # An order isn't idempotent, repeating it could bill twice
+    assert response.status_code == 500
+    assert len(sent) == 1
+
+
+def test_breaker_opens_and_lets_a_single_probe_through(monkeypatch):
+    threshold = resilience.get_breaker("/is_admin").failure_threshold
+    sent = respond_with(monkeypatch, [500] * threshold + [200])
+    breaker = resilience.get_breaker("/is_admin")
+
+    for _ in range(threshold):
+        asyncio.run(http_client.request("POST", "http://backend/is_admin"))
+    assert breaker.state is resilience.CircuitState.open
+    with pytest.raises(resilience.CircuitOpenError):
+        asyncio.run(http_client.request("POST", "http://backend/is_admin"))
+    assert len(sent) == threshold
+
+    monkeypatch.setattr(breaker, "_opened_at", breaker._opened_at - breaker.recovery_timeout)
+    breaker.allow()
+    assert breaker.state is resilience.CircuitState.half_open
+    # While the probe is out every other request fails fast
+    with pytest.raises(resilience.CircuitOpenError):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.state is resilience.CircuitState.closed
+    assert asyncio.run(http_client.request("POST", "http://backend/is_admin")).status_code == 200
@@ -0,0 +1,101 @@
+import asyncio
+import json
+
+import aiohttp
+
+import benchmark
+import http_client
+import ingestion
+import requests_to_server
+import spool
+
+
+def make_drainer(tmp_path, max_attempts: int = 2) -> ingestion.SpoolDrainer:
+    outbound_spool = spool.Spool(path=str(tmp_path / "spool.sqlite3"), rate_window=60)
+    for index in range(3):
+        outbound_spool.append(dedup_key=str(index), code="addMessage", url=ingestion.config.WEB_URL_MESSAGE,
+                              data=f'{{"chat_id": {-1000 - index}}}', from_user_id=1, chat_id=-1000 - index)
+    return ingestion.SpoolDrainer(outbound_spool, batch_size=200, max_delay=1, concurrency=4, retry_delay=1,
+                                  max_retry_delay=1, max_attempts=max_attempts,
+                                  prune_interval=60)
+
+
+def test_outage_keeps_entries_queued(loop, tmp_path, monkeypatch):
+    async def unavailable(**kwargs):
+        raise aiohttp.ClientConnectionError("Connection refused")
+
+    monkeypatch.setattr(requests_to_server, "send_bulk_to_server", unavailable)
+    drainer = make_drainer(tmp_path)
+    for _ in range(10):
+        assert not loop.run_until_complete(drainer.drain())
+    assert drainer.spool.stats()['depth'] == 3
+    assert drainer.spool.stats()['dead_letters'] == 0
+    drainer.spool.close()
+
+
+def test_rejected_entries_are_dead_lettered_and_replayed(loop, tmp_path, monkeypatch):
+    async def rejecting(**kwargs):
+        raise http_client.ResponseStatusError(http_client.ServerResponse("http://backend/add_bulk", 422, "{}"))
+
+    monkeypatch.setattr(requests_to_server, "send_bulk_to_server", rejecting)
+    monkeypatch.setattr(requests_to_server, "send_to_server", rejecting)
+    drainer = make_drainer(tmp_path)
+    for _ in range(2):
+        assert not loop.run_until_complete(drainer.drain())
+    assert drainer.spool.stats()['depth'] == 0
+    assert drainer.spool.stats()['dead_letters'] == 3
+
+    assert drainer.spool.replay() == 3
+    assert [entry.id for entry in drainer.spool.pending(10)] == [1, 2, 3]
+    assert drainer.spool.stats()['dead_letters'] == 0
+    drainer.spool.close()
+
+
+def test_messages_of_all_chats_go_out_in_one_bulk_request(loop, tmp_path, monkeypatch):
+    requests = []
+
+    async def accepting(**kwargs):
+        requests.append(kwargs['url'])
+        return http_client.ServerResponse(kwargs['url'], 200, '{"error": 0, "data": "ok"}')
+
+    monkeypatch.setattr(requests_to_server, "send_bulk_to_server", accepting)
+    monkeypatch.setattr(requests_to_server, "send_to_server", accepting)
+    drainer = make_drainer(tmp_path)
+    assert loop.run_until_complete(drainer.drain())
+    assert requests == [ingestion.config.WEB_URL_MESSAGE_BULK]
+
+    # A command splits the run, the messages around it keep their order
+    drainer.spool.append(dedup_key="command", code="addCommand", url=ingestion.config.WEB_URL_COMMAND,
+                         data='{"chat_id": -1000}', from_user_id=1, chat_id=-1000)
+    drainer.spool.append(dedup_key="after", code="addMessage", url=ingestion.config.WEB_URL_MESSAGE,
+                         data='{"chat_id": -1001}', from_user_id=1, chat_id=-1001)
+    requests.clear()
+    assert loop.run_until_complete(drainer.drain())
+    assert requests == [ingestion.config.WEB_URL_COMMAND, ingestion.config.WEB_URL_MESSAGE_BULK]
+    drainer.spool.close()
+
+
+def test_chat_messages_reach_the_backend_in_bulk(loop, running_bot, backend, process, monkeypatch):
+    updates = benchmark.UpdateFactory()
+    sent = []
+    send_bulk_to_server = requests_to_server.send_bulk_to_server
+
+    async def recording(items, url):
+        sent.append([json.loads(item['data'])['text'] for item in items])
+        return await send_bulk_to_server(items=items, url=url)
+
+    monkeypatch.setattr(requests_to_server, "send_bulk_to_server", recording)
+    singles = backend.requests[("/telegram/message/add", "200")]
+
+    texts = [f"Сообщение {index}" for index in range(20)]
+    process(*[updates.message(-1031 - index % 2, 31, text=text) for index, text in enumerate(texts)])
+
+    async def delivered() -> None:
+        while ingestion.spool_drainer.spool.depth():
+            await asyncio.sleep(0.05)
+
+    loop.run_until_complete(asyncio.wait_for(delivered(), 5))
+    # Handlers only spool the messages, the drainer sends them in arrival order in as few requests as it can
+    assert [text for batch in sent for text in batch] == texts
+    assert len(sent) <= 2
+    assert backend.requests[("/telegram/message/add", "200")] == singles
@@ -0,0 +1,60 @@
+import json
+from types import SimpleNamespace
+
+from aiogram import types
+
+import util
+
+SELLERS = [{'id': 1, 'name': "Продавец 1"}, {'id': 2, 'name': "Продавец 2"}]
+
+
+def question(loop, current_question: int = 1, answers_data: list[dict[str]] = SELLERS, **kwargs):
+    arguments = {'question_name': "sellers", 'question': "Выберите продавца", 'answer_type': "list", 'required': True}
+    return loop.run_until_complete(util.construct_question_with_answers(
+        message=None,
+        current_question=current_question,
+        answers_data=answers_data,
+        **{**arguments, **kwargs}
+    ))
+
+
+def test_same_question_shares_one_keyboard(loop):
+    first, second = question(loop), question(loop, answers_data=[dict(item) for item in SELLERS])
+
+    assert first.reply_markup is second.reply_markup
+    assert question(loop, current_question=2).reply_markup is not first.reply_markup
+    assert question(loop, answers_data=SELLERS[:1]).reply_markup is not first.reply_markup
+
+
+def test_cached_keyboard_serializes_like_a_built_one(loop):
+    markup = question(loop, required=False).reply_markup
+    built = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="Продавец 1", callback_data="1/1")],
+        [types.InlineKeyboardButton(text="Продавец 2", callback_data="1/2")],
+        [types.InlineKeyboardButton(text="Пропустить", callback_data="1/skip")]
+    ])
+
+    assert markup.to_python() == built.to_python()
+    assert json.loads(markup.as_json()) == built.to_python()
+
+
+def test_required_text_question_has_no_keyboard(loop):
+    message = question(loop, question_name="comment", answer_type="text", answers_data=[])
+    assert message.reply_markup is None
+
+
+def test_admin_keyboards_are_kept_per_dialog(loop):
+    accounts = [{'id': 1, 'name': "ОАО Банк", 'current_sum': 10}]
+
+    def admin_markup(chat_id: int, user_id: int) -> types.InlineKeyboardMarkup:
+        return loop.run_until_complete(util.construct_message_to_admin_chat(
+            message=SimpleNamespace(chat=SimpleNamespace(id=chat_id)),
+            user_id=user_id,
+            answers_dict={},
+            answers_data=accounts
+        )).reply_markup
+
+    markup = admin_markup(-100, 7)
+    assert admin_markup(-100, 7) is markup
+    assert admin_markup(-100, 8) is not markup
+    assert [row[0].callback_data for row in markup.inline_keyboard] == ["admin/-100/7/1", "admin/-100/7/reject"]
@@ -0,0 +1,80 @@
+import pytest
+from aiogram.dispatcher.handler import CancelHandler
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import config
+import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    # Metrics made by a test stay out of the bot's own
+    monkeypatch.setattr(metrics, "_registry", [])
+
+
+def test_metrics_are_rendered_in_prometheus_text_format(registry):
+    counter = metrics.Counter("test_calls_total", "Calls.", ("endpoint",))
+    counter.inc(('/say "hi"',))
+    counter.inc(('/say "hi"',), 2)
+    histogram = metrics.Histogram("test_seconds", "Durations.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe((), value)
+    metrics.Gauge("test_depth", "Depth.", lambda: {("a",): 3}, ("queue",))
+
+    assert metrics.render().splitlines() == [
+        "# HELP test_calls_total Calls.",
+        "# TYPE test_calls_total counter",
+        'test_calls_total{endpoint="/say \\"hi\\""} 3',
+        "# HELP test_seconds Durations.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1.0"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        "test_seconds_sum 5.55",
+        "test_seconds_count 3",
+        "# HELP test_depth Depth.",
+        "# TYPE test_depth gauge",
+        'test_depth{queue="a"} 3',
+    ]
+
+
+def test_failing_gauge_does_not_break_the_scrape(registry):
+    metrics.Gauge("test_broken", "Broken.", lambda: 1 / 0)
+    metrics.Gauge("test_fine", "Fine.", lambda: 1)
+
+    assert metrics.render().splitlines()[-1] == "test_fine 1"
+
+
+def test_handler_errors_are_counted_but_cancelled_handlers_are_not(loop, registry, monkeypatch):
+    monkeypatch.setattr(metrics, "handler_errors", metrics.Counter("test_errors_total", "Errors.", ("handler",)))
+
+    async def failing():
+        raise ValueError()
+
+    async def cancelling():
+        raise CancelHandler()
+
+    for handler, error in ((failing, ValueError), (cancelling, CancelHandler)):
+        with pytest.raises(error):
+            loop.run_until_complete(metrics.instrument_handler(handler)())
+
+    assert metrics.handler_errors._values == {("failing",): 1}
+    # Both are still timed
+    assert sum(metrics.handler_seconds._series[("cancelling",)][0]) == 1
+
+
+def test_metrics_endpoint(loop, registry):
+    metrics.Counter("test_scrapes_total", "Scrapes.").inc()
+
+    async def scrape() -> tuple[int, str, str]:
+        app = web.Application()
+        app.router.add_get(config.METRICS_PATH, metrics.handle_metrics)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get(config.METRICS_PATH)
+            return response.status, response.headers['Content-Type'], await response.text()
+
+    status, content_type, text = loop.run_until_complete(scrape())
+    assert status == 200
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert "test_scrapes_total 1" in text.splitlines()
@@ -0,0 +1,65 @@
+import asyncio
+
+import prefetch
+import requests_to_server
+import util
+
+
+def dialog(chat_id: int, user_id: int) -> util.StateData:
+    return util.StateData(
+        previous_answers=(),
+        current_question=1,
+        user_id=user_id,
+        message_id=1,
+        chat_id=chat_id,
+        answer_type=util.AnswerType.list_.value,
+        question_name="sellers",
+        last_question=False,
+        question_name_ru="Продавец",
+        answers_dict={},
+        answers_data=({'id': 1}, {'id': 2})
+    )
+
+
+def test_evicted_dialog_prefetches_are_cancelled(loop, monkeypatch):
+    prefetcher = prefetch.QuestionPrefetcher(enabled=True, max_per_dialog=2, max_dialogs=1, ttl=60)
+
+    async def ask_for_question(**kwargs):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(requests_to_server, "ask_for_question", ask_for_question)
+
+    async def run():
+        prefetcher.start(dialog(1, 10), data={}, from_user_id=10)
+        evicted = list(prefetcher._dialogs.get((1, 10)).values())
+        prefetcher.start(dialog(2, 20), data={}, from_user_id=20)
+        await asyncio.gather(*evicted, return_exceptions=True)
+        kept = prefetcher._dialogs.get((2, 20))
+        prefetcher.cancel(2, 20)
+        await asyncio.gather(*kept.values(), return_exceptions=True)
+        return evicted
+
+    evicted_before = prefetch.prefetch_evictions._values.get((), 0)
+    assert all(task.cancelled() for task in loop.run_until_complete(run()))
+    assert prefetch.prefetch_evictions._values[()] == evicted_before + 1
+
+
+def test_answers_are_counted_as_hits_and_misses(loop, monkeypatch):
+    prefetcher = prefetch.QuestionPrefetcher(enabled=True, max_per_dialog=1, max_dialogs=10, ttl=60)
+
+    async def ask_for_question(**kwargs):
+        return None
+
+    monkeypatch.setattr(requests_to_server, "ask_for_question", ask_for_question)
+    before = dict(prefetch.prefetch_answers._values)
+
+    async def run():
+        prefetcher.start(dialog(3, 30), data={}, from_user_id=30)
+        prefetcher.on_answer(3, 30, "sellers", "1")
+        prefetcher.start(dialog(3, 30), data={}, from_user_id=30)
+        prefetcher.on_answer(3, 30, "sellers", "2")
+        await asyncio.sleep(0)
+
+    loop.run_until_complete(run())
+    assert prefetch.prefetch_answers._values[("hit",)] == before.get(("hit",), 0) + 1
+    assert prefetch.prefetch_answers._values[("miss",)] == before.get(("miss",), 0) + 1
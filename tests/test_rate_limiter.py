@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+import rate_limiter
+
+
+def make_limiter() -> rate_limiter.RateLimiter:
+    return rate_limiter.RateLimiter(
+        global_rate=100, global_burst=100, chat_rate=1, chat_burst=1, group_rate=0.01, group_burst=1
+    )
+
+
+def test_group_limit_counts_only_new_messages():
+    async def scenario() -> None:
+        limiter = make_limiter()
+        await limiter.acquire(-5, rate_limiter.Lane.interactive, new_message=True)
+        # Edits and deletions in the group aren't held back by the message it has just used up
+        for _ in range(5):
+            await limiter.acquire(-5, rate_limiter.Lane.interactive, new_message=False, timeout=0.05)
+        with pytest.raises(asyncio.TimeoutError):
+            await limiter.acquire(-5, rate_limiter.Lane.interactive, new_message=True, timeout=0.05)
+        assert not limiter._waiters
+
+    asyncio.run(scenario())
+
+
+def test_group_edits_wait_out_flood_control():
+    async def scenario() -> None:
+        limiter = make_limiter()
+        limiter.retry_after(-5, 10)
+        with pytest.raises(asyncio.TimeoutError):
+            await limiter.acquire(-5, rate_limiter.Lane.interactive, new_message=False, timeout=0.05)
+
+    asyncio.run(scenario())
@@ -0,0 +1,117 @@
+import asyncio
+
+from aiogram import Bot, types
+
+import benchmark
+import config
+import scheduler
+
+
+def test_shard_call_runs_in_order_with_the_chats_updates(loop):
+    dispatcher = scheduler.ShardedDispatcher(Bot(token=config.BOT_TOKEN), shards=2, max_in_flight=10)
+    updates = benchmark.UpdateFactory()
+    events = []
+    released = asyncio.Event()
+
+    async def call() -> str:
+        events.append("call")
+        return "done"
+
+    async def handler(message: types.Message) -> None:
+        match message.chat.id:
+            case 2:
+                events.append("user update")
+                await released.wait()
+            case 1:
+                # Chat 2 is in the other shard, chat 3 in this one, where the call runs right away
+                events.append(await dispatcher.scheduler.run_in_shard(2, call))
+                events.append(await dispatcher.scheduler.run_in_shard(3, call))
+
+    dispatcher.register_message_handler(handler)
+
+    async def scenario() -> None:
+        dispatcher.scheduler.start()
+        await dispatcher.process_updates([updates.message(2, 2, text="a"), updates.message(1, 1, text="b")])
+        await asyncio.sleep(0.05)
+        released.set()
+        await asyncio.wait_for(dispatcher.scheduler.close(), 1)
+
+    loop.run_until_complete(scenario())
+    assert events == ["user update", "call", "done", "call", "done"]
+
+
+def test_chat_updates_keep_their_order_while_other_chats_go_on(loop):
+    dispatcher = scheduler.ShardedDispatcher(Bot(token=config.BOT_TOKEN), shards=2, max_in_flight=10)
+    updates = benchmark.UpdateFactory()
+    events = []
+    released = asyncio.Event()
+
+    async def handler(message: types.Message) -> None:
+        if message.text == "slow":
+            await released.wait()
+        events.append((message.chat.id, message.text))
+        if message.chat.id == 1 and message.text == "c":
+            released.set()
+
+    dispatcher.register_message_handler(handler)
+
+    async def scenario() -> None:
+        dispatcher.scheduler.start()
+        await dispatcher.process_updates([
+            updates.message(2, 2, text="slow"),
+            updates.message(2, 2, text="after"),
+            updates.message(1, 1, text="b"),
+            updates.message(1, 1, text="c")
+        ])
+        await asyncio.wait_for(dispatcher.scheduler.close(), 1)
+
+    loop.run_until_complete(scenario())
+    # Chat 1 isn't held up by chat 2's slow update, which its next update waits for
+    assert events == [(1, "b"), (1, "c"), (2, "slow"), (2, "after")]
+
+
+def test_submit_waits_while_too_many_updates_are_in_flight(loop):
+    dispatcher = scheduler.ShardedDispatcher(Bot(token=config.BOT_TOKEN), shards=2, max_in_flight=2)
+    updates = benchmark.UpdateFactory()
+    released = asyncio.Event()
+
+    async def handler(message: types.Message) -> None:
+        await released.wait()
+
+    dispatcher.register_message_handler(handler)
+
+    async def scenario() -> None:
+        dispatcher.scheduler.start()
+        submitted = asyncio.ensure_future(dispatcher.process_updates([
+            updates.message(chat_id, chat_id, text="a") for chat_id in (1, 2, 3)
+        ]))
+        await asyncio.sleep(0.05)
+        assert not submitted.done()
+        assert dispatcher.scheduler.in_flight == 2
+        released.set()
+        await asyncio.wait_for(submitted, 1)
+        await asyncio.wait_for(dispatcher.scheduler.close(), 1)
+        assert dispatcher.scheduler.in_flight == 0
+
+    loop.run_until_complete(scenario())
+
+
+def test_failed_update_is_reported_and_the_shard_goes_on(loop):
+    dispatcher = scheduler.ShardedDispatcher(Bot(token=config.BOT_TOKEN), shards=1, max_in_flight=10)
+    updates = benchmark.UpdateFactory()
+    processed = []
+
+    async def handler(message: types.Message) -> None:
+        if message.text == "fail":
+            raise ValueError(message.text)
+
+    dispatcher.register_message_handler(handler)
+    dispatcher.scheduler.add_listener(lambda update, error: processed.append((update.message.text, repr(error))))
+
+    async def scenario() -> None:
+        dispatcher.scheduler.start()
+        await dispatcher.process_updates([updates.message(1, 1, text="fail"), updates.message(1, 1, text="ok")])
+        await asyncio.wait_for(dispatcher.scheduler.close(), 1)
+
+    loop.run_until_complete(scenario())
+    assert processed == [("fail", "ValueError('fail')"), ("ok", "None")]
@@ -0,0 +1,29 @@
+import spool
+
+
+def make_spool(tmp_path) -> spool.Spool:
+    outbound_spool = spool.Spool(path=str(tmp_path / "spool.sqlite3"), rate_window=60)
+    for key in ("a", "b"):
+        outbound_spool.append(dedup_key=key, code="addMessage", url="http://backend/add", data="{}", from_user_id=1)
+    return outbound_spool
+
+
+def test_spool_is_opened_lazily(tmp_path):
+    spool.Spool(path=str(tmp_path / "spool.sqlite3"), rate_window=60)
+    assert not (tmp_path / "spool.sqlite3").exists()
+
+
+def test_failing_entry_is_dead_lettered(tmp_path):
+    outbound_spool = make_spool(tmp_path)
+    stuck = outbound_spool.pending(1)[0]
+
+    assert outbound_spool.fail([stuck.id], "ValueError()", max_attempts=2) == 0
+    assert [entry.id for entry in outbound_spool.pending(1)] == [stuck.id]
+    assert outbound_spool.fail([stuck.id], "ValueError()", max_attempts=2) == 1
+
+    # The stuck entry no longer holds back the next one and isn't spooled again when its update is replayed
+    assert [entry.id for entry in outbound_spool.pending(1)] != [stuck.id]
+    assert outbound_spool.stats()['dead_letters'] == 1
+    assert not outbound_spool.append(dedup_key="a", code="addMessage", url="http://backend/add", data="{}",
+                                      from_user_id=1)
+    outbound_spool.close()
@@ -0,0 +1,34 @@
+import sqlite_storage
+
+
+def open_storage(tmp_path) -> sqlite_storage.SQLiteStorage:
+    # Every change is flushed right away
+    return sqlite_storage.SQLiteStorage(path=str(tmp_path / "fsm.sqlite3"), flush_delay=60, flush_max_pending=1)
+
+
+def test_dialogs_survive_restart_and_reset_ones_are_deleted(loop, tmp_path):
+    async def write():
+        storage = open_storage(tmp_path)
+        await storage.set_state(chat=1, user=1, state="Bill:question")
+        await storage.set_data(chat=1, user=1, data={'state_data': "open"})
+        await storage.set_state(chat=1, user=2, state="Bill:question")
+        await storage.set_data(chat=1, user=2, data={'state_data': "finished"})
+        await storage.finish(chat=1, user=2)
+        assert "2" not in storage.data["1"]
+        # Users without a dialog leave nothing behind
+        assert await storage.get_state(chat=2, user=3) is None
+        assert await storage.get_data(chat=2, user=3) == {}
+        assert "2" not in storage.data
+        await storage.close()
+
+    async def read():
+        storage = open_storage(tmp_path)
+        rows = storage._connection.execute("SELECT chat, user FROM fsm").fetchall()
+        data = await storage.get_data(chat=1, user=1)
+        await storage.close()
+        return rows, data
+
+    loop.run_until_complete(write())
+    rows, data = loop.run_until_complete(read())
+    assert rows == [("1", "1")]
+    assert data == {'state_data': "open"}
@@ -0,0 +1,77 @@
+import copy
+
+import sqlite_storage
+import util
+
+# A dialog as pickled by the bot before StateData had its codec, with PreviousAnswer and StateData as plain dataclasses
+LEGACY_RECORD = (
+    b'\x80\x05\x95\x90\x01\x00\x00\x00\x00\x00\x00}\x94\x8c\nstate_data\x94\x8c\x04util\x94\x8c\tStateData\x94\x93'
+    b'\x94)\x81\x94}\x94(\x8c\x10previous_answers\x94]\x94(h\x02\x8c\x0ePreviousAnswer\x94\x93\x94)\x81\x94}\x94'
+    b'(\x8c\x04name\x94\x8c\x07sellers\x94\x8c\x05value\x94\x8c\x015\x94ubh\n)\x81\x94}\x94(h\r\x8c\x03sum\x94h\x0f'
+    b'G@\x97p\x00\x00\x00\x00\x00ube\x8c\x10current_question\x94K\x03\x8c\x07user_id\x94K*\x8c\nmessage_id\x94M\xe8'
+    b'\x03\x8c\x07chat_id\x94J\xfb\xff\xff\xff\x8c\x0banswer_type\x94\x8c\x05float\x94\x8c\rquestion_name\x94h\x13'
+    b'\x8c\rlast_question\x94\x89\x8c\x10question_name_ru\x94\x8c\n\xd0\xa1\xd1\x83\xd0\xbc\xd0\xbc\xd0\xb0\x94\x8c'
+    b'\x0canswers_dict\x94}\x94\x8c\x10\xd0\x9f\xd1\x80\xd0\xbe\xd0\xb4\xd0\xb0\xd0\xb2\xd0\xb5\xd1\x86\x94\x8c\x12'
+    b'\xd0\x9f\xd1\x80\xd0\xbe\xd0\xb4\xd0\xb0\xd0\xb2\xd0\xb5\xd1\x86 5\x94s\x8c\x0canswers_data\x94]\x94}\x94(\x8c'
+    b'\x02id\x94K\x05h\rh!uaubs.'
+)
+
+# make_state_data() as written by codec versions 2 and 1, both have to stay readable
+CODEC_V2 = (
+    b'\x02\x80\x04\x95\x8c\x00\x00\x00\x00\x00\x00\x00(\x8c\x07sellers\x94\x8c\x015\x94\x86\x94\x8c\x03sum\x94G'
+    b'@\x97p\x00\x00\x00\x00\x00\x86\x94\x86\x94K\x03K*M\xe8\x03J\xfb\xff\xff\xff\x8c\x05float\x94h\x03\x89\x8c\n'
+    b'\xd0\xa1\xd1\x83\xd0\xbc\xd0\xbc\xd0\xb0\x94}\x94\x8c\x10\xd0\x9f\xd1\x80\xd0\xbe\xd0\xb4\xd0\xb0\xd0\xb2\xd0\xb5'
+    b'\xd1\x86\x94\x8c\x12\xd0\x9f\xd1\x80\xd0\xbe\xd0\xb4\xd0\xb0\xd0\xb2\xd0\xb5\xd1\x86 5\x94s}\x94(\x8c\x02id\x94'
+    b'K\x05\x8c\x04name\x94h\nu\x85\x94t\x94.'
+)
+CODEC_V1 = (
+    b'\x01\xa9\x0b)\x02)\x02\xda\x07sellers\xda\x015)\x02\xda\x03sum\xe7\x00\x00\x00\x00\x00p\x97@\xe9\x03\x00'
+    b'\x00\x00\xe9*\x00\x00\x00\xe9\xe8\x03\x00\x00\xe9\xfb\xff\xff\xff\xda\x05floatr\x03\x00\x00\x00F\xf5\n\x00'
+    b'\x00\x00\xd0\xa1\xd1\x83\xd0\xbc\xd0\xbc\xd0\xb0\xfb\xf5\x10\x00\x00\x00\xd0\x9f\xd1\x80\xd0\xbe\xd0\xb4\xd0'
+    b'\xb0\xd0\xb2\xd0\xb5\xd1\x86\xf5\x12\x00\x00\x00\xd0\x9f\xd1\x80\xd0\xbe\xd0\xb4\xd0\xb0\xd0\xb2\xd0\xb5\xd1'
+    b'\x86 50\xa9\x01{\xda\x02id\xe9\x05\x00\x00\x00\xda\x04namer\r\x00\x00\x000'
+)
+
+
+def make_state_data() -> util.StateData:
+    return util.StateData(
+        previous_answers=(util.PreviousAnswer("sellers", "5"), util.PreviousAnswer("sum", 1500.0)),
+        current_question=3,
+        user_id=42,
+        message_id=1000,
+        chat_id=-5,
+        answer_type="float",
+        question_name="sum",
+        last_question=False,
+        question_name_ru="Сумма",
+        answers_dict={"Продавец": "Продавец 5"},
+        answers_data=({'id': 5, 'name': "Продавец 5"},)
+    )
+
+
+def test_state_data_round_trip():
+    state_data = make_state_data()
+    assert util.decode_state_data(util.encode_state_data(state_data)) == state_data
+
+    raw = sqlite_storage.SQLiteStorage.dumps({'state_data': state_data})
+    assert sqlite_storage.SQLiteStorage.loads(raw) == {'state_data': state_data}
+
+
+def test_earlier_codec_versions_are_decoded():
+    assert util.encode_state_data(make_state_data())[0] == util.STATE_DATA_CODEC_VERSION == 2
+    assert util.decode_state_data(CODEC_V2) == make_state_data()
+    assert util.decode_state_data(CODEC_V1) == make_state_data()
+
+
+def test_legacy_pickle_is_decoded():
+    state_data = sqlite_storage.SQLiteStorage.loads(LEGACY_RECORD)['state_data']
+    assert state_data == make_state_data()
+    assert type(state_data.previous_answers[0]) is util.PreviousAnswer
+
+
+def test_copies_do_not_share_answers():
+    state_data = make_state_data()
+    copied = copy.deepcopy(state_data)
+    copied.answers_dict["Сумма"] = "1500"
+    copied.answers_data[0]['name'] = "Продавец 6"
+    assert state_data == make_state_data()
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import config
+import http_client
+import tracing
+
+
+@pytest.fixture
+def written(monkeypatch):
+    # Traces as they would be written to the JSONL file
+    traces = []
+
+    class Logger:
+        @staticmethod
+        def info(line: str) -> None:
+            traces.append(json.loads(line))
+
+    monkeypatch.setattr(tracing, "trace_logger", Logger)
+    monkeypatch.setattr(config, "TRACE_SAMPLE_RATE", 0.0)
+    return traces
+
+
+def test_spans_are_nested_and_failed_traces_are_always_kept(written):
+    tracing.start_trace("update", update_id=1)
+    with tracing.span("handler"):
+        with tracing.span("backend"):
+            pass
+        with pytest.raises(ValueError):
+            with tracing.span("telegram", method="sendMessage"):
+                raise ValueError("flood")
+    trace_id = tracing.correlation_id()
+    tracing.finish_trace()
+
+    assert tracing.correlation_id() is None
+    [trace] = written
+    assert trace['correlation_id'] == trace_id
+    assert trace['attributes'] == {'update_id': 1}
+    assert [(span['id'], span['parent'], span['name']) for span in trace['spans']] == [
+        (1, None, "handler"), (2, 1, "backend"), (3, 1, "telegram")
+    ]
+    assert trace['spans'][2]['error'] == "ValueError('flood')"
+    assert trace['spans'][2]['attributes'] == {'method': "sendMessage"}
+
+
+def test_fast_traces_are_sampled_and_late_spans_dropped(written):
+    trace = tracing.start_trace("update", update_id=2)
+    tracing.finish_trace()
+    tracing._current_trace.set(trace)
+    with tracing.span("leftover task"):
+        pass
+    tracing._current_trace.set(None)
+
+    assert written == []
+    assert trace.spans == []
+
+
+def test_backend_requests_carry_the_correlation_id(loop, written):
+    received = []
+
+    async def echo(request: web.Request) -> web.Response:
+        received.append(request.headers.get(tracing.CORRELATION_HEADER))
+        return web.json_response({'error': 0})
+
+    async def scenario() -> str:
+        app = web.Application()
+        app.router.add_post("/echo", echo)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            tracing.start_trace("update", update_id=3)
+            trace_id = tracing.correlation_id()
+            await http_client.request("POST", str(server.make_url("/echo")))
+            tracing.finish_trace()
+        finally:
+            await http_client.close()
+            await server.close()
+        return trace_id
+
+    trace_id = loop.run_until_complete(asyncio.wait_for(scenario(), 5))
+    assert received == [trace_id]
@@ -0,0 +1,95 @@
+import asyncio
+
+from aiogram import Bot, types
+from aiohttp.test_utils import TestClient, TestServer
+
+import benchmark
+import config
+import scheduler
+import webhook
+
+
+async def drain(dispatcher) -> None:
+    for queue in dispatcher.scheduler.queues:
+        await queue.join()
+
+
+def test_update_is_answered_through_webhook(loop, running_bot):
+    dispatcher, bot = running_bot
+    update = benchmark.UpdateFactory().message(
+        -1001, 1, text="/bill", entities=[{'type': "bot_command", 'offset': 0, 'length': 5}]
+    )
+
+    async def scenario() -> int:
+        app = webhook.UpdateWebhook(dispatcher).make_app(config.WEBHOOK_PATH)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post(config.WEBHOOK_PATH, json=update.to_python())
+        await asyncio.wait_for(drain(dispatcher), 10)
+        return response.status
+
+    bot.calls.clear()
+    assert loop.run_until_complete(scenario()) == 200
+    # The first /bill question is sent by a scheduler worker, which has to see the bot
+    assert bot.calls['sendMessage'] == 1
+
+
+def make_blocking_dispatcher(max_in_flight: int) -> tuple[scheduler.ShardedDispatcher, list[int], asyncio.Event]:
+    dispatcher = scheduler.ShardedDispatcher(Bot(token=config.BOT_TOKEN), shards=2, max_in_flight=max_in_flight)
+    handled = []
+    released = asyncio.Event()
+
+    async def handler(message: types.Message) -> None:
+        handled.append(message.chat.id)
+        await released.wait()
+
+    dispatcher.register_message_handler(handler)
+    return dispatcher, handled, released
+
+
+def test_webhook_rejects_wrong_secret_token(loop):
+    dispatcher, handled, released = make_blocking_dispatcher(max_in_flight=10)
+    released.set()
+    update = benchmark.UpdateFactory().message(-1001, 1, text="Привет")
+
+    async def scenario() -> list[int]:
+        dispatcher.scheduler.start()
+        app = webhook.UpdateWebhook(dispatcher, secret_token="secret").make_app(config.WEBHOOK_PATH)
+        async with TestClient(TestServer(app)) as client:
+            statuses = [
+                (await client.post(config.WEBHOOK_PATH, json=update.to_python(), headers=headers)).status
+                for headers in ({}, {"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+                                {"X-Telegram-Bot-Api-Secret-Token": "secret"})
+            ]
+        await dispatcher.scheduler.close()
+        return statuses
+
+    assert loop.run_until_complete(scenario()) == [401, 401, 200]
+    assert handled == [-1001]
+
+
+def test_webhook_holds_updates_beyond_in_flight_limit(loop):
+    dispatcher, handled, released = make_blocking_dispatcher(max_in_flight=2)
+    updates = benchmark.UpdateFactory()
+
+    async def scenario() -> tuple[list[bool], list[int]]:
+        dispatcher.scheduler.start()
+        app = webhook.UpdateWebhook(dispatcher).make_app(config.WEBHOOK_PATH)
+        async with TestClient(TestServer(app)) as client:
+            posts = [
+                asyncio.ensure_future(client.post(
+                    config.WEBHOOK_PATH, json=updates.message(-1000 - index, 1, text="Привет").to_python()
+                ))
+                for index in range(3)
+            ]
+            await asyncio.sleep(0.2)
+            answered = [post.done() for post in posts]
+            released.set()
+            statuses = [(await post).status for post in posts]
+        await dispatcher.scheduler.close()
+        return answered, statuses
+
+    answered, statuses = loop.run_until_complete(scenario())
+    # The third update is answered only once one of the first two is processed, Telegram keeps it until then
+    assert sorted(answered) == [False, True, True]
+    assert statuses == [200, 200, 200]
+    assert len(handled) == 3
@@ -0,0 +1,131 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import config
+
+
+CORRELATION_HEADER = "X-Correlation-ID"
+
+
+class Trace:
+    __slots__ = ("correlation_id", "name", "attributes", "started_at", "start", "spans", "finished")
+
+    def __init__(self, name: str, attributes: dict):
+        self.correlation_id = uuid.uuid4().hex
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans: list[dict] = []
+        # Tasks started by a handler may outlive the update, their spans are dropped after it's finished
+        self.finished = False
+
+    def to_dict(self, duration_ms: float) -> dict:
+        return {
+            'correlation_id': self.correlation_id,
+            'name': self.name,
+            'attributes': self.attributes,
+            'started_at': self.started_at,
+            'duration_ms': duration_ms,
+            'spans': self.spans
+        }
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[int | None] = ContextVar("current_span", default=None)
+
+
+def correlation_id() -> str | None:
+    trace = _current_trace.get()
+    return None if trace is None else trace.correlation_id
+
+
+@contextmanager
+def span(name: str, **attributes):
+    trace = _current_trace.get()
+    if trace is None or trace.finished:
+        yield
+        return
+
+    start = time.perf_counter()
+    record = {
+        'id': len(trace.spans) + 1,
+        'parent': _current_span.get(),
+        'name': name,
+        'start_ms': round((start - trace.start) * 1000, 3),
+        'duration_ms': None
+    }
+    if attributes:
+        record['attributes'] = attributes
+    trace.spans.append(record)
+    token = _current_span.set(record['id'])
+    try:
+        yield
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['duration_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        _current_span.reset(token)
+
+
+def start_trace(name: str, **attributes) -> Trace:
+    trace = Trace(name, attributes)
+    _current_trace.set(trace)
+    _current_span.set(None)
+    return trace
+
+
+def finish_trace() -> None:
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    _current_trace.set(None)
+    trace.finished = True
+
+    duration_ms = round((time.perf_counter() - trace.start) * 1000, 3)
+    # Slow and failed traces are always kept, the rest is sampled
+    if duration_ms < config.TRACE_SLOW_THRESHOLD * 1000 and \
+            not any('error' in record for record in trace.spans) and \
+            random.random() >= config.TRACE_SAMPLE_RATE:
+        return
+    # Spans still open in leftover tasks keep changing, so the trace is serialized here and only written later
+    trace_logger.info(json.dumps(trace.to_dict(duration_ms), ensure_ascii=False, default=repr))
+
+
+class TracingMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict) -> None:
+        start_trace("update", update_id=update.update_id)
+
+    async def on_post_process_update(self, update: types.Update, result: list, data: dict) -> None:
+        finish_trace()
+
+
+trace_logger = logging.getLogger("BotTrace")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+
+file_handler = RotatingFileHandler(
+    filename=config.TRACE_FILE_PATH,
+    maxBytes=config.TRACE_MAX_BYTES,
+    backupCount=config.TRACE_BACKUP_COUNT,
+    delay=True
+)
+file_handler.setFormatter(logging.Formatter('%(message)s'))
+
+trace_queue = queue.SimpleQueue()
+trace_logger.addHandler(QueueHandler(trace_queue))
+listener = QueueListener(trace_queue, file_handler)
+listener.start()
+atexit.register(listener.stop)
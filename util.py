@@ -1,10 +1,20 @@
-from aiogram import types
-from dataclasses import dataclass
+import asyncio
+import hashlib
+import io
+import json
+import marshal
+import pickle
+import sys
+from aiogram import Bot, types
+from dataclasses import dataclass, replace
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters.state import State
 from enum import Enum
+from typing import Callable
 
 import bot_logger
 import bot_message
+import cache
 import config
 
 
@@ -14,15 +24,53 @@ class AnswerType(Enum):
     text_ = "text"
 
 
-@dataclass
-class PreviousAnswer:
-    name: str
-    value: str | float
+class PreviousAnswer(tuple):
+    __slots__ = ()
 
+    def __new__(cls, name: str, value: str | float):
+        return tuple.__new__(cls, (sys.intern(name), value))
 
-@dataclass
+    @property
+    def name(self) -> str:
+        return self[0]
+
+    @property
+    def value(self) -> str | float:
+        return self[1]
+
+    def __repr__(self):
+        return f"PreviousAnswer(name={self.name!r}, value={self.value!r})"
+
+    def __reduce__(self):
+        return PreviousAnswer, tuple(self)
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class LegacyPreviousAnswer:
+    # Dialogs pickled before STATE_DATA_CODEC_VERSION 1 hold PreviousAnswer as a plain object with its fields
+    def __new__(cls, *args):
+        if args:
+            return PreviousAnswer(*args)
+        return super().__new__(cls)
+
+
+class StateDataUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == __name__ and name == "PreviousAnswer":
+            return LegacyPreviousAnswer
+        return super().find_class(module, name)
+
+
+def unpickle(raw: bytes):
+    return StateDataUnpickler(io.BytesIO(raw)).load()
+
+
+# previous_answers are never changed in place, so copies of a dialog share them
+@dataclass(slots=True)
 class StateData:
-    previous_answers: list[PreviousAnswer]
+    previous_answers: tuple[PreviousAnswer, ...]
     current_question: int
     user_id: int
     message_id: int | None
@@ -32,7 +80,75 @@ class StateData:
     last_question: bool
     question_name_ru: str
     answers_dict: dict
-    answers_data: list[dict[str]]
+    answers_data: tuple[dict[str], ...]
+
+    def __deepcopy__(self, memo):
+        return replace(
+            self,
+            answers_dict=dict(self.answers_dict),
+            answers_data=tuple(dict(item) for item in self.answers_data)
+        )
+
+    def __reduce__(self):
+        return decode_state_data, (encode_state_data(self),)
+
+    def __setstate__(self, state: dict[str]):
+        # Only reached by dialogs pickled before the codec, with their fields by name
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.previous_answers = tuple(PreviousAnswer(answer.name, answer.value) for answer in self.previous_answers)
+        self.answers_data = tuple(self.answers_data)
+
+
+# 1 was marshal, which may change between Python versions, it's only read so dialogs saved with it survive the update.
+# 2 is a plain tuple pickled with a fixed protocol, which every later Python reads the same way
+STATE_DATA_CODEC_VERSION = 2
+STATE_DATA_PICKLE_PROTOCOL = 4
+
+
+def _intern(value: str | None) -> str | None:
+    return None if value is None else sys.intern(value)
+
+
+def encode_state_data(state_data: StateData) -> bytes:
+    return bytes((STATE_DATA_CODEC_VERSION,)) + pickle.dumps((
+        tuple(tuple(previous_answer) for previous_answer in state_data.previous_answers),
+        state_data.current_question,
+        state_data.user_id,
+        state_data.message_id,
+        state_data.chat_id,
+        state_data.answer_type,
+        state_data.question_name,
+        state_data.last_question,
+        state_data.question_name_ru,
+        state_data.answers_dict,
+        state_data.answers_data
+    ), STATE_DATA_PICKLE_PROTOCOL)
+
+
+def decode_state_data(raw: bytes) -> StateData:
+    match raw[0]:
+        case 2:
+            fields = pickle.loads(raw[1:])
+        case 1:
+            fields = marshal.loads(raw[1:])
+        case version:
+            raise ValueError(f"Unsupported StateData codec version {version}.")
+    (previous_answers, current_question, user_id, message_id, chat_id, answer_type, question_name,
+     last_question, question_name_ru, answers_dict, answers_data) = fields
+    return StateData(
+        previous_answers=tuple(PreviousAnswer(name, value) for name, value in previous_answers),
+        current_question=current_question,
+        user_id=user_id,
+        message_id=message_id,
+        chat_id=chat_id,
+        answer_type=_intern(answer_type),
+        question_name=_intern(question_name),
+        last_question=last_question,
+        question_name_ru=_intern(question_name_ru),
+        answers_dict={sys.intern(key): value for key, value in answers_dict.items()},
+        answers_data=tuple(answers_data)
+    )
 
 
 @dataclass
@@ -51,6 +167,41 @@ async def get_state_data(state: FSMContext) -> StateData:
     return (await state.get_data())['state_data']
 
 
+async def transition(
+        state: FSMContext,
+        state_data: StateData,
+        next_state: State | None = None,
+        **changes
+) -> StateData:
+    changed = False
+    for field, value in changes.items():
+        current = getattr(state_data, field)
+        if current is not value and current != value:
+            setattr(state_data, field, value)
+            changed = True
+
+    state_changed = next_state is not None and next_state.state != await state.get_state()
+    if not changed and not state_changed:
+        return state_data
+
+    # Storages that support it get the data and the state in a single operation
+    update_record = getattr(state.storage, "update_record", None)
+    if update_record is not None:
+        await update_record(
+            chat=state.chat,
+            user=state.user,
+            data={'state_data': state_data} if changed else None,
+            state=next_state.state if state_changed else None,
+            set_state=state_changed
+        )
+    else:
+        if changed:
+            await update_state_data(state, state_data)
+        if state_changed:
+            await state.set_state(next_state)
+    return state_data
+
+
 def get_text(message: types.Message):
     if message.text:
         return message.text
@@ -60,6 +211,22 @@ def get_text(message: types.Message):
         return ""
 
 
+# Resolved file URLs keyed by file_unique_id, Telegram keeps file paths valid for at least an hour
+file_url_cache = cache.TTLCache(
+    max_size=config.FILES_CACHE_SIZE,
+    ttl=config.FILES_CACHE_TTL
+)
+
+
+async def get_file_url(bot: Bot, file: types.base.TelegramObject) -> str:
+    url = file_url_cache.get(file.file_unique_id)
+    if url is None:
+        new_file = await bot.get_file(file.file_id)
+        url = "https://api.telegram.org/file/bot" + config.BOT_TOKEN + "/" + new_file["file_path"]
+        file_url_cache.set(file.file_unique_id, url)
+    return url
+
+
 async def get_files(message: types.Message):
     files = {
         "audio": "",
@@ -72,28 +239,25 @@ async def get_files(message: types.Message):
         "location": {},
         "contact": {}
     }
-    if message.audio:
-        new_file = await message.bot.get_file(message.audio.file_id)
-        files["audio"] = "https://api.telegram.org/file/bot" + config.BOT_TOKEN + "/" + new_file["file_path"]
-    if message.document:
-        new_file = await message.bot.get_file(message.document.file_id)
-        files["document"] = "https://api.telegram.org/file/bot" + config.BOT_TOKEN + "/" + new_file["file_path"]
-    if message.photo:
-        for photo in message.photo:
-            new_file = await message.bot.get_file(photo.file_id)
-            files["photo"].append("https://api.telegram.org/file/bot" + config.BOT_TOKEN + "/" + new_file["file_path"])
-    if message.sticker:
-        new_file = await message.bot.get_file(message.sticker.thumb.file_id)
-        files["sticker"] = "https://api.telegram.org/file/bot" + config.BOT_TOKEN + "/" + new_file["file_path"]
-    if message.video:
-        new_file = await message.bot.get_file(message.video.file_id)
-        files["video"] = "https://api.telegram.org/file/bot" + config.BOT_TOKEN + "/" + new_file["file_path"]
-    if message.video_note:
-        new_file = await message.bot.get_file(message.video_note.file_id)
-        files["video_note"] = "https://api.telegram.org/file/bot" + config.BOT_TOKEN + "/" + new_file["file_path"]
-    if message.voice:
-        new_file = await message.bot.get_file(message.voice.file_id)
-        files["voice"] = "https://api.telegram.org/file/bot" + config.BOT_TOKEN + "/" + new_file["file_path"]
+    to_resolve = {
+        "audio": message.audio,
+        "document": message.document,
+        "sticker": message.sticker.thumb if message.sticker else None,
+        "video": message.video,
+        "video_note": message.video_note,
+        "voice": message.voice
+    }
+    to_resolve = {key: file for key, file in to_resolve.items() if file}
+    # Sizes are sorted from the smallest to the largest one
+    photos = message.photo[-1:] if config.FILES_PHOTO_LARGEST_ONLY else message.photo
+
+    urls = await asyncio.gather(*[
+        get_file_url(message.bot, file)
+        for file in [*to_resolve.values(), *photos]
+    ])
+    files.update(zip(to_resolve.keys(), urls))
+    files["photo"] = urls[len(to_resolve):]
+
     if message.location:
         files["location"]["longitude"] = message.location.longitude
         files["location"]["latitude"] = message.location.latitude
@@ -113,10 +277,11 @@ async def get_files(message: types.Message):
 
 def get_reply_to_message_id(message: types.Message):
     if message.reply_to_message:
-        print("reply good")
+        bot_logger.debug("Message %s is a reply to message %s.",
+                         message.message_id, message.reply_to_message.message_id)
         return message.reply_to_message.message_id
     else:
-        print("reply bad")
+        bot_logger.debug("Message %s isn't a reply.", message.message_id)
         return 0
 
 
@@ -130,87 +295,100 @@ def check_float(
         return False
 
 
+# Pre-built keyboards keyed by a digest of what they're built from, shared between dialogs and chats
+keyboard_cache = cache.TTLCache(
+    max_size=config.KEYBOARD_CACHE_SIZE,
+    ttl=config.KEYBOARD_CACHE_TTL
+)
+
+
+def keyboard_key(*parts) -> str:
+    serialized = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+
+
+def cached_keyboard(
+        key: str,
+        build: Callable[[], list[list[types.InlineKeyboardButton]]]
+) -> bot_message.FrozenKeyboard:
+    keyboard = keyboard_cache.get(key)
+    if keyboard is None:
+        keyboard = bot_message.FrozenKeyboard(inline_keyboard=build())
+        keyboard_cache.set(key, keyboard)
+    return keyboard
+
+
+def answer_callback_data(current_question: int, answer) -> str:
+    # The question's number goes along, so a late tap on the previous question's keyboard isn't taken for this one
+    return f"{current_question}/{answer}"
+
+
+def parse_answer_callback_data(data: str) -> tuple[int | None, str]:
+    current_question, separator, answer = data.partition("/")
+    if not separator or not current_question.isdigit():
+        # Keyboards sent before the question's number was added
+        return None, data
+    return int(current_question), answer
+
+
+def build_question_keyboard(
+        current_question: int,
+        question_name: str,
+        answer_type: AnswerType,
+        required: bool,
+        answers_data: list[dict[str]]
+) -> list[list[types.InlineKeyboardButton]]:
+    rows = []
+    if answer_type is AnswerType.list_:
+        for item in answers_data:
+            text = f"{item['name']}, ИНН: {item['inn']}" if question_name == "legals" else item['name']
+            rows.append([types.InlineKeyboardButton(
+                text=text,
+                callback_data=answer_callback_data(current_question, item['id'])
+            )])
+    if not required:
+        rows.append([types.InlineKeyboardButton(
+            text="Пропустить",
+            callback_data=answer_callback_data(current_question, "skip")
+        )])
+    return rows
+
+
 async def construct_question_with_answers(
         message: types.Message,
+        current_question: int,
         question_name: str,
         question: str,
         answer_type: str,
         required: bool,
         answers_data: list[dict[str]]
 ) -> bot_message.BotMessage:
-    bot_logger.debug(f"Making a buttoned message for this data: "
-                     f"{question_name=}, {question=}, {answer_type=}, {required=} {answers_data=}")
+    bot_logger.debug("Making a buttoned message for this data: "
+                     "question_name=%r, question=%r, answer_type=%r, required=%r answers_data=%r",
+                     question_name, question, answer_type, required, answers_data)
 
     _type = AnswerType(answer_type)
 
-    match _type:
-        case AnswerType.list_:
-            markup = types.InlineKeyboardMarkup(
-                row_width=1
-            )
-            for item in answers_data:
-                text = f"{item['name']}, ИНН: {item['inn']}" if question_name == "legals" else item['name']
-                callback_data = item['id']
-                markup.add(
-                    types.InlineKeyboardButton(
-                        text=text,
-                        callback_data=callback_data
-                    )
-                )
-            if not required:
-                markup.add(
-                    types.InlineKeyboardButton(
-                        text="Пропустить",
-                        callback_data="skip"
-                    )
-                )
-
-            return bot_message.BotMessage(
-                text=question,
-                reply_markup=markup
-            )
-        case AnswerType.float_:
-            if required:
-                return bot_message.BotMessage(
-                    text=question
-                )
-            else:
-                return bot_message.BotMessage(
-                    text=question,
-                    reply_markup=types.InlineKeyboardMarkup().add(
-                        types.InlineKeyboardButton(
-                            text="Пропустить",
-                            callback_data="skip"
-                        )
-                    )
-                )
-        case AnswerType.text_:
-            if required:
-                return bot_message.BotMessage(
-                    text=question
-                )
-            else:
-                return bot_message.BotMessage(
-                    text=question,
-                    reply_markup=types.InlineKeyboardMarkup().add(
-                        types.InlineKeyboardButton(
-                            text="Пропустить",
-                            callback_data="skip"
-                        )
-                    )
-                )
+    # Required number and text questions are answered with a message, they have no buttons
+    if _type is not AnswerType.list_ and required:
+        return bot_message.BotMessage(
+            text=question
+        )
+    return bot_message.BotMessage(
+        text=question,
+        reply_markup=cached_keyboard(
+            keyboard_key("question", current_question, question_name, answer_type, required, answers_data),
+            lambda: build_question_keyboard(current_question, question_name, _type, required, answers_data)
+        )
+    )
 
 
-async def construct_message_to_admin_chat(
-        message: types.Message,
-        answers_dict: dict[str],
+def build_admin_keyboard(
+        chat_id: int,
+        user_id: int,
         answers_data: list[dict[str]]
-) -> bot_message.BotMessage:
-    bot_logger.debug(f"Making a buttoned message for this data: "
-                     f"{answers_dict=}, {answers_data=}")
-    markup = types.InlineKeyboardMarkup(
-        row_width=1
-    )
+) -> list[list[types.InlineKeyboardButton]]:
+    rows = []
     for item in answers_data:
         if item['name'].startswith("ОАО "):
             name = item['name'][4:]
@@ -221,18 +399,32 @@ async def construct_message_to_admin_chat(
         text = f"{name} : " \
                f"{item['date_add_current_sum'] if 'date_add_current_sum' in item else '---'} : " \
                f"{item['current_sum'] if 'current_sum' in item else '---'}"
-        callback_data = f"admin/{message.chat.id}/{item['id']}"
-        markup.add(
-            types.InlineKeyboardButton(
-                text=text,
-                callback_data=str(callback_data)
-            )
-        )
-    markup.add(
-        types.InlineKeyboardButton(
-            text="Отклонить",
-            callback_data=f"admin/{message.chat.id}/reject"
-        )
+        callback_data = f"admin/{chat_id}/{user_id}/{item['id']}"
+        rows.append([types.InlineKeyboardButton(
+            text=text,
+            callback_data=str(callback_data)
+        )])
+    rows.append([types.InlineKeyboardButton(
+        text="Отклонить",
+        callback_data=f"admin/{chat_id}/{user_id}/reject"
+    )])
+    return rows
+
+
+async def construct_message_to_admin_chat(
+        message: types.Message,
+        user_id: int,
+        answers_dict: dict[str],
+        answers_data: list[dict[str]]
+) -> bot_message.BotMessage:
+    bot_logger.debug("Making a buttoned message for this data: "
+                     "answers_dict=%r, answers_data=%r",
+                     answers_dict, answers_data)
+
+    # The callback data names the user's dialog, so these keyboards are shared between the user's requests
+    markup = cached_keyboard(
+        keyboard_key("admin", message.chat.id, user_id, answers_data),
+        lambda: build_admin_keyboard(message.chat.id, user_id, answers_data)
     )
 
     text = "Подтвердить данный запрос?"
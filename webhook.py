@@ -0,0 +1,63 @@
+from typing import Awaitable, Callable
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+import bot_logger
+import config
+
+
+class UpdateWebhook:
+    def __init__(self, dispatcher: Dispatcher, secret_token: str | None = None):
+        self.dispatcher = dispatcher
+        self.secret_token = secret_token
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token and \
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            return web.Response(status=401)
+
+        Dispatcher.set_current(self.dispatcher)
+        Bot.set_current(self.dispatcher.bot)
+        update = types.Update(**(await request.json()))
+
+        # Answered as soon as the scheduler accepts the update, it only waits when the in-flight limit is reached
+        await self.dispatcher.process_updates([update])
+        return web.Response()
+
+    def make_app(self, path: str) -> web.Application:
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        return app
+
+
+def start_webhook(
+        dispatcher: Dispatcher,
+        on_startup: Callable[[Dispatcher], Awaitable],
+        on_shutdown: Callable[[Dispatcher], Awaitable]
+) -> None:
+    update_webhook = UpdateWebhook(
+        dispatcher=dispatcher,
+        secret_token=config.WEBHOOK_SECRET_TOKEN or None
+    )
+    app = update_webhook.make_app(config.WEBHOOK_PATH)
+
+    async def startup(_: web.Application) -> None:
+        await on_startup(dispatcher)
+        bot_logger.info(f"Setting webhook to {config.WEBHOOK_HOST + config.WEBHOOK_PATH}")
+        await dispatcher.bot.set_webhook(
+            url=config.WEBHOOK_HOST + config.WEBHOOK_PATH,
+            max_connections=config.WEBHOOK_MAX_CONCURRENT_UPDATES,
+            secret_token=config.WEBHOOK_SECRET_TOKEN or None
+        )
+
+    async def shutdown(_: web.Application) -> None:
+        await on_shutdown(dispatcher)
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+        session = await dispatcher.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=config.WEBAPP_HOST, port=config.WEBAPP_PORT)